@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module with native implementations of beta diversity metrics."""
+
+from numpy import (add, array, concatenate, cumsum, fill_diagonal, flatnonzero,
+                   newaxis, ones, union1d, unique, zeros)
+from scipy.sparse import csr_matrix
+
+# Metrics that can be computed by this module. These names match the metric
+# names used by QIIME's beta_diversity.py.
+METRICS = ['bray_curtis', 'unweighted_unifrac', 'weighted_unifrac']
+
+# Metrics that require a tree.
+PHYLOGENETIC_METRICS = ['unweighted_unifrac', 'weighted_unifrac']
+
+# Maximum number of array elements to create at once when comparing a block
+# of samples against the other samples.
+MAX_BLOCK_ELEMENTS = 2 ** 22
+
+def table_to_csr(table):
+    """Converts a biom table into a sparse matrix with one row per sample.
+
+    Returns the sample IDs, observation IDs, and a scipy CSR matrix of counts
+    (samples x observations).
+    """
+    indptr = [0]
+    indices = []
+    data = []
+
+    for samp_data in table.iterSampleData():
+        nonzero_idxs = flatnonzero(samp_data)
+        indices.append(nonzero_idxs)
+        data.append(samp_data[nonzero_idxs])
+        indptr.append(indptr[-1] + len(nonzero_idxs))
+
+    if indices:
+        indices = concatenate(indices)
+        data = concatenate(data).astype(float)
+    else:
+        indices = zeros(0, dtype=int)
+        data = zeros(0)
+
+    counts = csr_matrix((data, indices, array(indptr)),
+                        shape=(len(table.SampleIds),
+                               len(table.ObservationIds)))
+    return list(table.SampleIds), list(table.ObservationIds), counts
+
+def compute_distance_matrices(table, metrics, tree=None):
+    """Computes distance matrices for a biom table using several metrics.
+
+    metrics should be a list of metric names (see METRICS). tree must be a
+    FlatTree if any of the metrics are phylogenetic. Both UniFrac variants are
+    computed from a single pass over the tree.
+
+    Returns the sample IDs and a list of distance matrices (numpy arrays), one
+    for each metric.
+    """
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown metric '%s'. Must be one of %r." %
+                             (metric, METRICS))
+        if metric in PHYLOGENETIC_METRICS and tree is None:
+            raise ValueError("A tree is required to compute %s." % metric)
+
+    samp_ids, obs_ids, counts = table_to_csr(table)
+
+    unifrac_dms = {}
+    if set(metrics) & set(PHYLOGENETIC_METRICS):
+        unifrac_dms['unweighted_unifrac'], unifrac_dms['weighted_unifrac'] = \
+                unifrac(counts, obs_ids, tree)
+
+    dms = []
+    for metric in metrics:
+        if metric == 'bray_curtis':
+            dms.append(bray_curtis(counts))
+        else:
+            dms.append(unifrac_dms[metric])
+    return samp_ids, dms
+
+def bray_curtis(counts):
+    """Computes Bray-Curtis distances between the rows of a sparse matrix.
+
+    counts should be a scipy sparse matrix with one row per sample (e.g. as
+    returned by table_to_csr). Returns a numpy array containing the distance
+    matrix, which can be passed directly to the methods in the stats module.
+    Distances are the same as those computed by QIIME's beta_diversity.py (two
+    samples with no counts have a distance of zero).
+    """
+    counts = csr_matrix(counts, dtype=float)
+    totals = array(counts.sum(axis=1)).ravel()
+
+    denominators = totals[:, newaxis] + totals
+    denominators[denominators == 0] = 1
+    return pairwise_l1(counts) / denominators
+
+def unifrac(counts, obs_ids, tree):
+    """Computes unweighted and weighted UniFrac distances.
+
+    counts should be a scipy sparse matrix with one row per sample and one
+    column per observation (e.g. as returned by table_to_csr), obs_ids should
+    be the tip names of each observation, and tree should be a FlatTree.
+
+    The counts are summed up the tree once, with each level of the tree
+    handled as a single vectorized operation. Branches that are not observed
+    in any sample are ignored. Returns a tuple of numpy arrays containing the
+    unweighted and (unnormalized) weighted UniFrac distance matrices. These
+    are the same as those computed by QIIME's beta_diversity.py.
+    """
+    counts = csr_matrix(counts, dtype=float)
+    tip_idxs = tree.getTipIndices(obs_ids)
+
+    # Only keep branches that are observed in at least one sample.
+    obs_totals = zeros(len(tree.names))
+    add.at(obs_totals, tip_idxs, array(counts.sum(axis=0)).ravel())
+    keep = tree.propagate(obs_totals) > 0
+    tree = tree.subtree(keep)
+    tip_idxs = (cumsum(keep) - 1)[tip_idxs]
+
+    # Per-sample abundances of each branch (branches x samples).
+    node_counts = zeros((len(tree.names), counts.shape[0]))
+    add.at(node_counts, tip_idxs, counts.T.toarray())
+    node_counts = tree.propagate(node_counts)
+    lengths = tree.lengths
+
+    # Unweighted: unique branch length / observed branch length.
+    present = (node_counts > 0).astype(float)
+    branch_totals = lengths.dot(present)
+    shared = (present * lengths[:, newaxis]).T.dot(present)
+    observed = branch_totals[:, newaxis] + branch_totals - shared
+    unique_lengths = observed - shared
+    observed[observed == 0] = 1
+    unweighted = unique_lengths / observed
+    fill_diagonal(unweighted, 0)
+
+    # Weighted: branch lengths times the absolute difference in each sample's
+    # relative abundance.
+    # Samples with no counts are a distance of one from all other samples
+    # (this matches QIIME).
+    samp_totals = array(counts.sum(axis=1)).ravel()
+    empty = samp_totals == 0
+    samp_totals[empty] = 1
+    weighted = pairwise_l1(node_counts.T / samp_totals[:, newaxis], lengths)
+    weighted[empty] = 1
+    weighted[:, empty] = 1
+    fill_diagonal(weighted, 0)
+
+    return unweighted, weighted
+
+def pairwise_l1(mat, weights=None):
+    """Computes (weighted) L1 distances between the rows of a sparse matrix.
+
+    The distance between rows x and y is the sum of
+    weights[k] * |x[k] - y[k]| over all columns k. If weights is not provided,
+    all columns are weighted equally. The values in mat must be nonnegative.
+
+    Rows are compared in blocks. Each block is only compared over the columns
+    where it has nonzero values, since the other columns only contribute the
+    (precomputed) weighted row sums of the rows it is compared against.
+    """
+    mat = csr_matrix(mat, dtype=float)
+    num_rows, num_cols = mat.shape
+    if weights is None:
+        weights = ones(num_cols)
+
+    row_sums = mat.dot(weights)
+    csc = mat.tocsc()
+    result = zeros((num_rows, num_rows))
+
+    start = 0
+    while start < num_rows:
+        num_other_rows = num_rows - start
+        end = start + 1
+        cols = unique(_row_columns(mat, start))
+
+        # Grow the block while the comparison fits in memory.
+        while end < num_rows:
+            next_cols = union1d(cols, _row_columns(mat, end))
+            if (end + 1 - start) * num_other_rows * len(next_cols) > \
+                    MAX_BLOCK_ELEMENTS:
+                break
+            end += 1
+            cols = next_cols
+
+        block = mat[start:end][:, cols].toarray()
+        others = csc[:, cols][start:].toarray()
+        col_weights = weights[cols]
+
+        # Columns outside of cols are zero in the block, so they contribute
+        # the remainder of each other row's weighted sum.
+        diffs = abs(block[:, newaxis, :] - others[newaxis, :, :])
+        dists = diffs.dot(col_weights)
+        dists += row_sums[start:] - others.dot(col_weights)
+
+        result[start:end, start:] = dists
+        result[start:, start:end] = dists.T
+        start = end
+
+    result[range(num_rows), range(num_rows)] = 0
+    return result
+
+def _row_columns(mat, row):
+    """Returns the columns with stored values in a row of a CSR matrix."""
+    return mat.indices[mat.indptr[row]:mat.indptr[row + 1]]
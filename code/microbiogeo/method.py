@@ -29,9 +29,21 @@ class AbstractStatMethod(object):
     DisplayName = None
     StatDisplayName = None
 
+    # p-value strings written when a method is run with zero permutations
+    # (i.e. only the effect size is computed).
+    EffectSizeOnlyPValues = ['N/A',
+                             'Too few iters to compute p-value (num_iters=0)']
+
     def parse(self, results_f):
         raise NotImplementedError
 
+    def is_effect_size_only(self, p_value_str):
+        """Returns True if the p-value string indicates zero permutations.
+
+        The parsers return None as the p-value for these results.
+        """
+        return p_value_str in self.EffectSizeOnlyPValues
+
     def parse_float(self, float_str, min_val=None, max_val=None,
                     suppress_nan_check=False):
         """Converts a float (as a string) into a float.
@@ -75,7 +87,9 @@ class QiimeStatMethod(AbstractStatMethod):
         es, p_value = tokens[1:3]
         es = self.parse_float(es)
 
-        if 'Too few iters to compute p-value' in p_value:
+        if self.is_effect_size_only(p_value):
+            p_value = None
+        elif 'Too few iters to compute p-value' in p_value:
             raise UnparsableLineError(line)
         else:
             p_value = self.parse_float(p_value, 0, 1)
@@ -233,7 +247,11 @@ class Mantel(AbstractStatMethod):
 
         es, p_value = tokens[3:5]
         es = self.parse_float(es, -1, 1, suppress_nan_check=True)
-        p_value = self.parse_float(p_value, 0, 1)
+
+        if self.is_effect_size_only(p_value):
+            p_value = None
+        else:
+            p_value = self.parse_float(p_value, 0, 1)
 
         if isnan(es):
             es = 0.0
@@ -328,7 +346,9 @@ class OrdinationCorrelation(AbstractStatMethod):
 
         es = self.parse_float(es, -1, 1)
 
-        if 'Too few iters to compute p-value' in p_value or p_value == 'N/A':
+        if self.is_effect_size_only(p_value):
+            p_value = None
+        elif 'Too few iters to compute p-value' in p_value:
             raise UnparsableLineError(line)
         else:
             p_value = self.parse_float(p_value, 0, 1)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module for principal coordinates analysis (PCoA)."""
+
+from numpy import argsort, asarray, newaxis, sqrt, zeros
+from numpy.linalg import eigh
+from numpy.random import RandomState
+from scipy.sparse.linalg import eigsh
+
+# Number of axes written to pc.txt by default. Only the first two axes are
+# plotted, and ordination correlation uses the first axis.
+DEFAULT_NUM_AXES = 3
+
+# Smallest matrix where a Lanczos solver is used. Smaller matrices are
+# decomposed fully, which is faster at this size.
+MIN_LANCZOS_SAMPLES = 100
+
+def pcoa(dm_data, num_axes=DEFAULT_NUM_AXES):
+    """Performs PCoA on a distance matrix, computing only the leading axes.
+
+    The matrix is Gower-centered once, and only the num_axes largest
+    eigenvalues and their eigenvectors are computed (using ARPACK's Lanczos
+    solver for larger matrices). Coordinates are the same as those computed
+    by QIIME's principal_coordinates.py for the same axes (up to the sign of
+    each axis).
+
+    The percent variation explained by each axis is computed relative to the
+    trace of the centered matrix (i.e. the sum of all eigenvalues), so the
+    remaining eigenvalues are never needed. principal_coordinates.py divides
+    by the sum of the absolute eigenvalues instead, so the percentages differ
+    slightly if the distance matrix has negative eigenvalues.
+
+    Returns a tuple containing the coordinates (samples x axes), the
+    eigenvalues, and the percent variation explained by each axis. Axes are
+    sorted by decreasing eigenvalue.
+    """
+    dm_data = asarray(dm_data, dtype=float)
+    num_samps = len(dm_data)
+
+    if num_axes < 1:
+        raise ValueError("Must compute at least one axis.")
+    num_axes = min(num_axes, num_samps)
+
+    # Gower centering (the matrix is symmetric, so row and column means are
+    # the same).
+    centered = (dm_data * dm_data) / -2.0
+    means = centered.mean(axis=1)
+    centered -= means[:, newaxis]
+    centered -= means
+    centered += means.mean()
+
+    if num_samps >= MIN_LANCZOS_SAMPLES and num_axes < num_samps - 1:
+        # Use a fixed starting vector so that results are reproducible.
+        v0 = RandomState(0).uniform(size=num_samps)
+        eigvals, eigvecs = eigsh(centered, k=num_axes, which='LA', v0=v0)
+    else:
+        eigvals, eigvecs = eigh(centered)
+
+    order = argsort(eigvals)[::-1][:num_axes]
+    eigvals = eigvals[order]
+    coords = eigvecs[:, order] * sqrt(abs(eigvals))
+
+    trace = centered.trace()
+    if trace == 0:
+        pct_var = zeros(num_axes)
+    else:
+        pct_var = eigvals / trace * 100
+    return coords, eigvals, pct_var
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module with a native implementation of rarefaction."""
+
+from numpy import (arange, argsort, diff, flatnonzero, repeat, searchsorted,
+                   zeros_like)
+from scipy.sparse import csr_matrix
+
+from microbiogeo.distance import table_to_csr
+from microbiogeo.util import get_random_state
+
+def rarefy_tables(table, depths, random_state=None):
+    """Rarefies a table to several depths in a single pass.
+
+    This is a vectorized version of QIIME's single_rarefaction.py, which
+    reparses the table for every depth. The table is only converted into a
+    sparse matrix once, and each depth's subsample is drawn from it without
+    replacement for all samples at once.
+
+    A sample's subsample is drawn from the multivariate hypergeometric
+    distribution one OTU at a time: the number of sequences drawn from an OTU
+    is hypergeometric, given the sequences left to draw and the sequences in
+    the sample's remaining OTUs. Each step draws an OTU from every sample
+    with a single vectorized call, so there are only as many steps as the
+    largest number of OTUs in a sample.
+
+    random_state can be a numpy RandomState, seed, or None (see
+    microbiogeo.util.get_random_state), or a list of these (one for each
+    depth, so that each depth is rarefied from its own random stream).
+
+    Returns a list containing a (sample_ids, otu_ids, counts) tuple for each
+    depth, where counts is a scipy CSR matrix (samples x OTUs). As with
+    single_rarefaction.py, samples with fewer sequences than the depth are
+    removed, as are OTUs that aren't in any of the remaining samples.
+    """
+    if isinstance(random_state, list):
+        random_states = map(get_random_state, random_state)
+    else:
+        random_states = [get_random_state(random_state)] * len(depths)
+
+    samp_ids, otu_ids, counts = table_to_csr(table)
+    counts.sort_indices()
+    data = counts.data.astype(int)
+    num_samps = len(samp_ids)
+    totals = counts.sum(axis=1).A.ravel().astype(int)
+
+    # Each nonzero count's sample and position in its sample's row. Counts
+    # are grouped by position so that each step covers every sample.
+    row_lens = diff(counts.indptr)
+    entry_rows = repeat(arange(num_samps), row_lens)
+    entry_pos = arange(counts.nnz) - repeat(counts.indptr[:-1], row_lens)
+    by_pos = argsort(entry_pos, kind='mergesort')
+    max_row_len = row_lens.max() if num_samps > 0 else 0
+    pos_bounds = searchsorted(entry_pos[by_pos], arange(max_row_len + 1))
+
+    tables = []
+    for depth, random_state in zip(depths, random_states):
+        if depth < 1:
+            raise ValueError("Must specify a depth of at least one sequence "
+                             "(was provided %d)." % depth)
+
+        keep = totals >= depth
+        remaining_seqs = totals.copy()
+        remaining_depth = keep * depth
+        drawn = zeros_like(data)
+
+        for pos in range(max_row_len):
+            entries = by_pos[pos_bounds[pos]:pos_bounds[pos + 1]]
+            rows = entry_rows[entries]
+
+            # Samples that already have enough sequences are done.
+            active = remaining_depth[rows] > 0
+            if not active.any():
+                break
+            entries = entries[active]
+            rows = rows[active]
+
+            good = data[entries]
+            draws = random_state.hypergeometric(good,
+                                                remaining_seqs[rows] - good,
+                                                remaining_depth[rows])
+            drawn[entries] = draws
+            remaining_seqs[rows] -= good
+            remaining_depth[rows] -= draws
+
+        keep_idxs = flatnonzero(keep)
+        rare_counts = csr_matrix((drawn, counts.indices, counts.indptr),
+                                 shape=counts.shape)[keep_idxs]
+        rare_counts.eliminate_zeros()
+        keep_otu_idxs = flatnonzero(rare_counts.getnnz(axis=0))
+        rare_counts = rare_counts[:, keep_otu_idxs].tocsr()
+
+        tables.append(([samp_ids[idx] for idx in keep_idxs],
+                       [otu_ids[idx] for idx in keep_otu_idxs], rare_counts))
+    return tables
@@ -14,73 +14,159 @@ __email__ = "jai.rideout@gmail.com"
 from collections import defaultdict
 from os import listdir
 from os.path import basename, exists, join, splitext
-from random import randint, sample
 
 from biom.parse import parse_biom_table
+from biom.table import Table
 
 from matplotlib.lines import Line2D
 from matplotlib.patches import Rectangle
 from matplotlib.pyplot import figure
 from matplotlib.ticker import FormatStrFormatter
 
-from numpy import ceil, inf, mean, std
+from numpy import (array, asarray, ceil, concatenate, inf, mean, std,
+                   unique)
 
-from qiime.filter import (filter_mapping_file_from_mapping_f,
-                          filter_samples_from_otu_table)
+from scipy.sparse import csr_matrix
+
+from qiime.filter import filter_samples_from_otu_table
+from qiime.format import format_mapping_file
 from qiime.parse import (parse_mapping_file_to_dict, parse_mapping_file,
                          parse_coords, group_by_field)
-from qiime.util import add_filename_suffix, create_dir, MetadataMap
+from qiime.sort import natsort
+from qiime.util import add_filename_suffix, create_dir
+
+from microbiogeo.distance import table_to_csr
 
 from microbiogeo.method import (AbstractStatMethod, Adonis, Anosim, Best,
                                 Dbrda, Mantel, MantelCorrelogram, MoransI,
                                 Mrpp, PartialMantel, Permanova, Permdisp,
                                 QiimeStatMethod, UnparsableFileError,
                                 UnparsableLineError)
+from microbiogeo.tree import TreeNeighborhoodIndex
 from microbiogeo.util import (get_color_pool,
                               get_num_samples_in_distance_matrix,
                               get_num_samples_in_map, get_num_samples_in_table,
-                              get_panel_label, get_simsam_rep_num, has_results,
-                              run_command, run_parallel_jobs)
+                              get_panel_label, get_random_state,
+                              get_simsam_rep_num, has_results, run_command,
+                              run_parallel_jobs, sample_items)
 
 class InvalidSubsetSize(Exception):
     pass
 
-def choose_cluster_subsets(otu_table_f, map_f, category, num_total_samples):
-    otu_table = parse_biom_table(otu_table_f)
-    metadata_map = MetadataMap.parseMetadataMap(map_f)
+def choose_cluster_subsets(otu_table_f, map_f, category, num_total_samples,
+                           random_state=None):
+    return choose_data_subsets('cluster', otu_table_f, map_f,
+                               [(category, num_total_samples)],
+                               random_state=random_state)[0]
+
+def choose_data_subsets(analysis_type, otu_table_f, map_f, subsets,
+                        materialize=True, random_state=None,
+                        num_replicates=None):
+    """Chooses several subsets of samples from a table and mapping file.
+
+    This is the same as calling choose_cluster_subsets or
+    choose_gradient_subset (depending on analysis_type) once for each
+    (category, num_total_samples) pair in subsets, but the table and mapping
+    file are only parsed once. otu_table_f can also be a table that has
+    already been parsed.
+
+    random_state can be a numpy RandomState, seed, or None (see
+    microbiogeo.util.get_random_state), or a list of these (one for each
+    subset, so that each subset is chosen from its own random stream).
+
+    Returns a list containing a (subset table, subset mapping file string)
+    tuple for each subset. If materialize is False, the subset tables and
+    mapping files aren't created, and a list of each subset's sample IDs (in
+    the same order as the table) is returned instead.
+
+    If num_replicates is provided, the subsets are chosen from num_replicates
+    replicates of each sample (named as simulate_tables names them, see
+    get_replicate_samp_ids) instead of from the samples themselves. The
+    replicates don't need to exist yet, so only their sample IDs can be
+    returned (materialize must be False).
+    """
+    if analysis_type == 'cluster':
+        choose_fn = _choose_cluster_samp_ids
+    elif analysis_type == 'gradient':
+        choose_fn = _choose_gradient_samp_ids
+    else:
+        raise ValueError("Unrecognized simulated data type '%s'." %
+                         analysis_type)
+
+    if isinstance(otu_table_f, Table):
+        otu_table = otu_table_f
+    else:
+        otu_table = parse_biom_table(otu_table_f)
+    map_lines = list(map_f)
+    mdm, _ = parse_mapping_file_to_dict(map_lines)
+    map_data, map_header, _ = parse_mapping_file(map_lines)
+
+    samp_ids = list(otu_table.SampleIds)
+    if num_replicates is not None:
+        if materialize:
+            raise ValueError("Subsets of sample replicates can't be "
+                             "materialized before the replicates have been "
+                             "simulated.")
+        # Each replicate has the same metadata as its sample.
+        mdm = dict([(rep_samp_id, mdm[samp_id]) for samp_id in samp_ids
+                    if samp_id in mdm for rep_samp_id in
+                    get_replicate_samp_ids([samp_id], num_replicates)])
+        samp_ids = get_replicate_samp_ids(samp_ids, num_replicates)
+
+    if isinstance(random_state, list):
+        random_states = map(get_random_state, random_state)
+    else:
+        random_states = [get_random_state(random_state)] * len(subsets)
 
-    # Dirty... :(
-    try:
-        map_f.seek(0)
-    except AttributeError:
-        pass
+    results = []
+    for (category, num_total_samples), subset_random_state in zip(
+            subsets, random_states):
+        samp_ids_to_keep = choose_fn(samp_ids, mdm, category,
+                                     num_total_samples, subset_random_state)
+
+        assert len(samp_ids_to_keep) == num_total_samples, \
+               "%d != %d" % (len(samp_ids_to_keep), num_total_samples)
+        assert len(samp_ids_to_keep) == len(set(samp_ids_to_keep)), \
+               "Duplicate sample IDs in subset"
+
+        samp_ids_to_keep = set(samp_ids_to_keep)
+        if not materialize:
+            results.append([samp_id for samp_id in samp_ids
+                            if samp_id in samp_ids_to_keep])
+            continue
+
+        results.append((filter_samples_from_otu_table(otu_table,
+                                                      samp_ids_to_keep, 0,
+                                                      inf),
+                        format_mapping_file(map_header,
+                                            [row for row in map_data
+                                             if row[0] in samp_ids_to_keep])))
+    return results
 
-    if num_total_samples > len(otu_table.SampleIds):
+def _choose_cluster_samp_ids(samp_ids, mdm, category, num_total_samples,
+                             random_state):
+    if num_total_samples > len(samp_ids):
         raise InvalidSubsetSize("Too many total samples (%d) were specified "
                                 "as a subset size. There are only %d total "
                                 "samples to choose a subset from." %
-                                (num_total_samples, len(otu_table.SampleIds)))
+                                (num_total_samples, len(samp_ids)))
 
+    table_samp_ids = set(samp_ids)
     category_map = defaultdict(list)
-    for samp_id in metadata_map.SampleIds:
+    for samp_id in sorted(mdm):
         # Mapping files can have more samples than OTU tables.
-        if samp_id in otu_table.SampleIds:
-            category_val = metadata_map.getCategoryValue(samp_id, category)
-            category_map[category_val].append(samp_id)
+        if samp_id in table_samp_ids:
+            category_map[mdm[samp_id][category]].append(samp_id)
 
     samp_ids_to_keep, extra_samps = _choose_items_from_clusters(
-            category_map, otu_table.SampleIds, num_total_samples)
+            category_map, samp_ids, num_total_samples, random_state)
     samp_ids_to_keep.extend(extra_samps)
+    return samp_ids_to_keep
 
-    assert len(samp_ids_to_keep) == num_total_samples, \
-           "%d != %d" % (len(samp_ids_to_keep), num_total_samples)
-    assert len(samp_ids_to_keep) == len(set(samp_ids_to_keep)), \
-           "Duplicate sample IDs in subset"
-
-    return (filter_samples_from_otu_table(otu_table, samp_ids_to_keep, 0, inf),
-            filter_mapping_file_from_mapping_f(map_f, samp_ids_to_keep))
+def _choose_items_from_clusters(category_map, all_samp_ids, num_total_samples,
+                                random_state=None):
+    random_state = get_random_state(random_state)
 
-def _choose_items_from_clusters(category_map, all_samp_ids, num_total_samples):
     # How many clusters we have.
     num_cat_states = len(category_map)
 
@@ -90,8 +176,8 @@ def _choose_items_from_clusters(category_map, all_samp_ids, num_total_samples):
     # Sort category states to facilitate unit testing.
     samp_ids_to_keep = []
     for category_val, samp_ids in sorted(category_map.items()):
-        samp_ids_to_keep.extend(
-                sample(samp_ids, min(cluster_subset_size, len(samp_ids))))
+        samp_ids_to_keep.extend(sample_items(samp_ids,
+                min(cluster_subset_size, len(samp_ids)), random_state))
 
     remaining_samp_ids = set(all_samp_ids) - set(samp_ids_to_keep)
 
@@ -100,52 +186,149 @@ def _choose_items_from_clusters(category_map, all_samp_ids, num_total_samples):
     # num_total_samples quota.
     num_remaining_samps = num_total_samples - len(samp_ids_to_keep)
 
-    return samp_ids_to_keep, sample(remaining_samp_ids, num_remaining_samps)
+    return samp_ids_to_keep, sample_items(remaining_samp_ids,
+                                          num_remaining_samps, random_state)
 
-def choose_gradient_subset(otu_table_f, map_f, category, num_total_samples):
-    otu_table = parse_biom_table(otu_table_f)
-    mdm, _ = parse_mapping_file_to_dict(map_f)
+def choose_gradient_subset(otu_table_f, map_f, category, num_total_samples,
+                           random_state=None):
+    return choose_data_subsets('gradient', otu_table_f, map_f,
+                               [(category, num_total_samples)],
+                               random_state=random_state)[0]
 
-    try:
-        map_f.seek(0)
-    except AttributeError:
-        pass
-
-    if num_total_samples > len(otu_table.SampleIds):
+def _choose_gradient_samp_ids(samp_ids, mdm, category, num_total_samples,
+                              random_state):
+    if num_total_samples > len(samp_ids):
         raise InvalidSubsetSize("Too many total samples (%d) were specified "
                                 "as a gradient subset size. There are only %d "
                                 "total samples to choose a subset from." %
-                                (num_total_samples, len(otu_table.SampleIds)))
+                                (num_total_samples, len(samp_ids)))
 
     # Only keep the sample IDs that are in both the mapping file and OTU table.
     # Sort the samples according to the gradient category.
+    table_samp_ids = set(samp_ids)
     samp_ids = [(samp_id, float(metadata[category]))
-                for samp_id, metadata in mdm.items()
-                if samp_id in otu_table.SampleIds]
+                for samp_id, metadata in sorted(mdm.items())
+                if samp_id in table_samp_ids]
     samp_ids.sort(key=lambda samp_id: samp_id[1])
 
-    samp_ids_to_keep = [samp_id[0] for samp_id in
-                        _choose_items_from_bins(samp_ids, num_total_samples)]
-
-    assert len(samp_ids_to_keep) == num_total_samples, \
-           "%d != %d" % (len(samp_ids_to_keep), num_total_samples)
-    assert len(samp_ids_to_keep) == len(set(samp_ids_to_keep)), \
-           "Duplicate sample IDs in subset"
+    return [samp_id[0] for samp_id in
+            _choose_items_from_bins(samp_ids, num_total_samples,
+                                    random_state)]
 
-    return (filter_samples_from_otu_table(otu_table, samp_ids_to_keep, 0, inf),
-            filter_mapping_file_from_mapping_f(map_f, samp_ids_to_keep))
-
-def _choose_items_from_bins(sequence, num_items):
+def _choose_items_from_bins(sequence, num_items, random_state=None):
     # Adapted from http://stackoverflow.com/a/9873935
+    random_state = get_random_state(random_state)
     items = []
 
     for i in range(num_items):
         start = int(ceil(i * float(len(sequence)) / num_items))
         end = int(ceil((i + 1) * float(len(sequence)) / num_items)) - 1
-        items.append(sequence[randint(start, end)])
+        items.append(sequence[random_state.randint(start, end + 1)])
 
     return items
 
+def get_replicate_samp_ids(samp_ids, num_replicates):
+    """Returns the sample IDs of num_replicates replicates of each sample.
+
+    Replicate j of sample S is named S.j (the same as simsam.py), and the
+    replicates of each sample are kept together.
+    """
+    return ['%s.%d' % (samp_id, rep_num) for samp_id in samp_ids
+            for rep_num in range(num_replicates)]
+
+def simulate_tables(table, tree, num_replicates, dissims, random_state=None,
+                    samp_idxs=None, rep_idxs=None):
+    """Simulates tables at several dissimilarities in a single pass.
+
+    This is a vectorized version of QIIME's simsam.py (see
+    qiime.simsam.sim_otu_table), which reparses the table and tree and walks
+    the tree for every dissimilarity. Each sample is replicated
+    num_replicates times (replicate j of sample S is named S.j), and in each
+    replicate, each OTU's count is moved to a tip chosen uniformly at random
+    from the descendants of the OTU's highest ancestor that is less than the
+    dissimilarity up the tree.
+
+    tree can be a FlatTree containing all of the OTUs in table, or a
+    TreeNeighborhoodIndex that was built for (at least) the OTUs in table.
+    The index gives the range of tips that each OTU can be moved to at each
+    dissimilarity, so the random tips are drawn directly from those ranges.
+
+    random_state can be a numpy RandomState, seed, or None (see
+    microbiogeo.util.get_random_state), or a list of these (one for each
+    dissimilarity, so that each dissimilarity is simulated from its own
+    random stream). If samp_idxs is provided, only those samples (indices into
+    table, e.g. a subset from a subset index) are simulated, as if the table
+    had been filtered to them first. If rep_idxs is provided, only those
+    replicates are simulated (indices into get_replicate_samp_ids, i.e.
+    replicate j of sample i is index i * num_replicates + j), which avoids
+    simulating replicates that would be thrown away when choosing a subset of
+    them.
+
+    Returns a list containing a (sample_ids, otu_ids, counts) tuple for each
+    dissimilarity, where counts is a scipy CSR matrix (samples x OTUs) and
+    otu_ids are naturally sorted (the same order as simsam.py).
+    """
+    if num_replicates < 1:
+        raise ValueError("Must specify at least one sample replicate (was "
+                         "provided %d)." % num_replicates)
+    if isinstance(random_state, list):
+        random_states = map(get_random_state, random_state)
+    else:
+        random_states = [get_random_state(random_state)] * len(dissims)
+
+    samp_ids, otu_ids, counts = table_to_csr(table)
+    if samp_idxs is not None:
+        samp_ids = [samp_ids[idx] for idx in samp_idxs]
+        counts = counts[samp_idxs]
+
+        # Row indexing doesn't keep the OTUs in order, which would change
+        # the order of the random draws from that of a filtered table.
+        counts.sort_indices()
+
+    if isinstance(tree, TreeNeighborhoodIndex):
+        index = tree
+    else:
+        index = TreeNeighborhoodIndex.fromTree(tree, otu_ids)
+
+    rep_samp_ids = get_replicate_samp_ids(samp_ids, num_replicates)
+    if rep_idxs is None:
+        num_draws = num_replicates
+    else:
+        # Each replicate is simulated from its own copy of its sample's
+        # counts, so one draw per copy simulates all of them.
+        rep_samp_ids = [rep_samp_ids[idx] for idx in rep_idxs]
+        counts = counts[asarray(rep_idxs) // num_replicates]
+        counts.sort_indices()
+        num_draws = 1
+    counts = counts.tocoo()
+
+    tables = []
+    for dissim, random_state in zip(dissims, random_states):
+        first_tips, num_tips = index.getNeighborhood(dissim, otu_ids)
+
+        rows = []
+        new_tips = []
+        for rep_num in range(num_draws):
+            draws = (random_state.random_sample(counts.nnz) *
+                     num_tips[counts.col]).astype(int)
+            draws = draws.clip(max=num_tips[counts.col] - 1)
+            rows.append(counts.row * num_draws + rep_num)
+            new_tips.append(first_tips[counts.col] + draws)
+
+        new_tips, cols = unique(concatenate(new_tips), return_inverse=True)
+        new_otu_ids = [str(index.tip_names[tip]) for tip in new_tips]
+        sorted_otu_ids = natsort(new_otu_ids)
+        sorted_idxs = dict([(otu_id, idx)
+                            for idx, otu_id in enumerate(sorted_otu_ids)])
+        cols = array([sorted_idxs[otu_id] for otu_id in new_otu_ids])[cols]
+
+        sim_counts = csr_matrix((concatenate([counts.data] * num_draws),
+                                 (concatenate(rows), cols)),
+                                shape=(len(rep_samp_ids),
+                                       len(sorted_otu_ids)))
+        tables.append((rep_samp_ids, sorted_otu_ids, sim_counts))
+    return tables
+
 def create_simulated_data_plots(analysis_type, in_dir, workflow):
     """Create plots of sample size vs effect size/p-val for each dissim.
     
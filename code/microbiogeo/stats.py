@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module with native implementations of permutation-based methods."""
+
+from functools import partial
+from multiprocessing import Pool
+
+from cogent.maths.stats.distribution import z_high
+from cogent.maths.stats.special import igam, igamc
+from numpy import (argsort, asarray, bincount, concatenate, diff, empty,
+                   finfo, flatnonzero, isnan, maximum, minimum, nan, newaxis,
+                   ones, repeat, sqrt, tril_indices, unique, vstack, zeros)
+from numpy.random import permutation, randint, RandomState
+
+TAIL_TYPES = ['two sided', 'greater', 'less']
+CATEGORY_METHODS = ['anosim', 'permanova']
+
+# Tolerance used when comparing permuted statistics to the original statistic,
+# so that permutations that are equivalent to the original data are counted
+# even if the statistics differ by floating point error (as in vegan).
+EPS = sqrt(finfo(float).eps)
+
+# Below this skewness, the Pearson type III approximation is replaced by the
+# normal distribution.
+MIN_SKEWNESS = 1e-4
+
+# Number of permutations in each independent random substream (see
+# _run_substreams). This must not change, or seeded results will change.
+SUBSTREAM_SIZE = 100
+
+# Written at the top of results files whose p-values were approximated.
+APPROXIMATION_NOTE = ('# p-value computed using a Pearson type III '
+                      'approximation of the permutation distribution (no '
+                      'permutations were performed)')
+
+def mantel_multi(dm, grad_dms, num_perms=999, tail_type='two sided',
+                 random_fn=permutation, block_size=100, approximate=False,
+                 seed=None, num_jobs=1):
+    """Runs a Mantel test of one distance matrix against several others.
+
+    This is equivalent to running a separate Mantel test of dm against each
+    matrix in grad_dms, except that each permutation of dm is only computed
+    once and is correlated against all of the other matrices at the same time.
+
+    All matrices must be symmetric and hollow, and must have their samples in
+    the same order. Only the lower triangle of each matrix is used. Matrices
+    can also be condensed (as from scipy.spatial.distance.squareform), in
+    which case they are never expanded to square form.
+
+    If approximate is True, no permutations are performed. Instead, p-values
+    are computed from a Pearson type III distribution fit to the exact mean,
+    variance, and skewness of the permutation distribution (num_perms is
+    ignored).
+
+    If seed is provided or num_jobs is greater than one, the permutations are
+    split into independent random substreams (see _run_substreams) instead of
+    using random_fn, and the substreams are run using num_jobs processes. The
+    p-values only depend on seed, not on num_jobs.
+
+    Returns a list of (r statistic, p-value) tuples, one for each matrix in
+    grad_dms (in the same order). The p-value will be None if num_perms is
+    zero (and approximate is False).
+    """
+    if tail_type not in TAIL_TYPES:
+        raise ValueError("Invalid tail type '%s'. Must be one of %r." %
+                         (tail_type, TAIL_TYPES))
+    _validate_parallel_input(num_perms, num_jobs)
+
+    dm = asarray(dm, dtype=float)
+    size = _get_num_samples(dm)
+    grad_dms = [asarray(grad_dm, dtype=float) for grad_dm in grad_dms]
+    for grad_dm in grad_dms:
+        if _get_num_samples(grad_dm) != size:
+            raise ValueError("All distance matrices must be the same size.")
+
+    rows, cols = tril_indices(size, -1)
+
+    # The off-diagonal values of a permuted matrix are a rearrangement of the
+    # original values, so the mean and norm only need to be computed once.
+    x = _get_distances(dm, rows, cols)
+    x_mean = x.mean()
+    x_norm = sqrt(((x - x_mean) ** 2).sum())
+    dm_centered = dm - x_mean
+
+    grads = vstack([_standardize(_get_distances(grad_dm, rows, cols))
+                    for grad_dm in grad_dms])
+    orig_stats = _correlate(grads, x - x_mean, x_norm)
+
+    if approximate:
+        return _approximate_mantel(x - x_mean, grads, orig_stats, size,
+                                   tail_type)
+
+    count_fn = partial(_count_mantel_better, dm_centered, grads, x_norm,
+                       orig_stats, tail_type, block_size)
+
+    if seed is None and num_jobs == 1:
+        better = count_fn(num_perms, random_fn)
+    else:
+        better = _run_substreams(count_fn, num_perms, seed, num_jobs)
+
+    return _format_results(orig_stats, better, num_perms)
+
+def _count_mantel_better(dm_centered, grads, x_norm, orig_stats, tail_type,
+                         block_size, num_perms, random_fn):
+    """Counts permutations of dm_centered that are at least as extreme.
+
+    Returns an array with a count for each gradient.
+    """
+    size = _get_num_samples(dm_centered)
+    rows, cols = tril_indices(size, -1)
+
+    better = zeros(len(orig_stats), dtype=int)
+    perms_done = 0
+    while perms_done < num_perms:
+        curr_block_size = min(block_size, num_perms - perms_done)
+
+        perm_vecs = []
+        for i in range(curr_block_size):
+            perm_order = random_fn(size)
+            perm_vecs.append(_get_distances(dm_centered, perm_order[rows],
+                                            perm_order[cols]))
+        perm_stats = _correlate(grads, vstack(perm_vecs).T, x_norm)
+
+        for grad_idx, orig_stat in enumerate(orig_stats):
+            better[grad_idx] += _count_better(perm_stats[grad_idx], orig_stat,
+                                              tail_type)
+        perms_done += curr_block_size
+    return better
+
+def _format_results(orig_stats, better, num_perms):
+    """Returns a list of (statistic, p-value) tuples."""
+    results = []
+    for orig_stat, num_better in zip(orig_stats, better):
+        if num_perms > 0:
+            p_value = (num_better + 1) / (num_perms + 1)
+        else:
+            p_value = None
+        results.append((orig_stat, p_value))
+    return results
+
+def _validate_parallel_input(num_perms, num_jobs):
+    if num_perms < 0:
+        raise ValueError("Invalid number of permutations: %d. Must be greater "
+                         "than or equal to zero." % num_perms)
+    if num_jobs < 1:
+        raise ValueError("Invalid number of jobs: %d. Must be greater than "
+                         "zero." % num_jobs)
+
+def _run_substreams(count_fn, num_perms, seed=None, num_jobs=1):
+    """Runs permutations in independent random substreams.
+
+    The permutations are split into chunks of SUBSTREAM_SIZE permutations,
+    and each chunk draws its permutations from its own random number
+    generator (seeded with seed and the chunk index). The chunks are run using
+    num_jobs processes and their counts are summed, so the result does not
+    depend on num_jobs. If seed is None, one is drawn from numpy's global
+    random number generator.
+
+    count_fn must accept the number of permutations to perform and a function
+    that permutes its input (like numpy.random.permutation), and must return
+    an array of counts. It must be picklable if num_jobs is greater than one.
+    """
+    if seed is None:
+        seed = randint(0, 2 ** 31 - 1)
+
+    chunks = []
+    for chunk_idx, start in enumerate(range(0, num_perms, SUBSTREAM_SIZE)):
+        chunks.append((chunk_idx, min(SUBSTREAM_SIZE, num_perms - start)))
+
+    if not chunks:
+        return count_fn(0, None)
+
+    chunk_fn = partial(_run_substream, count_fn, seed)
+
+    if num_jobs > 1 and len(chunks) > 1:
+        pool = Pool(min(num_jobs, len(chunks)))
+        try:
+            counts = pool.map(chunk_fn, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = map(chunk_fn, chunks)
+
+    return sum(counts[1:], counts[0])
+
+def _run_substream(count_fn, seed, chunk):
+    chunk_idx, num_perms = chunk
+    return count_fn(num_perms, RandomState([seed, chunk_idx]).permutation)
+
+def _approximate_mantel(x, grads, orig_stats, size, tail_type):
+    """Computes Mantel p-values using the Pearson type III approximation.
+
+    x is the centered lower triangle of the permuted distance matrix, and
+    grads contains the standardized lower triangles of the other matrices.
+    """
+    x_square = _to_square(x, size)
+    x_sums = {}
+
+    results = []
+    for grad, orig_stat in zip(grads, orig_stats):
+        if isnan(orig_stat):
+            results.append((orig_stat, 1.0))
+            continue
+
+        # The Mantel r statistic is an increasing linear function of the QAP
+        # statistic of the centered matrices.
+        grad_square = _to_square(grad, size)
+        mean, var, skew = _qap_moments(x_square, grad_square, x_sums)
+        orig_qap_stat = (x_square * grad_square).sum()
+
+        if var <= 0:
+            p_value = 1.0
+        else:
+            z = (orig_qap_stat - mean) / sqrt(var)
+
+            if tail_type == 'two sided':
+                p_value = min(1.0, _pearson3_upper_tail(abs(z), skew) +
+                                   _pearson3_upper_tail(abs(z), -skew))
+            elif tail_type == 'greater':
+                p_value = _pearson3_upper_tail(z, skew)
+            else:
+                p_value = _pearson3_upper_tail(-z, -skew)
+        results.append((orig_stat, p_value))
+    return results
+
+def _standardize(vec):
+    """Centers vec and scales it to unit norm (if it has nonzero norm)."""
+    vec = vec - vec.mean()
+    norm = sqrt((vec ** 2).sum())
+
+    if norm == 0:
+        vec.fill(nan)
+    else:
+        vec /= norm
+    return vec
+
+def _correlate(standardized_vecs, centered_vecs, norm):
+    """Computes Pearson correlations between two sets of vectors.
+
+    standardized_vecs should be a 2D array (one vector per row) produced by
+    _standardize, and centered_vecs should be a 1D array or a 2D array (one
+    vector per column) of centered vectors that all share the same norm.
+    """
+    if norm == 0:
+        return standardized_vecs.dot(centered_vecs) * nan
+    return standardized_vecs.dot(centered_vecs) / norm
+
+def _count_better(perm_stats, orig_stat, tail_type):
+    """Returns number of permuted stats at least as extreme as orig_stat."""
+    perm_stats = asarray(perm_stats)
+
+    if tail_type == 'two sided':
+        return (abs(perm_stats) >= abs(orig_stat) - EPS).sum()
+    elif tail_type == 'greater':
+        return (perm_stats >= orig_stat - EPS).sum()
+    else:
+        return (perm_stats <= orig_stat + EPS).sum()
+
+def anosim_multi(dms, grouping, num_perms=999, random_fn=permutation,
+                 block_size=10, approximate=False, seed=None, num_jobs=1):
+    """Runs ANOSIM on several distance matrices that share the same grouping.
+
+    Each permutation of grouping is applied to all of the distance matrices at
+    the same time. This is equivalent to running ANOSIM (as implemented in
+    qiime.stats.Anosim) separately on each distance matrix.
+
+    dms should be a list of symmetric, hollow distance matrices (square or
+    condensed) with their samples in the same order, and grouping should be a list of category
+    values (one for each sample, in the same order as the distance matrices).
+
+    If approximate is True, p-values are computed using the same Pearson type
+    III approximation as mantel_multi instead of permutations. seed and
+    num_jobs have the same meaning as in mantel_multi.
+
+    Returns a list of (R statistic, p-value) tuples, one for each distance
+    matrix. The p-value will be None if num_perms is zero (and approximate is
+    False).
+    """
+    dms, grouping = _validate_category_input(dms, grouping, num_perms,
+                                             num_jobs)
+    size = len(grouping)
+    rows, cols = tril_indices(size, -1)
+
+    ranks = vstack([_rank(_get_distances(dm, rows, cols)) for dm in dms])
+    compute_stats = partial(_compute_anosim_stats, ranks)
+
+    if approximate:
+        return _approximate_anosim(ranks, grouping, compute_stats([grouping]),
+                                   size)
+
+    return _run_category_test(compute_stats, grouping, num_perms, random_fn,
+                              block_size, seed, num_jobs)
+
+def _compute_anosim_stats(ranks, groupings):
+    """Computes R statistics for each row of ranks and each grouping."""
+    size = len(groupings[0])
+    rows, cols = tril_indices(size, -1)
+    divisor = size * ((size - 1) / 4)
+
+    within = vstack([g[rows] == g[cols] for g in groupings]).T
+    r_w = ranks.dot(within) / within.sum(axis=0)
+    r_b = ranks.dot(~within) / (~within).sum(axis=0)
+    return (r_b - r_w) / divisor
+
+def permanova_multi(dms, grouping, num_perms=999, random_fn=permutation,
+                    block_size=10, seed=None, num_jobs=1):
+    """Runs PERMANOVA on several distance matrices that share a grouping.
+
+    Each permutation of grouping is applied to all of the distance matrices at
+    the same time. This is equivalent to running PERMANOVA (as implemented in
+    qiime.stats.Permanova) separately on each distance matrix.
+
+    Input and return values are the same as anosim_multi, except that the
+    pseudo-F statistic is returned instead of the R statistic (and
+    approximate p-values are not supported).
+    """
+    dms, grouping = _validate_category_input(dms, grouping, num_perms,
+                                             num_jobs)
+    size = len(grouping)
+    rows, cols = tril_indices(size, -1)
+
+    sq_dists = vstack([_get_distances(dm, rows, cols) ** 2 for dm in dms])
+    compute_stats = partial(_compute_permanova_stats, sq_dists,
+                            bincount(grouping))
+
+    return _run_category_test(compute_stats, grouping, num_perms, random_fn,
+                              block_size, seed, num_jobs)
+
+def _compute_permanova_stats(sq_dists, group_sizes, groupings):
+    """Computes pseudo-F statistics for each row of sq_dists and grouping."""
+    size = len(groupings[0])
+    rows, cols = tril_indices(size, -1)
+    num_groups = len(group_sizes)
+    s_T = sq_dists.sum(axis=1)[:, newaxis] / size
+
+    weights = vstack([(g[rows] == g[cols]) / group_sizes[g[rows]]
+                      for g in groupings]).T
+    s_W = sq_dists.dot(weights)
+    s_A = s_T - s_W
+    return (s_A / (num_groups - 1)) / (s_W / (size - num_groups))
+
+def _approximate_anosim(ranks, grouping, orig_stats, size):
+    """Computes ANOSIM p-values using the Pearson type III approximation."""
+    rows, cols = tril_indices(size, -1)
+    within = (grouping[rows] == grouping[cols]).astype(float)
+    within_square = _to_square(within - within.mean(), size)
+    within_sums = {}
+
+    results = []
+    for rank, orig_stat in zip(ranks, orig_stats[:, 0]):
+        # R is a decreasing linear function of the sum of the within-group
+        # ranks, which is a QAP statistic.
+        rank_square = _to_square(rank - rank.mean(), size)
+        mean, var, skew = _qap_moments(within_square, rank_square,
+                                       within_sums)
+        orig_qap_stat = (within_square * rank_square).sum()
+
+        if var <= 0:
+            p_value = 1.0
+        else:
+            z = (orig_qap_stat - mean) / sqrt(var)
+            p_value = _pearson3_upper_tail(-z, -skew)
+        results.append((orig_stat, p_value))
+    return results
+
+def _validate_category_input(dms, grouping, num_perms, num_jobs=1):
+    """Checks input to the categorical methods and encodes the grouping.
+
+    Returns the distance matrices as float arrays and the grouping as an
+    integer array of group indices.
+    """
+    _validate_parallel_input(num_perms, num_jobs)
+
+    dms = [asarray(dm, dtype=float) for dm in dms]
+    for dm in dms:
+        if _get_num_samples(dm) != len(grouping):
+            raise ValueError("All distance matrices must have one row and "
+                             "column for each sample in the grouping.")
+
+    _, grouping = unique(grouping, return_inverse=True)
+    num_groups = grouping.max() + 1 if len(grouping) > 0 else 0
+
+    if num_groups < 2:
+        raise ValueError("The grouping must contain at least two groups of "
+                         "samples.")
+    if num_groups == len(grouping):
+        raise ValueError("The grouping must contain at least one group with "
+                         "more than one sample.")
+
+    return dms, grouping
+
+def _run_category_test(compute_stats, grouping, num_perms, random_fn,
+                       block_size, seed=None, num_jobs=1):
+    """Computes test statistics and p-values by permuting the grouping.
+
+    compute_stats must accept a list of groupings and return a 2D array with
+    one row for each distance matrix and one column for each grouping. Larger
+    statistics are considered more extreme.
+
+    As in qiime.stats, each permutation is applied to the previously permuted
+    grouping, so the same random_fn (and seed) will produce the same p-values.
+    If seed is provided or num_jobs is greater than one, each substream
+    starts over from the original grouping (see _run_substreams).
+    """
+    orig_stats = compute_stats([grouping])[:, 0]
+    count_fn = partial(_count_category_better, compute_stats, grouping,
+                       orig_stats, block_size)
+
+    if seed is None and num_jobs == 1:
+        better = count_fn(num_perms, random_fn)
+    else:
+        better = _run_substreams(count_fn, num_perms, seed, num_jobs)
+
+    return _format_results(orig_stats, better, num_perms)
+
+def _count_category_better(compute_stats, grouping, orig_stats, block_size,
+                           num_perms, random_fn):
+    """Counts permuted groupings with statistics at least as large."""
+    better = zeros(len(orig_stats), dtype=int)
+
+    perm_grouping = grouping
+    perms_done = 0
+    while perms_done < num_perms:
+        curr_block_size = min(block_size, num_perms - perms_done)
+
+        perm_groupings = []
+        for i in range(curr_block_size):
+            perm_grouping = random_fn(perm_grouping)
+            perm_groupings.append(perm_grouping)
+        perm_stats = compute_stats(perm_groupings)
+
+        better += (perm_stats >= orig_stats[:, newaxis] - EPS).sum(axis=1)
+        perms_done += curr_block_size
+    return better
+
+def _get_num_samples(dm):
+    """Returns the number of samples in a square or condensed matrix."""
+    if dm.ndim == 1:
+        size = int(round((1 + sqrt(1 + 8 * len(dm))) / 2))
+        if size * (size - 1) // 2 != len(dm):
+            raise ValueError("A condensed distance matrix of length %d does "
+                             "not correspond to a square matrix." % len(dm))
+        return size
+    elif dm.ndim != 2 or dm.shape[0] != dm.shape[1]:
+        raise ValueError("Distance matrices must be square or condensed.")
+    return dm.shape[0]
+
+def _get_distances(dm, rows, cols):
+    """Returns the distances between the samples in rows and cols.
+
+    dm can be square or condensed (the upper triangle as a 1-D array). rows
+    and cols must not contain the same sample at the same position, as the
+    diagonal isn't stored in condensed matrices.
+    """
+    if dm.ndim == 1:
+        size = _get_num_samples(dm)
+        lo = minimum(rows, cols)
+        hi = maximum(rows, cols)
+        return dm[size * lo - lo * (lo + 1) // 2 + hi - lo - 1]
+    return dm[rows, cols]
+
+def _rank(values):
+    """Ranks values (starting at 1), assigning tied values their mean rank."""
+    values = asarray(values)
+    sorted_idxs = argsort(values, kind='mergesort')
+    sorted_vals = values[sorted_idxs]
+
+    # Find the start and end of each run of tied values, and give each value
+    # in a run the average of the (1-based) ranks spanned by the run.
+    run_starts = concatenate(([0], flatnonzero(diff(sorted_vals)) + 1))
+    run_ends = concatenate((run_starts[1:], [len(values)]))
+
+    ranks = empty(len(values))
+    ranks[sorted_idxs] = repeat((run_starts + run_ends + 1) / 2,
+                                run_ends - run_starts)
+    return ranks
+
+def _to_square(lower_tri, size):
+    """Converts a lower triangle (as from tril_indices) to a symmetric matrix.
+
+    The diagonal of the returned matrix will be zero.
+    """
+    rows, cols = tril_indices(size, -1)
+    result = zeros((size, size))
+    result[rows, cols] = lower_tri
+    result[cols, rows] = lower_tri
+    return result
+
+def _pearson3_upper_tail(z, skew):
+    """Returns P(T >= z) for a standardized Pearson type III variable T.
+
+    T has a mean of zero, a variance of one, and the specified skewness. The
+    distribution is a shifted/scaled gamma distribution, and approaches the
+    standard normal distribution as skew approaches zero.
+    """
+    if abs(skew) < MIN_SKEWNESS:
+        return z_high(z)
+
+    shape = 4 / skew ** 2
+
+    if skew > 0:
+        x = shape + z * sqrt(shape)
+        if x <= 0:
+            return 1.0
+        return igamc(shape, x)
+    else:
+        x = shape - z * sqrt(shape)
+        if x <= 0:
+            return 0.0
+        return igam(shape, x)
+
+def _qap_moments(a, b, a_sums=None):
+    """Computes the exact moments of a quadratic assignment (QAP) statistic.
+
+    The QAP statistic is the sum over i != j of a[i, j] * b[p(i), p(j)],
+    where p is a permutation of the samples. Returns the mean, variance, and
+    skewness of the statistic over all possible permutations. a and b must be
+    symmetric and hollow matrices of the same size.
+
+    The moments are computed by grouping the terms of each power of the
+    statistic by the pattern of equal indices, which makes the computation
+    polynomial in the number of samples. a_sums can be provided to cache
+    intermediate results for a between calls with different b matrices.
+    """
+    if a_sums is None:
+        a_sums = {}
+    b_sums = {}
+
+    raw_moments = [_qap_raw_moment(a, b, order, a_sums, b_sums)
+                   for order in (1, 2, 3)]
+
+    mean = raw_moments[0]
+    var = raw_moments[1] - mean ** 2
+    third = raw_moments[2] - 3 * mean * raw_moments[1] + 2 * mean ** 3
+
+    if var <= 0:
+        skew = 0.0
+    else:
+        skew = third / var ** 1.5
+    return mean, var, skew
+
+def _qap_raw_moment(a, b, order, a_sums, b_sums):
+    """Computes E[S^order] for the QAP statistic S (see _qap_moments).
+
+    Each term of S^order is indexed by 2 * order sample indices. For a fixed
+    pattern of equal indices (a set partition of the indices) with k distinct
+    values, each injective assignment of a's indices is paired with each
+    injective assignment of b's indices with probability 1 / (n)_k.
+    """
+    size = len(a)
+    result = 0.0
+
+    for partition in _set_partitions(2 * order):
+        num_blocks = max(partition) + 1
+
+        # Terms with i == j are zero since the matrices are hollow, and there
+        # are no injective assignments if there are too few samples.
+        if _has_loop(partition) or num_blocks > size:
+            continue
+
+        a_sum = _distinct_sum(a, partition, a_sums)
+        b_sum = _distinct_sum(b, partition, b_sums)
+        result += a_sum * b_sum / _falling_factorial(size, num_blocks)
+    return result
+
+def _distinct_sum(mat, partition, cache):
+    """Sums products of mat over index assignments that exactly match a pattern.
+
+    The product for a pattern is the product of mat[i, j] for each pair of
+    indices (i, j), where the indices in the same block of partition are
+    equal and indices in different blocks are different. This is computed
+    from unrestricted sums (where blocks may be equal) using Mobius inversion
+    on the lattice of set partitions.
+    """
+    if partition not in cache:
+        result = 0.0
+        num_blocks = max(partition) + 1
+
+        for merging in _set_partitions(num_blocks):
+            coarser = _normalize_partition([merging[block]
+                                            for block in partition])
+            if _has_loop(coarser):
+                continue
+
+            # Mobius function of the partition lattice.
+            coeff = 1
+            for block_size in bincount(merging):
+                coeff *= (-1) ** (block_size - 1) * \
+                         _falling_factorial(block_size - 1, block_size - 1)
+            result += coeff * _unrestricted_sum(mat, coarser, cache)
+        cache[partition] = result
+    return cache[partition]
+
+def _unrestricted_sum(mat, partition, cache):
+    """Sums products of mat over all index assignments allowed by partition.
+
+    Indices in the same block of partition are equal, but indices in
+    different blocks may also be equal.
+    """
+    key = ('unrestricted', partition)
+
+    if key not in cache:
+        edges = [(partition[i], partition[i + 1])
+                 for i in range(0, len(partition), 2)]
+        cache[key] = _contract(mat, edges)
+    return cache[key]
+
+def _contract(mat, edges):
+    """Sums the product of mat over the indices of a small graph's vertices.
+
+    Each edge (u, v) contributes a factor of mat[i_u, i_v] to the product,
+    and the sum is over all values of the vertex indices. Vertices are
+    eliminated one at a time, which is efficient for graphs with few edges.
+    """
+    weights = {}
+    for u, v in edges:
+        weights[u] = ones(len(mat))
+        weights[v] = ones(len(mat))
+    edges = [(u, v, mat) for u, v in edges]
+
+    result = 1.0
+    while weights:
+        # Fold self-loops into the vertex weights and merge parallel edges.
+        merged_edges = {}
+        for u, v, m in edges:
+            if u == v:
+                weights[u] = weights[u] * m.diagonal()
+            elif (v, u) in merged_edges:
+                merged_edges[(v, u)] = merged_edges[(v, u)] * m.T
+            elif (u, v) in merged_edges:
+                merged_edges[(u, v)] = merged_edges[(u, v)] * m
+            else:
+                merged_edges[(u, v)] = m
+        edges = [(u, v, m) for (u, v), m in merged_edges.items()]
+
+        degrees = dict([(vertex, 0) for vertex in weights])
+        for u, v, _ in edges:
+            degrees[u] += 1
+            degrees[v] += 1
+        vertex = min(sorted(weights), key=lambda vertex: degrees[vertex])
+        weight = weights.pop(vertex)
+
+        vertex_edges = []
+        other_edges = []
+        for edge in edges:
+            if vertex in edge[:2]:
+                vertex_edges.append(_orient_edge(edge, vertex))
+            else:
+                other_edges.append(edge)
+        edges = other_edges
+
+        if len(vertex_edges) == 0:
+            result *= weight.sum()
+        elif len(vertex_edges) == 1:
+            u, m = vertex_edges[0]
+            weights[u] = weights[u] * m.dot(weight)
+        elif len(vertex_edges) == 2:
+            (u, m1), (v, m2) = vertex_edges
+            edges.append((u, v, (m1 * weight).dot(m2.T)))
+        else:
+            raise ValueError("Cannot contract graphs where every vertex has "
+                             "three or more neighbors.")
+    return result
+
+def _orient_edge(edge, vertex):
+    """Returns the other vertex of edge and a matrix with vertex as columns."""
+    u, v, m = edge
+    if v == vertex:
+        return u, m
+    else:
+        return v, m.T
+
+def _set_partitions(num_items):
+    """Generates all set partitions of num_items items.
+
+    Each partition is a tuple giving the block number of each item. Block
+    numbers are assigned in order of first appearance.
+    """
+    if num_items == 0:
+        yield ()
+    else:
+        for partition in _set_partitions(num_items - 1):
+            num_blocks = max(partition) + 1 if partition else 0
+            for block in range(num_blocks + 1):
+                yield partition + (block,)
+
+def _normalize_partition(blocks):
+    """Renumbers blocks in order of first appearance (see _set_partitions)."""
+    block_map = {}
+    for block in blocks:
+        if block not in block_map:
+            block_map[block] = len(block_map)
+    return tuple([block_map[block] for block in blocks])
+
+def _has_loop(partition):
+    """Returns True if any index pair (i, j) has i and j in the same block."""
+    for i in range(0, len(partition), 2):
+        if partition[i] == partition[i + 1]:
+            return True
+    return False
+
+def _falling_factorial(n, k):
+    """Returns n * (n - 1) * ... * (n - k + 1)."""
+    result = 1
+    for i in range(k):
+        result *= n - i
+    return result
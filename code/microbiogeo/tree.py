@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Module for working with phylogenetic trees."""
+
+from cogent.core.tree import PhyloNode
+from numpy import (add, argsort, array, bincount, column_stack, cumsum,
+                   flatnonzero, inf, load, ones, savez, searchsorted, where,
+                   zeros)
+from qiime.parse import parse_newick
+
+class FlatTree(object):
+    """A phylogenetic tree stored as flat arrays in postorder.
+
+    Node i's parent is parents[i] (-1 for the root), and its branch length is
+    lengths[i] (zero if the branch has no length). Children always come
+    before their parents, so the root is the last node. names contains the
+    name of each node (None if the node is unnamed).
+    """
+
+    def __init__(self, names, parents, lengths):
+        self.names = list(names)
+        self.parents = array(parents, dtype=int)
+        self.lengths = array(lengths, dtype=float)
+
+        # Depth of each node (the root has a depth of zero). Since parents
+        # come after their children, walking backwards visits each parent
+        # before its children.
+        depths = [0] * len(self.parents)
+        for node_idx in range(len(self.parents) - 2, -1, -1):
+            depths[node_idx] = depths[self.parents[node_idx]] + 1
+        self.depths = array(depths, dtype=int)
+
+        # Nodes sorted by decreasing depth, and the start of each depth level
+        # in that ordering (excluding the root's level).
+        self._level_order = argsort(-self.depths, kind='mergesort')
+        level_depths = self.depths[self._level_order]
+        self._level_bounds = searchsorted(-level_depths,
+                                          -array(range(self.depths.max(), -1,
+                                                       -1)))
+
+        is_parent = array([False] * len(self.parents))
+        is_parent[self.parents[self.parents >= 0]] = True
+        self.is_tip = ~is_parent
+
+    def getTipIndices(self, tip_names):
+        """Returns the node index of each named tip.
+
+        Raises a ValueError if any of the tips are not in the tree.
+        """
+        tip_lookup = dict([(name, idx) for idx, name in enumerate(self.names)
+                           if self.is_tip[idx]])
+
+        missing = [name for name in tip_names if name not in tip_lookup]
+        if missing:
+            raise ValueError("The following tips are not in the tree: %s" %
+                             ', '.join(map(str, missing)))
+
+        return array([tip_lookup[name] for name in tip_names], dtype=int)
+
+    def propagate(self, values):
+        """Sums values up the tree.
+
+        values must be an array with one row for each node. Returns a new array
+        where each node's row is the sum of its original row and the rows of
+        all of its descendants. Each depth level is summed into its parents in
+        a single vectorized operation.
+        """
+        result = array(values, dtype=float)
+
+        for level_idx in range(len(self._level_bounds) - 1):
+            nodes = self._level_order[self._level_bounds[level_idx]:
+                                      self._level_bounds[level_idx + 1]]
+            add.at(result, self.parents[nodes], result[nodes])
+        return result
+
+    def subtree(self, keep):
+        """Returns the tree containing only the nodes where keep is True.
+
+        The parent of each kept node (other than the root) must also be kept.
+        Nodes are not collapsed, so the branch lengths are unchanged.
+        """
+        keep = array(keep, dtype=bool)
+        new_idxs = cumsum(keep) - 1
+        kept = flatnonzero(keep)
+
+        parents = self.parents[kept]
+        parents[parents >= 0] = new_idxs[parents[parents >= 0]]
+        return FlatTree([self.names[idx] for idx in kept], parents,
+                        self.lengths[kept])
+
+    def prune(self, tip_names):
+        """Returns the tree containing only the specified tips.
+
+        Nodes that are not ancestors of the tips are removed, and internal
+        nodes that are left with a single child are collapsed into that child
+        (their branch lengths are added to the child's). The root is never
+        collapsed, so any stem above the tips' most recent common ancestor is
+        kept as a single branch. Tip-to-tip and tip-to-root distances are
+        unchanged, so UniFrac distances computed using the pruned tree are the
+        same as those computed using the full tree.
+        """
+        if len(tip_names) == 0:
+            raise ValueError("Cannot prune a tree to zero tips.")
+
+        keep = zeros(len(self.names))
+        keep[self.getTipIndices(tip_names)] = 1
+        tree = self.subtree(self.propagate(keep) > 0)
+
+        num_children = bincount(tree.parents[:-1], minlength=len(tree.names))
+        collapse = num_children == 1
+        collapse[-1] = False
+
+        # Walk from the root down so that each parent has already been
+        # attached to its nearest non-collapsed ancestor.
+        parents = tree.parents.copy()
+        lengths = tree.lengths.copy()
+        for node_idx in range(len(parents) - 2, -1, -1):
+            parent_idx = parents[node_idx]
+            if collapse[parent_idx]:
+                parents[node_idx] = parents[parent_idx]
+                lengths[node_idx] += lengths[parent_idx]
+
+        return FlatTree(tree.names, parents, lengths).subtree(~collapse)
+
+    def getNewick(self):
+        """Returns the tree as a newick string (with branch lengths)."""
+        nodes = [PhyloNode(Name=name, Length=length)
+                 for name, length in zip(self.names, self.lengths)]
+        for node_idx, parent_idx in enumerate(self.parents[:-1]):
+            nodes[parent_idx].append(nodes[node_idx])
+
+        nodes[-1].Length = None
+        return nodes[-1].getNewick(with_distances=True)
+
+
+class TreeNeighborhoodIndex(object):
+    """Index of the tips near each of a set of tips (OTUs) in a tree.
+
+    For each indexed OTU, the path from the OTU to the root is stored as the
+    distance up the tree to each ancestor (dists) and the range of tips below
+    each ancestor (first_tips and num_tips, which index into tip_names). Tips
+    are numbered in postorder, so the tips below any node are a contiguous
+    range. Rows for OTUs closer to the root are padded with infinite
+    distances.
+
+    This is everything needed to find an OTU's neighborhood at any
+    dissimilarity (see getNeighborhood) without the tree, so an index can be
+    built once for a tree and set of OTUs and saved for reuse (see save and
+    load_tree_index).
+    """
+
+    def __init__(self, tip_names, otu_ids, dists, first_tips, num_tips):
+        self.tip_names = array(tip_names)
+        self.otu_ids = list(otu_ids)
+        self.dists = array(dists, dtype=float)
+        self.first_tips = array(first_tips, dtype=int)
+        self.num_tips = array(num_tips, dtype=int)
+
+        self._otu_idxs = dict([(otu_id, idx)
+                               for idx, otu_id in enumerate(self.otu_ids)])
+
+    @classmethod
+    def fromTree(cls, tree, otu_ids):
+        """Builds the index for otu_ids (tips in the FlatTree tree)."""
+        node_idxs = tree.getTipIndices(otu_ids)
+
+        # Walk all of the OTUs up to the root at the same time.
+        chain = [node_idxs]
+        dists = [zeros(len(node_idxs))]
+        cur = node_idxs
+        cur_dists = dists[0]
+        while True:
+            has_parent = tree.parents[cur] >= 0
+            if not has_parent.any():
+                break
+
+            cur_dists = where(has_parent, cur_dists + tree.lengths[cur], inf)
+            cur = where(has_parent, tree.parents[cur], cur)
+            chain.append(cur)
+            dists.append(cur_dists)
+        chain = column_stack(chain)
+
+        # The subtree rooted at node i is nodes [i - sizes[i] + 1, i].
+        sizes = tree.propagate(ones(len(tree.names))).astype(int)
+        tips_through = cumsum(tree.is_tip)
+        tips_before = tips_through - tree.is_tip
+        first_tips = tips_before[chain - sizes[chain] + 1]
+
+        return cls([tree.names[idx] for idx in flatnonzero(tree.is_tip)],
+                   otu_ids, column_stack(dists), first_tips,
+                   tips_through[chain] - first_tips)
+
+    def getNeighborhood(self, dissim, otu_ids):
+        """Returns the tips that each OTU can be replaced by at dissim.
+
+        An OTU's neighborhood is the tips below its highest ancestor that is
+        less than dissim up the tree (the same as QIIME's simsam.py). If the
+        OTU has no such ancestor, the neighborhood is the OTU itself.
+
+        Returns two arrays containing the first tip (an index into tip_names)
+        and number of tips in each OTU's neighborhood.
+        """
+        rows = array([self._otu_idxs[otu_id] for otu_id in otu_ids],
+                     dtype=int)
+
+        # The distances in each row are sorted, so this is the number of
+        # ancestors less than dissim up the tree (the first entry is the OTU
+        # itself, at a distance of zero).
+        anc_nums = (self.dists[rows] < dissim).sum(axis=1) - 1
+        anc_nums[anc_nums < 0] = 0
+
+        return (self.first_tips[rows, anc_nums],
+                self.num_tips[rows, anc_nums])
+
+    def getNeighborhoodTips(self, dissim, otu_ids):
+        """Returns the names of all tips in the OTUs' neighborhoods at dissim.
+
+        These are the only tips that simulate_tables can draw new OTUs from,
+        so a tree pruned to them is enough to compute phylogenetic distances
+        between the simulated samples. Tips are returned in postorder.
+        """
+        first_tips, num_tips = self.getNeighborhood(dissim, otu_ids)
+
+        # Mark the start and end of each tip range and take the running count
+        # of open ranges, so overlapping neighborhoods are only walked once.
+        markers = zeros(len(self.tip_names) + 1, dtype=int)
+        add.at(markers, first_tips, 1)
+        add.at(markers, first_tips + num_tips, -1)
+        return [self.tip_names[idx]
+                for idx in flatnonzero(cumsum(markers[:-1]) > 0)]
+
+    def save(self, index_fp):
+        """Saves the index to index_fp (a numpy .npz file)."""
+        savez(index_fp, tip_names=self.tip_names, otu_ids=array(self.otu_ids),
+              dists=self.dists, first_tips=self.first_tips,
+              num_tips=self.num_tips)
+
+
+def load_tree_index(index_fp):
+    """Loads a TreeNeighborhoodIndex saved by TreeNeighborhoodIndex.save."""
+    index_data = load(index_fp)
+    return TreeNeighborhoodIndex(index_data['tip_names'],
+                                 index_data['otu_ids'].tolist(),
+                                 index_data['dists'],
+                                 index_data['first_tips'],
+                                 index_data['num_tips'])
+
+def flatten_tree(tree):
+    """Converts a cogent tree into a FlatTree."""
+    nodes = list(tree.postorder())
+    node_idxs = dict([(id(node), idx) for idx, node in enumerate(nodes)])
+
+    names = []
+    parents = []
+    lengths = []
+    for node in nodes:
+        names.append(node.Name)
+
+        if node.Parent is None:
+            parents.append(-1)
+        else:
+            parents.append(node_idxs[id(node.Parent)])
+
+        if node.Length is None:
+            lengths.append(0.0)
+        else:
+            lengths.append(node.Length)
+    return FlatTree(names, parents, lengths)
+
+def parse_flat_tree(tree_f):
+    """Parses a newick tree into a FlatTree.
+
+    Node names are parsed the same way as QIIME parses trees.
+    """
+    return flatten_tree(parse_newick(tree_f, PhyloNode))
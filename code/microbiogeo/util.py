@@ -13,21 +13,26 @@ __email__ = "jai.rideout@gmail.com"
 
 from biom.parse import parse_biom_table
 from collections import defaultdict
-from os import listdir
-from os.path import exists, join
-from random import randint, sample, shuffle
+from hashlib import sha1
+from os import getpid, link, listdir, rename
+from os.path import dirname, exists, getmtime, join, samefile, splitext
+from shutil import copyfile
 
 from IPython.parallel import Client
 
-from numpy import ceil
+from numpy import (array, asarray, ceil, cumsum, float32, int32, ix_, load,
+                   maximum, minimum, save, savez, subtract, triu_indices)
+from numpy.random import RandomState
+
+from scipy.spatial.distance import squareform
 
 from qiime.colors import data_colors, data_color_order
 from qiime.filter import filter_samples_from_distance_matrix
-from qiime.format import format_distance_matrix
+from qiime.format import format_coords, format_distance_matrix
 from qiime.make_distance_histograms import matplotlib_rgb_color
-from qiime.parse import (parse_distmat, parse_mapping_file,
+from qiime.parse import (parse_coords, parse_distmat, parse_mapping_file,
                          parse_mapping_file_to_dict)
-from qiime.util import MetadataMap, qiime_system_call
+from qiime.util import create_dir, MetadataMap, qiime_system_call
 
 class ExternalCommandFailedError(Exception):
     pass
@@ -70,6 +75,54 @@ def has_results(results_dir, required_files=None):
 
     return has_results
 
+def link_artifact(fp, out_fps, store_dir):
+    """Makes each filepath in out_fps an identical copy of fp.
+
+    A single copy of fp is kept in store_dir (a content-addressed artifact
+    store), under the SHA-1 hash of its contents. Each output filepath is a
+    hardlink to the stored copy, so identical files are only written once no
+    matter how many places they are linked from, and they still appear as
+    regular files to anything that reads them. fp itself isn't modified.
+    Files are copied instead if they can't be hardlinked (e.g. store_dir is on
+    a different filesystem).
+
+    Returns the filepath of the stored copy.
+    """
+    create_dir(store_dir)
+    store_fp = join(store_dir, _hash_file(fp) + splitext(fp)[1])
+
+    if not exists(store_fp):
+        tmp_fp = _get_tmp_fp(store_fp)
+        copyfile(fp, tmp_fp)
+        rename(tmp_fp, store_fp)
+
+    for out_fp in out_fps:
+        create_dir(dirname(out_fp) or '.')
+        if exists(out_fp) and samefile(store_fp, out_fp):
+            continue
+
+        # Link to a temporary name first so that out_fp is replaced
+        # atomically.
+        tmp_fp = _get_tmp_fp(out_fp)
+        try:
+            link(store_fp, tmp_fp)
+        except OSError:
+            copyfile(store_fp, tmp_fp)
+        rename(tmp_fp, out_fp)
+    return store_fp
+
+def _hash_file(fp, block_size=2 ** 20):
+    file_hash = sha1()
+    with open(fp, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            file_hash.update(block)
+            block = f.read(block_size)
+    return file_hash.hexdigest()
+
+def _get_tmp_fp(fp):
+    return '%s.%d.tmp' % (fp, getpid())
+
 def get_num_samples_in_table(table_fp):
     """Returns the number of samples in the table."""
     with open(table_fp, 'U') as table_f:
@@ -77,34 +130,381 @@ def get_num_samples_in_table(table_fp):
         return len(table.SampleIds)
 
 def get_num_samples_in_distance_matrix(dm_fp):
-    """Returns the number of samples in the distance matrix."""
-    with open(dm_fp, 'U') as dm_f:
-        return len(parse_distmat(dm_f)[0])
+    """Returns the number of samples in the distance matrix.
+
+    Only the sample IDs are read if the distance matrix is in binary form.
+    """
+    if _has_binary_dm(dm_fp):
+        return len(_parse_binary_dm_ids(get_binary_dm_fps(dm_fp)[1]))
+    else:
+        with open(dm_fp, 'U') as dm_f:
+            return len(parse_distmat(dm_f)[0])
+
+def get_binary_dm_fps(dm_fp):
+    """Returns the filepaths of the binary form of a distance matrix.
+
+    The binary form is stored as a .npy file containing the distances and a
+    sidecar text file containing the sample IDs (one per line). For example,
+    the binary form of dm.txt (or dm.npy) is dm.npy and dm_ids.txt.
+    """
+    base_fp = splitext(dm_fp)[0]
+    return base_fp + '.npy', base_fp + '_ids.txt'
+
+def parse_distance_matrix(dm_f, condensed=False):
+    """Parses a distance matrix in either text or binary form.
+
+    dm_f can be a file-like object in QIIME's distance matrix format, or a
+    filepath. Filepaths ending in .npy are read in binary form. For other
+    filepaths, the binary form is used if it exists and is at least as new as
+    the text file, and the text file is parsed otherwise. Binary distances are
+    memory-mapped (read-only) instead of being read into memory.
+
+    If condensed is True, the distances are returned in condensed form (the
+    upper triangle as a 1-D array, in the same order as
+    scipy.spatial.distance.squareform). Otherwise, distances stored in
+    condensed form are expanded to a square matrix.
+
+    Returns a tuple containing the sample IDs and distances, in the same form
+    as qiime.parse.parse_distmat.
+    """
+    labels, dm_data = _parse_stored_distance_matrix(dm_f)
+
+    if condensed and dm_data.ndim == 2:
+        dm_data = squareform(dm_data, checks=False)
+    elif not condensed and dm_data.ndim == 1:
+        dm_data = squareform(asarray(dm_data, dtype=float))
+    return labels, dm_data
+
+def write_distance_matrix(dm_fp, labels, dm_data, binary=False,
+                          condensed=False):
+    """Writes a distance matrix in text and/or binary form.
+
+    If dm_fp ends in .npy, only the binary form is written. Otherwise, the
+    text form is written to dm_fp, and the binary form is also written
+    alongside it if binary is True.
+
+    If condensed is True, the binary form is written as the upper triangle of
+    the distance matrix in single precision (about an eighth of the size of
+    the full matrix), and binary is implied. Readers expand it back to a
+    square matrix (see parse_distance_matrix). dm_data can be square or
+    condensed.
+    """
+    dm_data = asarray(dm_data)
+
+    if not dm_fp.endswith('.npy'):
+        square_dm_data = dm_data
+        if square_dm_data.ndim == 1:
+            square_dm_data = squareform(square_dm_data)
+
+        with open(dm_fp, 'w') as dm_f:
+            dm_f.write(format_distance_matrix(labels, square_dm_data))
+
+    if binary or condensed or dm_fp.endswith('.npy'):
+        data_fp, ids_fp = get_binary_dm_fps(dm_fp)
+
+        if condensed:
+            if dm_data.ndim == 2:
+                dm_data = squareform(dm_data, checks=False)
+            save(data_fp, asarray(dm_data, dtype=float32))
+        else:
+            if dm_data.ndim == 1:
+                dm_data = squareform(dm_data)
+            save(data_fp, asarray(dm_data, dtype=float))
+
+        with open(ids_fp, 'w') as ids_f:
+            ids_f.write('\n'.join(labels))
+            ids_f.write('\n')
+
+def _parse_stored_distance_matrix(dm_f):
+    """Parses a distance matrix without converting its storage form."""
+    if not isinstance(dm_f, basestring):
+        return parse_distmat(dm_f)
+
+    if _has_binary_dm(dm_f):
+        data_fp, ids_fp = get_binary_dm_fps(dm_f)
+        return _parse_binary_dm_ids(ids_fp), load(data_fp, mmap_mode='r')
+    else:
+        with open(dm_f, 'U') as text_dm_f:
+            return parse_distmat(text_dm_f)
+
+def _has_binary_dm(dm_fp):
+    """Returns True if the binary form of dm_fp should be read."""
+    if dm_fp.endswith('.npy'):
+        return True
+
+    data_fp, ids_fp = get_binary_dm_fps(dm_fp)
+    return exists(data_fp) and exists(ids_fp) and \
+           (not exists(dm_fp) or getmtime(data_fp) >= getmtime(dm_fp))
+
+def _parse_binary_dm_ids(ids_fp):
+    with open(ids_fp, 'U') as ids_f:
+        return [line.strip() for line in ids_f if line.strip()]
 
 def get_num_samples_in_map(map_fp):
     """Returns the number of samples in the mapping file."""
     with open(map_fp, 'U') as map_f:
         return len(parse_mapping_file(map_f)[0])
 
+def parse_subset_index(index_fp):
+    """Parses a subset index written by write_subset_index.
+
+    Returns the parent table's sample IDs and a dict mapping each subset's
+    name to the indices of its samples in the parent table (in the same order
+    as the parent table).
+    """
+    with open(index_fp, 'rb') as index_f:
+        index_data = load(index_f)
+        samp_ids = index_data['samp_ids'].tolist()
+        names = index_data['names'].tolist()
+        offsets = index_data['offsets']
+        samp_idxs = index_data['samp_idxs']
+
+    subsets = {}
+    for name, start, end in zip(names, offsets[:-1], offsets[1:]):
+        subsets[name] = samp_idxs[start:end]
+    return samp_ids, subsets
+
+def write_subset_index(index_fp, samp_ids, subsets):
+    """Writes subsets of a table's samples to a single index file.
+
+    Each subset is stored as the indices of its samples in the parent table
+    (samp_ids), so a subset can be used directly with the parent table
+    instead of being written out as its own table and mapping file. subsets
+    maps each subset's name to its sample IDs. The index is a numpy .npz
+    file, and is replaced atomically.
+    """
+    samp_idxs = dict([(samp_id, idx) for idx, samp_id in enumerate(samp_ids)])
+
+    names = sorted(subsets)
+    subset_idxs = []
+    for name in names:
+        subset_idxs.append(sorted([samp_idxs[samp_id]
+                                   for samp_id in subsets[name]]))
+    offsets = cumsum([0] + [len(idxs) for idxs in subset_idxs])
+
+    tmp_fp = _get_tmp_fp(index_fp)
+    with open(tmp_fp, 'wb') as index_f:
+        savez(index_f, samp_ids=array(samp_ids), names=array(names),
+              offsets=offsets,
+              samp_idxs=array([idx for idxs in subset_idxs for idx in idxs],
+                              dtype=int32))
+    rename(tmp_fp, index_fp)
+
+def derive_seed(seed, *keys):
+    """Returns the seed of an independent random stream identified by keys.
+
+    The derived seed only depends on seed and keys (e.g. a workflow's seed
+    and a job's study, depth, category, trial number, sample size and
+    dissimilarity), so a job's random stream is the same no matter where, or
+    in what order, it is run. Derived seeds can be derived from again to
+    identify nested streams. Returns None if seed is None (unseeded).
+    """
+    if seed is None:
+        return None
+
+    digest = sha1(repr((seed,) + keys)).hexdigest()
+    return int(digest[:8], 16) & 0x7fffffff
+
+def get_random_state(random_state=None):
+    """Returns a numpy RandomState for random_state.
+
+    random_state can be a RandomState (returned as is), a seed, or None (a
+    random seed is used).
+    """
+    if isinstance(random_state, RandomState):
+        return random_state
+    return RandomState(random_state)
+
+def sample_items(items, num_items, random_state=None):
+    """Returns num_items items chosen at random, without replacement.
+
+    This is the same as random.sample, but draws from random_state (see
+    get_random_state). Sets are sorted first so that the result only depends
+    on the random stream.
+    """
+    if isinstance(items, (set, frozenset)):
+        items = sorted(items)
+    if num_items > len(items):
+        raise ValueError("Cannot choose %d items from %d items." %
+                         (num_items, len(items)))
+
+    random_state = get_random_state(random_state)
+    return [items[idx]
+            for idx in random_state.permutation(len(items))[:num_items]]
+
 def get_simsam_rep_num(target_num_samps, curr_num_samps):
     if curr_num_samps >= target_num_samps:
         raise ValueError("Current number of samples is greater than or equal "
                          "to the target number of samples.")
     return int(ceil(target_num_samps / curr_num_samps))
 
-def shuffle_dm(dm_f):
-    labels, dm_data = parse_distmat(dm_f)
-    shuffle(labels)
+def shuffle_dm(dm_f, random_state=None):
+    labels, dm_data = parse_distance_matrix(dm_f)
+    get_random_state(random_state).shuffle(labels)
     return format_distance_matrix(labels, dm_data)
 
-def subset_dm(dm_f, num_samps):
-    labels, dm_data = parse_distmat(dm_f)
-    samp_ids_to_keep = sample(labels, num_samps)
+def shuffle_dm_and_coords(dm_f, coords_f, random_state=None,
+                          condensed=False):
+    """Shuffles the labels of a distance matrix and its PCoA coordinates.
+
+    coords_f should contain the principal coordinates of the distance matrix
+    in dm_f. Shuffling only permutes the labels, so the shuffled distance
+    matrix has the same ordination as the original, with each sample's
+    coordinates moved to its new label. The same permutation is applied to
+    both, so PCoA doesn't need to be rerun on the shuffled distance matrix.
+
+    dm_f can be anything accepted by parse_distance_matrix. random_state is
+    used to shuffle the labels (see get_random_state). condensed has the same
+    meaning as in parse_distance_matrix. Returns a tuple containing the
+    shuffled distance matrix (labels, data) and formatted coordinates.
+    """
+    labels, dm_data = parse_distance_matrix(dm_f, condensed)
+    coords_labels, coords, eigvals, pct_var = parse_coords(coords_f)
+
+    if set(labels) != set(coords_labels) or len(labels) != len(coords_labels):
+        raise ValueError("The coordinates file must contain the same samples "
+                         "as the distance matrix.")
+    coords_idxs = dict([(label, idx)
+                        for idx, label in enumerate(coords_labels)])
+    coords = coords[[coords_idxs[label] for label in labels]]
+
+    shuffled_labels = labels[:]
+    get_random_state(random_state).shuffle(shuffled_labels)
+    return ((shuffled_labels, dm_data),
+            format_coords(shuffled_labels, coords, eigvals, pct_var))
+
+def subset_dm(dm_f, num_samps, random_state=None):
+    labels, dm_data = parse_distance_matrix(dm_f)
+    samp_ids_to_keep = sample_items(labels, num_samps, random_state)
     return filter_samples_from_distance_matrix((labels, dm_data),
                                                samp_ids_to_keep, negate=True)
 
-def subset_groups(dm_f, map_f, category, max_group_size):
-    dm_labels, dm_data = parse_distmat(dm_f)
+def slice_dm(dm_f, sample_ids, strip_replicate_suffix=False,
+             condensed=False):
+    """Returns a distance matrix containing only the specified samples.
+
+    The output distance matrix is labeled with sample_ids (in that order) and
+    is created by indexing into the input distance matrix, so no distances are
+    recomputed. If strip_replicate_suffix is True, the replicate number that
+    simsam.py appends to each sample ID (e.g. '.0' in 'S1.0') is removed
+    before looking up the sample in the input distance matrix. This is only
+    valid for tables simulated with a dissimilarity of zero, where each
+    replicate has the same counts as its original sample.
+
+    dm_f can be anything accepted by parse_distance_matrix. Returns a tuple
+    containing the sliced distance matrix's labels and data. If condensed is
+    True and the distance matrix is stored in condensed form, the sliced data
+    is also condensed. Otherwise, it is a square matrix.
+    """
+    labels, dm_data = _parse_stored_distance_matrix(dm_f)
+    label_idxs = dict([(label, idx) for idx, label in enumerate(labels)])
+
+    idxs = []
+    for samp_id in sample_ids:
+        lookup_id = samp_id
+        if strip_replicate_suffix:
+            lookup_id = samp_id.rsplit('.', 1)[0]
+
+        if lookup_id not in label_idxs:
+            raise ValueError("Sample '%s' is not in the distance matrix." %
+                             lookup_id)
+        idxs.append(label_idxs[lookup_id])
+
+    if dm_data.ndim == 1:
+        dm_data = _slice_condensed_dm(dm_data, len(labels), idxs)
+        if not condensed:
+            dm_data = squareform(dm_data)
+        return sample_ids, dm_data
+    else:
+        return sample_ids, dm_data[ix_(idxs, idxs)]
+
+def _slice_condensed_dm(dm_data, num_samps, idxs):
+    """Slices a condensed distance matrix without expanding it.
+
+    Only the distances between the samples in idxs are read. Returns a
+    condensed matrix.
+    """
+    idxs = asarray(idxs)
+    rows, cols = triu_indices(len(idxs), 1)
+    i = idxs[rows]
+    j = idxs[cols]
+    lo = minimum(i, j)
+    hi = maximum(i, j)
+
+    # Distances between replicates of the same sample are zero, so they aren't
+    # stored in the condensed matrix.
+    same = lo == hi
+    pos = num_samps * lo - lo * (lo + 1) // 2 + hi - lo - 1
+    pos[same] = 0
+
+    condensed = asarray(dm_data[pos], dtype=float)
+    condensed[same] = 0.0
+    return condensed
+
+def intersect_distance_matrices(dms):
+    """Makes multiple distance matrices compatible with each other.
+
+    dms should be a list of (labels, data) tuples, as returned by
+    qiime.parse.parse_distmat or parse_distance_matrix. Only the samples that
+    are in all of the distance matrices are kept, and they are ordered
+    according to the first distance matrix. Condensed distance matrices are
+    kept in condensed form (and aren't copied if they already have the shared
+    samples in that order).
+
+    Returns a tuple containing the list of shared sample IDs and a list of
+    filtered/reordered distance matrix data (one for each input matrix).
+    """
+    shared_labels = set(dms[0][0])
+    for labels, _ in dms[1:]:
+        shared_labels &= set(labels)
+    order = [label for label in dms[0][0] if label in shared_labels]
+
+    dms_data = []
+    for labels, dm_data in dms:
+        label_idxs = dict([(label, idx) for idx, label in enumerate(labels)])
+        idxs = [label_idxs[label] for label in order]
+
+        if dm_data.ndim == 1:
+            if idxs != range(len(labels)):
+                dm_data = _slice_condensed_dm(dm_data, len(labels), idxs)
+            dms_data.append(dm_data)
+        else:
+            dms_data.append(dm_data[ix_(idxs, idxs)])
+
+    return order, dms_data
+
+def compute_gradient_dm(map_f, category):
+    """Computes a gradient distance matrix from a mapping file category.
+
+    The distance between two samples is the absolute difference of their
+    (numeric) values in category. This is the same as
+    distance_matrix_from_mapping.py with a single category, but doesn't
+    require writing the distance matrix to disk.
+
+    Returns a tuple containing the sample IDs and distances, in the same form
+    as qiime.parse.parse_distmat.
+    """
+    metadata, _ = parse_mapping_file_to_dict(map_f)
+    samp_ids = sorted(metadata)
+
+    values = []
+    for samp_id in samp_ids:
+        if category not in metadata[samp_id]:
+            raise ValueError("Category '%s' is not in the mapping file." %
+                             category)
+        try:
+            values.append(float(metadata[samp_id][category]))
+        except ValueError:
+            raise ValueError("All values in category '%s' must be numeric, "
+                             "but sample '%s' has '%s'." %
+                             (category, samp_id, metadata[samp_id][category]))
+
+    values = asarray(values)
+    return samp_ids, abs(subtract.outer(values, values))
+
+def subset_groups(dm_f, map_f, category, max_group_size, random_state=None):
+    random_state = get_random_state(random_state)
+    dm_labels, dm_data = parse_distance_matrix(dm_f)
     metadata_map = MetadataMap.parseMetadataMap(map_f)
 
     category_map = defaultdict(list)
@@ -117,23 +517,28 @@ def subset_groups(dm_f, map_f, category, max_group_size):
             category_map[category_val].append(samp_id)
 
     samp_ids_to_keep = []
-    for category_val, samp_ids in category_map.items():
-        samp_ids_to_keep.extend(
-                sample(samp_ids, min(max_group_size, len(samp_ids))))
+    for category_val, samp_ids in sorted(category_map.items()):
+        samp_ids_to_keep.extend(sample_items(samp_ids,
+                min(max_group_size, len(samp_ids)), random_state))
 
     return filter_samples_from_distance_matrix((dm_labels, dm_data),
                                                samp_ids_to_keep, negate=True)
 
-def choose_gradient_subsets(dm_f, map_f, gradient, subset_sizes, num_subsets):
+def choose_gradient_subsets(dm_f, map_f, gradient, subset_sizes, num_subsets,
+                            random_state=None):
+    random_state = get_random_state(random_state)
     subsets = []
 
     mdm, _ = parse_mapping_file_to_dict(map_f)
-    dm_labels, dm_data = parse_distmat(dm_f)
+    dm_labels, dm_data = parse_distance_matrix(dm_f)
 
     # Only keep the sample IDs that are in both the mapping file and distance
-    # matrix.
+    # matrix. Sort the samples according to the gradient category (tied
+    # samples are ordered by sample ID, so the same seed always chooses the
+    # same samples).
     samp_ids = [(samp_id, float(metadata[gradient]))
-                for samp_id, metadata in mdm.items() if samp_id in dm_labels]
+                for samp_id, metadata in sorted(mdm.items())
+                if samp_id in dm_labels]
     samp_ids.sort(key=lambda samp_id: samp_id[1])
 
     for subset_size in subset_sizes:
@@ -155,15 +560,15 @@ def choose_gradient_subsets(dm_f, map_f, gradient, subset_sizes, num_subsets):
                     else:
                         end_idx = bin_idxs[i + 1] - 1
 
-                    samp_ids_to_keep.append(
-                            samp_ids[randint(bin_idxs[i], end_idx)][0])
+                    samp_ids_to_keep.append(samp_ids[
+                            random_state.randint(bin_idxs[i], end_idx + 1)][0])
                 else:
-                    # We subtract 1 since randint is inclusive on both sides,
-                    # and we don't want to choose the same sample ID multiple
-                    # times from different bins.
-                    samp_ids_to_keep.append(
-                            samp_ids[randint(bin_idxs[i],
-                                             bin_idxs[i + 1] - 1)][0])
+                    # randint excludes the next bin's start, so we don't
+                    # choose the same sample ID multiple times from different
+                    # bins.
+                    samp_ids_to_keep.append(samp_ids[
+                            random_state.randint(bin_idxs[i],
+                                                 bin_idxs[i + 1])][0])
 
             assert len(samp_ids_to_keep) == subset_size, \
                    "%d != %d" % (len(samp_ids_to_keep), subset_size)
@@ -195,7 +600,10 @@ class StatsResults(object):
         self.p_values = []
 
     def addResult(self, effect_size, p_value):
-        self._check_p_value(p_value)
+        # p_value is None if only the effect size was computed (i.e. the
+        # method was run without permutations).
+        if p_value is not None:
+            self._check_p_value(p_value)
 
         if self.isEmpty():
             self.effect_size = effect_size
@@ -207,7 +615,8 @@ class StatsResults(object):
                                  "permutations." % (effect_size,
                                                     self.effect_size))
 
-        self.p_values.append(p_value)
+        if p_value is not None:
+            self.p_values.append(p_value)
 
     def isEmpty(self):
         return self.effect_size is None
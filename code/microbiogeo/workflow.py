@@ -15,7 +15,6 @@ from collections import defaultdict
 from csv import writer
 from os import listdir
 from os.path import basename, exists, join, splitext
-from random import randint, sample
 
 from biom.parse import parse_biom_table
 
@@ -32,6 +31,8 @@ from qiime.parse import (parse_mapping_file_to_dict, parse_mapping_file,
                          parse_coords, group_by_field)
 from qiime.util import add_filename_suffix, create_dir, MetadataMap
 
+from microbiogeo.distance import METRICS as NATIVE_METRICS
+from microbiogeo.distance import PHYLOGENETIC_METRICS
 from microbiogeo.format import (format_method_comparison_heatmaps,
                                 format_method_comparison_table)
 from microbiogeo.method import (AbstractStatMethod, Adonis, Anosim, Best,
@@ -45,16 +46,27 @@ from microbiogeo.simulate import create_simulated_data_plots
 from microbiogeo.util import (get_color_pool,
                               get_num_samples_in_distance_matrix,
                               get_num_samples_in_map, get_num_samples_in_table,
-                              get_panel_label, get_simsam_rep_num, has_results,
-                              run_command, run_parallel_jobs, StatsResults)
+                              derive_seed, get_panel_label, get_simsam_rep_num,
+                              has_results, parse_subset_index, run_command,
+                              run_parallel_jobs, StatsResults)
 
 def generate_data(analysis_type, in_dir, out_dir, workflow, tree_fp,
                   ipython_profile=None):
     """Generates real and simulated data for each study.
 
     Distance matrices will be created at each even sampling depth and metric
-    using the provided tree if necessary. Shuffled versions of each distance
-    matrix will also be created, which can be used as negative controls.
+    using the provided tree if necessary. The tree is pruned once per study
+    to the study's OTUs, and that tree is pruned again at each even sampling
+    depth, so that the real data's distance matrices are computed using a
+    tree containing only the observed OTUs. simsam.py still uses the full tree
+    because it draws new OTUs from the tips near each observed OTU, but the
+    simulated data's distance matrices are computed using a tree pruned to the
+    study's OTUs and the tips near them at the study's highest dissimilarity
+    (which contains every tip that can be drawn at any dissimilarity). Shuffled
+    versions of each distance matrix will also be created, which can be used
+    as negative controls. If in_process_rarefaction is set, the table is
+    rarefied to all depths by a single rarefy_tables.py command instead of
+    running single_rarefaction.py once for each depth.
     Additionally, simulated gradient or cluster data will be created at varying
     sample sizes and dissimilarity levels (using simsam.py).
 
@@ -64,20 +76,24 @@ def generate_data(analysis_type, in_dir, out_dir, workflow, tree_fp,
 
     out_dir/
         study/
+            pruned_tree.tre
+            simulated_tree.tre (if any dissimilarity is nonzero)
+            artifacts/ (if dedup_artifacts, see link_artifacts.py)
             depth/
                 even depth otu table (.biom)
+                pruned_tree.tre
                 real/
                     metric/
                         original/
                             map.txt
-                            dm.txt
+                            dm.txt (dm.npy if binary only, see _writes_text_dms)
                             pc.txt
-                            <category>_dm.txt (if gradient)
+                            <category>_dm.txt (if gradient, see _writes_gradient_dms)
                         shuff_num
                             map.txt
-                            dm.txt
+                            dm.txt (dm.npy if binary only, see _writes_text_dms)
                             pc.txt
-                            <category>_dm.txt (if gradient)
+                            <category>_dm.txt (if gradient, see _writes_gradient_dms)
                 simulated/
                     category/
                         trial_num/
@@ -87,13 +103,18 @@ def generate_data(analysis_type, in_dir, out_dir, workflow, tree_fp,
                                     subset files/dirs dependent on samp_size
                                     metric/
                                         map.txt
-                                        dm.txt
+                                        dm.txt (dm.npy if binary only, see _writes_text_dms)
                                         pc.txt
-                                        <category>_dm.txt (if gradient)
+                                        <category>_dm.txt (if gradient, see _writes_gradient_dms)
     """
     create_dir(out_dir)
 
-    cmds = []
+    # Simulated data at a dissimilarity of zero reuses the real data's
+    # distance matrices, so all real data is created first.
+    real_cmds = []
+    sim_table_cmds = []
+    sim_subset_table_cmds = []
+    sim_cmds = []
     for study in workflow:
         study_dir = join(out_dir, study)
         create_dir(study_dir)
@@ -102,34 +123,127 @@ def generate_data(analysis_type, in_dir, out_dir, workflow, tree_fp,
         map_fp = join(in_dir, study, 'map.txt')
         map_f = open(map_fp, 'U')
 
+        # Identical copies of mapping files are hardlinks to a single copy in
+        # the study's artifact store.
+        artifact_dir = None
+        if workflow[study].get('dedup_artifacts', False):
+            artifact_dir = join(study_dir, 'artifacts')
+
+        study_tree_fp = join(study_dir, 'pruned_tree.tre')
+        if not exists(study_tree_fp):
+            run_command('prune_tree.py -i %s -t %s -o %s;' % (
+                    otu_table_fp, tree_fp, study_tree_fp))
+
+        # simulate_tables.py looks up OTU neighborhoods in the full tree
+        # through an index, which covers every table simulated for this study
+        # (all are subsets of the study's table).
+        tree_index_fp = None
+        if workflow[study].get('in_process_simsam', False):
+            tree_index_fp = join(study_dir, 'tree_index.npz')
+            if not exists(tree_index_fp):
+                run_command('build_tree_index.py -i %s -t %s -o %s;' % (
+                        otu_table_fp, tree_fp, tree_index_fp))
+
+        # Neighborhoods only grow with the dissimilarity, so a single tree
+        # covers every table simulated for this study.
+        sim_tree_fp = tree_fp
+        max_dissim = max(workflow[study]['dissim'])
+        if max_dissim > 0:
+            sim_tree_fp = join(study_dir, 'simulated_tree.tre')
+            if not exists(sim_tree_fp):
+                run_command('prune_tree.py -i %s -t %s -o %s -d %r;' % (
+                        otu_table_fp, tree_fp, sim_tree_fp, max_dissim))
+
+        # Rarefy the table first since simsam.py's output tables will still
+        # have even sampling depth and we don't want to lose simulated
+        # samples after the fact.
+        rarefy_depths = []
+        rarefy_fps = []
         for depth in workflow[study]['depths']:
             depth_dir = join(study_dir, '%d' % depth[0])
             create_dir(depth_dir)
 
-            # Rarefy the table first since simsam.py's output tables will still
-            # have even sampling depth and we don't want to lose simulated
-            # samples after the fact.
             even_otu_table_fp = join(depth_dir, basename(otu_table_fp))
-
             if not exists(even_otu_table_fp):
-                run_command('single_rarefaction.py -i %s -o %s -d %d;' % (
-                        otu_table_fp, even_otu_table_fp, depth[0]))
+                rarefy_depths.append(depth[0])
+                rarefy_fps.append(even_otu_table_fp)
+
+        if rarefy_depths:
+            if workflow[study].get('in_process_rarefaction', False):
+                run_command(_build_rarefy_tables_command(otu_table_fp,
+                        rarefy_depths, rarefy_fps,
+                        derive_seed(workflow[study].get('seed'), study)))
+            else:
+                for depth, even_otu_table_fp in zip(rarefy_depths,
+                                                    rarefy_fps):
+                    run_command('single_rarefaction.py -i %s -o %s -d %d;' % (
+                            otu_table_fp, even_otu_table_fp, depth))
 
-            cmds.extend(_build_real_data_commands(analysis_type, depth_dir,
-                    even_otu_table_fp, map_fp, tree_fp, workflow[study]))
-            cmds.extend(_build_simulated_data_commands(analysis_type,
-                    depth_dir, even_otu_table_fp, map_fp, tree_fp,
-                    workflow[study]))
+        for depth in workflow[study]['depths']:
+            depth_dir = join(study_dir, '%d' % depth[0])
+            depth_seed = _get_depth_seed(workflow, study, depth)
+            even_otu_table_fp = join(depth_dir, basename(otu_table_fp))
 
-    run_parallel_jobs(cmds, run_command, ipython_profile=ipython_profile)
+            depth_tree_fp = join(depth_dir, 'pruned_tree.tre')
+            if not exists(depth_tree_fp):
+                run_command('prune_tree.py -i %s -t %s -o %s;' % (
+                        even_otu_table_fp, study_tree_fp, depth_tree_fp))
+
+            real_cmds.extend(_build_real_data_commands(analysis_type,
+                    depth_dir, even_otu_table_fp, map_fp, depth_tree_fp,
+                    workflow[study], artifact_dir, depth_seed))
+            study_sim_table_cmds, study_sim_subset_table_cmds, \
+                    study_sim_cmds = _build_simulated_data_commands(
+                            analysis_type, depth_dir, even_otu_table_fp,
+                            map_fp, tree_fp, workflow[study], artifact_dir,
+                            tree_index_fp, depth_seed, sim_tree_fp)
+            sim_table_cmds.extend(study_sim_table_cmds)
+            sim_subset_table_cmds.extend(study_sim_subset_table_cmds)
+            sim_cmds.extend(study_sim_cmds)
+
+    # Simulated tables that are created in-process (see
+    # _build_simulated_data_commands) don't depend on the real data, so they
+    # (and the subsets they're simulated from) are created at the same time.
+    run_parallel_jobs(real_cmds + sim_table_cmds, run_command,
+                      ipython_profile=ipython_profile)
+    run_parallel_jobs(sim_subset_table_cmds, run_command,
+                      ipython_profile=ipython_profile)
+    run_parallel_jobs(sim_cmds, run_command, ipython_profile=ipython_profile)
+
+def _build_rarefy_tables_command(otu_table_fp, depths, out_fps, seed=None):
+    """Returns a command that rarefies a table to all depths at once."""
+    return 'rarefy_tables.py -i %s -d %s -o %s' % (otu_table_fp,
+            ','.join(map(str, depths)), ','.join(out_fps)) + \
+           _build_seed_option(seed)
+
+def _get_depth_seed(workflow, study, depth):
+    """Returns the seed that a study's depth derives its jobs' seeds from.
+
+    Returns None if the study doesn't have a seed (i.e. all of its jobs are
+    unseeded).
+    """
+    return derive_seed(workflow[study].get('seed'), study, depth[0])
+
+def _build_seed_option(seed):
+    """Returns the option that seeds a command's random number generator."""
+    if seed is None:
+        return ''
+    else:
+        return ' --seed %d' % seed
 
 def _build_real_data_commands(analysis_type, out_dir, even_otu_table_fp,
-                              map_fp, tree_fp, workflow):
+                              map_fp, tree_fp, workflow, artifact_dir=None,
+                              seed=None):
     cmds = []
 
     data_type_dir = join(out_dir, 'real')
     create_dir(data_type_dir)
 
+    # All metrics that are missing results are computed from a single pass
+    # over the table (and tree).
+    text = _writes_text_dms(workflow)
+    metrics = []
+    metric_dirs = []
     for metric in workflow['metrics']:
         metric_dir = join(data_type_dir, metric[0])
         create_dir(metric_dir)
@@ -137,8 +251,8 @@ def _build_real_data_commands(analysis_type, out_dir, even_otu_table_fp,
         orig_dir = join(metric_dir, 'original')
         create_dir(orig_dir)
 
-        required_files = ['dm.txt', 'map.txt', 'pc.txt']
-        if analysis_type == 'gradient':
+        required_files = [_get_dm_filename(text), 'map.txt', 'pc.txt']
+        if analysis_type == 'gradient' and _writes_gradient_dms(workflow):
             for category in workflow['categories']:
                 required_files.append('%s_dm.txt' % category[0])
 
@@ -152,23 +266,56 @@ def _build_real_data_commands(analysis_type, out_dir, even_otu_table_fp,
                 break
 
         if not (has_orig_files and has_shuff_files):
-            cmds.append(_build_per_metric_real_data_commands(analysis_type,
-                    metric_dir, even_otu_table_fp, map_fp, tree_fp, metric,
-                    workflow['categories'], workflow['num_shuffled_trials']))
+            metrics.append(metric[0])
+            metric_dirs.append(metric_dir)
+
+    if metrics:
+        binary = workflow.get('binary_dms', False)
+        condensed = workflow.get('condensed_dms', False)
+        cmd = _build_beta_diversity_commands(even_otu_table_fp,
+                [join(metric_dir, 'original') for metric_dir in metric_dirs],
+                metrics, tree_fp, binary, condensed, text)
+
+        for metric, metric_dir in zip(metrics, metric_dirs):
+            cmd.extend(_build_per_metric_real_data_commands(analysis_type,
+                    metric_dir, map_fp, workflow['categories'],
+                    workflow['num_shuffled_trials'], binary, condensed,
+                    _writes_gradient_dms(workflow), artifact_dir,
+                    derive_seed(seed, 'real', metric), text))
+        cmds.append(' && '.join(cmd))
     return cmds
 
-def _build_per_metric_real_data_commands(analysis_type, out_dir,
-                                         even_otu_table_fp, map_fp, tree_fp,
-                                         metric, categories,
-                                         num_shuffled_trials):
+def _build_per_metric_real_data_commands(analysis_type, out_dir, map_fp,
+                                         categories, num_shuffled_trials,
+                                         binary=False, condensed=False,
+                                         gradient_dms=True,
+                                         artifact_dir=None, seed=None,
+                                         text=True):
+    """Returns commands that create a metric's real data files.
+
+    out_dir/original/dm.txt must already exist (see
+    _build_beta_diversity_commands). If binary is True, the shuffled distance
+    matrices are also written in binary form (condensed if condensed is True).
+    If text is False, distance matrices are stored as dm.npy instead (see
+    _writes_text_dms).
+    Gradient distance matrices are only written if gradient_dms is True (see
+    _writes_gradient_dms). If artifact_dir is provided, the copies of map_fp
+    are hardlinks to a single copy stored in artifact_dir. If seed is
+    provided, each shuffle is seeded from it and the shuffle's number.
+    """
     orig_dir = join(out_dir, 'original')
+    dm_fn = _get_dm_filename(text)
 
-    cmd = ['beta_diversity.py -i %s -o %s -m %s -t %s' % (even_otu_table_fp, orig_dir, metric[0], tree_fp)]
-    cmd.append('mv %s %s' % (join(orig_dir, '%s_%s.txt' % (metric[0], splitext(basename(even_otu_table_fp))[0])), join(orig_dir, 'dm.txt')))
-    cmd.append('cp %s %s' % (map_fp, join(orig_dir, 'map.txt')))
-    cmd.append('principal_coordinates.py -i %s -o %s' % (join(orig_dir, 'dm.txt'), join(orig_dir, 'pc.txt')))
+    if artifact_dir is None:
+        cmd = ['cp %s %s' % (map_fp, join(orig_dir, 'map.txt'))]
+    else:
+        map_fps = [join(orig_dir, 'map.txt')]
+        map_fps.extend([join(out_dir, '%d' % shuff_num, 'map.txt')
+                        for shuff_num in range(num_shuffled_trials)])
+        cmd = [_build_link_artifact_command(map_fp, map_fps, artifact_dir)]
+    cmd.append('compute_pcoa.py -i %s -o %s' % (join(orig_dir, dm_fn), join(orig_dir, 'pc.txt')))
 
-    if analysis_type == 'gradient':
+    if analysis_type == 'gradient' and gradient_dms:
         for category in categories:
             cmd.append('distance_matrix_from_mapping.py -i %s -c %s -o %s' % (join(orig_dir, 'map.txt'), category[0], join(orig_dir, '%s_dm.txt' % category[0])))
 
@@ -176,22 +323,225 @@ def _build_per_metric_real_data_commands(analysis_type, out_dir,
         shuff_num_dir = join(out_dir, '%d' % shuff_num)
 
         cmd.append('mkdir -p %s' % shuff_num_dir)
-        cmd.append('shuffle_distance_matrix.py -i %s -o %s' % (join(orig_dir, 'dm.txt'), join(shuff_num_dir, 'dm.txt')))
-        cmd.append('cp %s %s' % (join(orig_dir, 'map.txt'), join(shuff_num_dir, 'map.txt')))
-        cmd.append('principal_coordinates.py -i %s -o %s' % (join(shuff_num_dir, 'dm.txt'), join(shuff_num_dir, 'pc.txt')))
+        cmd.append('shuffle_distance_matrix.py -i %s -o %s -c %s -p %s' % (join(orig_dir, dm_fn), join(shuff_num_dir, dm_fn), join(orig_dir, 'pc.txt'), join(shuff_num_dir, 'pc.txt')))
+        cmd[-1] += _build_dm_form_options(binary, condensed)
+        cmd[-1] += _build_seed_option(derive_seed(seed, shuff_num))
+        if artifact_dir is None:
+            cmd.append('cp %s %s' % (join(orig_dir, 'map.txt'), join(shuff_num_dir, 'map.txt')))
 
-        if analysis_type == 'gradient':
+        if analysis_type == 'gradient' and gradient_dms:
             for category in categories:
                 cmd.append('distance_matrix_from_mapping.py -i %s -c %s -o %s' % (join(shuff_num_dir, 'map.txt'), category[0], join(shuff_num_dir, '%s_dm.txt' % category[0])))
-    return ' && '.join(cmd)
+    return cmd
+
+def _build_beta_diversity_commands(otu_table_fp, out_dirs, metrics, tree_fp,
+                                   binary=False, condensed=False, text=True):
+    """Returns commands that create out_dir/dm.txt for each metric.
+
+    out_dirs and metrics should be parallel lists. All metrics with native
+    implementations are computed by a single compute_distance_matrices.py
+    call, so the table and tree are only parsed once. All other metrics are
+    computed by QIIME's beta_diversity.py. If binary is True, the native
+    metrics' distance matrices are also written in binary form (condensed if
+    condensed is True). If text is False, the native metrics' distance
+    matrices are only written in binary form, to out_dir/dm.npy (see
+    _writes_text_dms).
+    """
+    native_metrics = []
+    native_dm_fps = []
+    beta_div_cmds = []
+    for out_dir, metric in zip(out_dirs, metrics):
+        dm_fp = join(out_dir, 'dm.txt')
+
+        if metric in NATIVE_METRICS:
+            native_metrics.append(metric)
+            native_dm_fps.append(join(out_dir, _get_dm_filename(text)))
+        else:
+            beta_div_cmds.append('beta_diversity.py -i %s -o %s -m %s -t %s' % (otu_table_fp, out_dir, metric, tree_fp))
+            beta_div_cmds.append('mv %s %s' % (join(out_dir, '%s_%s.txt' % (metric, splitext(basename(otu_table_fp))[0])), dm_fp))
+
+    cmds = []
+    if native_metrics:
+        cmds.append('compute_distance_matrices.py -i %s -m %s -o %s' % (otu_table_fp, ','.join(native_metrics), ','.join(native_dm_fps)))
+        if set(native_metrics) & set(PHYLOGENETIC_METRICS):
+            cmds[0] += ' -t %s' % tree_fp
+        cmds[0] += _build_dm_form_options(binary, condensed)
+    cmds.extend(beta_div_cmds)
+    return cmds
+
+def _build_sliced_dm_commands(real_data_dir, map_fp, metric_dirs, metrics,
+                              binary=False, condensed=False, text=True):
+    """Returns commands that create metric_dir/dm.txt for each metric.
+
+    Used for tables simulated with a dissimilarity of zero, which have the
+    same counts as the real data. Instead of recomputing distances, each
+    metric's real data distance matrix (which must already exist) is sliced
+    to the samples in map_fp. If binary is True, the sliced distance matrices
+    are also written in binary form (condensed if condensed is True). If text
+    is False, distance matrices are stored as dm.npy instead (see
+    _writes_text_dms).
+    """
+    dm_fn = _get_dm_filename(text)
+    cmds = ['slice_distance_matrix.py -i %s -m %s -o %s --strip_replicate_suffix' % (join(real_data_dir, metric, 'original', dm_fn), map_fp, join(metric_dir, dm_fn)) for metric_dir, metric in zip(metric_dirs, metrics)]
+    return [cmd + _build_dm_form_options(binary, condensed) for cmd in cmds]
+
+def _build_dm_form_options(binary, condensed):
+    """Returns the options that select how distance matrices are written.
+
+    condensed implies binary.
+    """
+    if condensed:
+        return ' --condensed'
+    elif binary:
+        return ' -b'
+    else:
+        return ''
+
+def _writes_text_dms(workflow):
+    """Returns True if distance matrices should be written as text.
+
+    The native metrics and methods read the binary form of a distance matrix
+    (condensed or not) directly, so the text form is only needed if binary
+    distance matrices aren't enabled, or if a metric or method is run by QIIME
+    or R. QIIME's beta_diversity.py only writes text, and
+    compare_categories.py is used for ANOSIM and PERMANOVA unless
+    batch_metrics is enabled. Otherwise, distance matrices are only written in
+    binary form, as dm.npy instead of dm.txt (see _get_dm_filename).
+    """
+    if not (workflow.get('binary_dms', False) or
+            workflow.get('condensed_dms', False)):
+        return True
+
+    for metric in workflow['metrics']:
+        if metric[0] not in NATIVE_METRICS:
+            return True
+
+    batch_metrics = workflow.get('batch_metrics', False)
+    for method in workflow['methods']:
+        if type(method) in (Mantel, PearsonOrdinationCorrelation,
+                            SpearmanOrdinationCorrelation):
+            continue
+        if batch_metrics and _is_batchable_across_metrics(method):
+            continue
+        return True
+    return False
+
+def _get_dm_filename(text):
+    """Returns the name of a distance matrix's file (see _writes_text_dms).
+
+    Filepaths ending in .npy are only written (and read) in binary form.
+    """
+    return 'dm.txt' if text else 'dm.npy'
+
+def _build_link_artifact_command(in_fp, out_fps, artifact_dir):
+    return 'link_artifacts.py -i %s -o %s -s %s' % (in_fp, ','.join(out_fps), artifact_dir)
+
+def _writes_gradient_dms(workflow):
+    """Returns True if <category>_dm.txt files should be written.
+
+    Mantel tests (batch_mantel.py) compute gradient distances from the mapping
+    file, so the files are only needed by QIIME's Mantel correlogram, or if
+    they are explicitly requested with export_gradient_dms.
+    """
+    return workflow.get('export_gradient_dms', False) or \
+           MantelCorrelogram() in workflow['methods']
 
 def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
-                                   map_fp, tree_fp, workflow):
+                                   map_fp, tree_fp, workflow,
+                                   artifact_dir=None, tree_index_fp=None,
+                                   seed=None, sim_tree_fp=None):
+    """Returns commands that create the simulated data.
+
+    Returns three lists of commands, which must be run in order (the commands
+    within each list are independent of each other): commands that create
+    simulated tables and choose subsets, commands that simulate the chosen
+    subsets, and commands that create everything else. If in_process_simsam
+    is set, all of a sample size's simulated tables are created by a single
+    simulate_tables.py command (in the first or second list), which uses
+    tree_index_fp instead of tree_fp if it is provided. Otherwise, each
+    dissimilarity's table is created by simsam.py. The simulated tables'
+    distance matrices are computed using sim_tree_fp if it is provided, which
+    must contain every tip that can be drawn from tree_fp (see generate_data).
+
+    If batch_subsets is set, all of the subsets of the real data are chosen
+    by a single choose_data_subset.py command (in the first list, with any
+    simulate_tables.py commands that use the subsets in the second list)
+    instead of being chosen here, one at a time. If virtual_subsets and in_process_simsam are
+    both set, the subsets aren't written out as tables and mapping files.
+    Instead, they are added to a single subset index (subsets.npz, in the
+    simulated data directory), and simulate_tables.py reads them from the
+    index and the even table.
+
+    Sample sizes larger than the even table are normally simulated by
+    replicating every sample and then choosing a subset of the simulated
+    table. If subset_before_simulating and in_process_simsam are both set,
+    the subset is chosen from the (not yet simulated) replicates first and
+    added to a subset index (subsets_n<num replicates>.npz), and only the
+    replicates in the subset are simulated. The subset is shared by all of
+    the sample size's dissimilarities, the same as subsets of the real data.
+
+    Otherwise, the replicated table doesn't depend on the category or sample
+    size. If share_simulated_tables is set, it is only simulated once for
+    each trial, number of replicates and dissimilarity (in the first list,
+    under the simulated data directory's 'replicated' directory), and each
+    category and sample size chooses its subset from the shared table.
+
+    If seed is provided, each subset and simulation is seeded from it and the
+    category, trial number and sample size (and dissimilarity, where a
+    command only creates one), so the same subsets and tables are created no
+    matter which jobs have already been run. simsam.py can't be seeded.
+    """
+    table_cmds = []
     cmds = []
 
+    if sim_tree_fp is None:
+        sim_tree_fp = tree_fp
+
+    # Subsets of the real data that will be chosen by a single command, and
+    # the simulate_tables.py commands that must run after it (and after the
+    # commands that choose subsets of replicates).
+    subset_categories = []
+    subset_sizes = []
+    subset_dirs = []
+    subset_seeds = []
+    subset_table_cmds = []
+
     data_type_dir = join(out_dir, 'simulated')
     create_dir(data_type_dir)
 
+    # Created by _build_real_data_commands.
+    real_data_dir = join(out_dir, 'real')
+    binary = workflow.get('binary_dms', False)
+    condensed = workflow.get('condensed_dms', False)
+    text = _writes_text_dms(workflow)
+    gradient_dms = analysis_type == 'gradient' and \
+                   _writes_gradient_dms(workflow)
+    in_process_simsam = workflow.get('in_process_simsam', False)
+    batch_subsets = workflow.get('batch_subsets', False)
+
+    subset_index_fp = None
+    indexed_subsets = {}
+    if in_process_simsam and workflow.get('virtual_subsets', False):
+        batch_subsets = True
+        subset_index_fp = join(data_type_dir, 'subsets.npz')
+        if exists(subset_index_fp):
+            indexed_subsets = parse_subset_index(subset_index_fp)[1]
+
+    # Subsets of (not yet simulated) replicates, chosen before simulating so
+    # that only the replicates in each subset are simulated. Replicate
+    # number -> list of (category, sample size, subset name, seed) tuples.
+    subset_before_simulating = in_process_simsam and \
+                               workflow.get('subset_before_simulating', False)
+    rep_subsets = defaultdict(list)
+    indexed_rep_subsets = {}
+
+    # Replicated tables that don't depend on the category or sample size,
+    # simulated once and subsetted by each of them. (Trial number, replicate
+    # number) -> dissimilarity -> directory to simulate into.
+    share_simulated_tables = not subset_before_simulating and \
+                             workflow.get('share_simulated_tables', False)
+    shared_sims = defaultdict(dict)
+
     num_samps = get_num_samples_in_table(even_otu_table_fp)
 
     for category in workflow['categories']:
@@ -205,6 +555,9 @@ def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
             for samp_size in workflow['sample_sizes']:
                 samp_size_dir = join(trial_num_dir, '%d' % samp_size)
                 create_dir(samp_size_dir)
+                samp_size_seed = derive_seed(seed, 'simulated', category[0],
+                                             trial_num, samp_size)
+                simulate_seed = derive_seed(samp_size_seed, 'simulate')
 
                 # Lots of duplicate code between these two blocks...
                 # need to refactor and test.
@@ -213,12 +566,31 @@ def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
 
                     subset_otu_table_fp = join(samp_size_dir, basename(even_otu_table_fp))
                     subset_map_fp = join(samp_size_dir, basename(map_fp))
+                    subset_name = None
+
+                    if subset_index_fp is not None:
+                        # Subsets are named by their path under the
+                        # simulated data directory.
+                        subset_name = '%s/%d/%d' % (category[0], trial_num, samp_size)
+                        if subset_name not in indexed_subsets:
+                            subset_categories.append(category[0])
+                            subset_sizes.append(samp_size)
+                            subset_dirs.append(subset_name)
+                            subset_seeds.append(derive_seed(samp_size_seed, 'subset'))
+                    elif not has_results(samp_size_dir, required_files=[basename(subset_otu_table_fp), basename(subset_map_fp)]):
+                        if batch_subsets:
+                            subset_categories.append(category[0])
+                            subset_sizes.append(samp_size)
+                            subset_dirs.append(samp_size_dir)
+                            subset_seeds.append(derive_seed(samp_size_seed, 'subset'))
+                        else:
+                            run_command(_build_choose_subsets_command(analysis_type, even_otu_table_fp, map_fp, [category[0]], [samp_size], [samp_size_dir], seeds=[derive_seed(samp_size_seed, 'subset')]))
+                    if subset_name is None and samp_size_dir not in subset_dirs:
+                        assert get_num_samples_in_table(subset_otu_table_fp) == samp_size
+                        assert get_num_samples_in_map(subset_map_fp) == samp_size
 
-                    if not has_results(samp_size_dir, required_files=[basename(subset_otu_table_fp), basename(subset_map_fp)]):
-                        run_command('choose_data_subset.py -t %s -i %s -m %s -c %s -n %d -o %s' % (analysis_type, even_otu_table_fp, map_fp, category[0], samp_size, samp_size_dir))
-                    assert get_num_samples_in_table(subset_otu_table_fp) == samp_size
-                    assert get_num_samples_in_map(subset_map_fp) == samp_size
-
+                    sim_dissims = []
+                    sim_dirs = []
                     for d in workflow['dissim']:
                         dissim_dir = join(samp_size_dir, repr(d))
                         create_dir(dissim_dir)
@@ -233,8 +605,8 @@ def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
 
                         has_metric_files = True
                         for metric in workflow['metrics']:
-                            required_metric_files = ['dm.txt', 'map.txt', 'pc.txt']
-                            if analysis_type == 'gradient':
+                            required_metric_files = [_get_dm_filename(text), 'map.txt', 'pc.txt']
+                            if gradient_dms:
                                 required_metric_files.append('%s_dm.txt' % category[0])
 
                             metric_dir = join(dissim_dir, metric[0])
@@ -243,41 +615,78 @@ def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
                                 break
 
                         if not (has_simsam_files and has_metric_files):
-                            cmd = ['simsam.py -i %s -t %s -o %s -d %r -n %d -m %s' % (subset_otu_table_fp, tree_fp, dissim_dir, d, simsam_rep_num, subset_map_fp)]
-
-                            for metric in workflow['metrics']:
-                                metric_dir = join(dissim_dir, metric[0])
+                            if in_process_simsam:
+                                sim_dissims.append(d)
+                                sim_dirs.append(dissim_dir)
+                                cmd = []
+                            else:
+                                cmd = ['simsam.py -i %s -t %s -o %s -d %r -n %d -m %s' % (subset_otu_table_fp, tree_fp, dissim_dir, d, simsam_rep_num, subset_map_fp)]
+
+                            metric_dirs = [join(dissim_dir, metric[0]) for metric in workflow['metrics']]
+                            metrics = [metric[0] for metric in workflow['metrics']]
+                            if d == 0:
+                                cmd.extend(_build_sliced_dm_commands(real_data_dir, simsam_map_fp, metric_dirs, metrics, binary, condensed, text))
+                            else:
+                                cmd.extend(_build_beta_diversity_commands(simsam_otu_table_fp, metric_dirs, metrics, sim_tree_fp, binary, condensed, text))
+
+                            if artifact_dir is not None:
+                                cmd.append(_build_link_artifact_command(simsam_map_fp, [join(metric_dir, 'map.txt') for metric_dir in metric_dirs], artifact_dir))
+
+                            for metric_dir in metric_dirs:
                                 create_dir(metric_dir)
 
-                                if analysis_type == 'gradient':
+                                if gradient_dms:
                                     cmd.append('distance_matrix_from_mapping.py -i %s -c %s -o %s' % (simsam_map_fp, category[0], join(metric_dir, '%s_dm.txt' % category[0])))
 
-                                cmd.append('beta_diversity.py -i %s -o %s -m %s -t %s' % (simsam_otu_table_fp, metric_dir, metric[0], tree_fp))
-                                cmd.append('mv %s %s' % (join(metric_dir, '%s_%s.txt' % (metric[0], splitext(basename(simsam_otu_table_fp))[0])), join(metric_dir, 'dm.txt')))
-                                cmd.append('cp %s %s' % (simsam_map_fp, join(metric_dir, 'map.txt')))
-                                cmd.append('principal_coordinates.py -i %s -o %s' % (join(metric_dir, 'dm.txt'), join(metric_dir, 'pc.txt')))
+                                if artifact_dir is None:
+                                    cmd.append('cp %s %s' % (simsam_map_fp, join(metric_dir, 'map.txt')))
+                                cmd.append('compute_pcoa.py -i %s -o %s' % (join(metric_dir, _get_dm_filename(text)), join(metric_dir, 'pc.txt')))
                             cmds.append(' && '.join(cmd))
+
+                    if sim_dissims:
+                        if subset_name is None:
+                            subset_table_cmds.append(_build_simulate_tables_command(subset_otu_table_fp, subset_map_fp, tree_fp, simsam_rep_num, sim_dissims, sim_dirs, tree_index_fp, seed=simulate_seed))
+                        else:
+                            subset_table_cmds.append(_build_simulate_tables_command(even_otu_table_fp, map_fp, tree_fp, simsam_rep_num, sim_dissims, sim_dirs, tree_index_fp, subset_index_fp, subset_name, simulate_seed))
                 else:
                     # We need to simulate more samples than we originally have.
                     simsam_rep_num = get_simsam_rep_num(samp_size, num_samps)
 
+                    rep_subset_index_fp = None
+                    if subset_before_simulating:
+                        rep_subset_index_fp = _get_rep_subset_index_fp(data_type_dir, simsam_rep_num)
+                        subset_name = '%s/%d/%d' % (category[0], trial_num, samp_size)
+                    elif share_simulated_tables:
+                        shared_dir = join(data_type_dir, 'replicated', '%d' % trial_num, '%d' % simsam_rep_num)
+
+                    sim_dissims = []
+                    sim_dirs = []
                     for d in workflow['dissim']:
                         dissim_dir = join(samp_size_dir, repr(d))
                         create_dir(dissim_dir)
 
-                        simsam_map_fp = join(dissim_dir, add_filename_suffix(map_fp, '_n%d_d%r' % (simsam_rep_num, d)))
-                        simsam_otu_table_fp = join(dissim_dir, add_filename_suffix(even_otu_table_fp, '_n%d_d%r' % (simsam_rep_num, d)))
+                        sim_dir = dissim_dir
+                        if share_simulated_tables:
+                            sim_dir = join(shared_dir, repr(d))
+                            create_dir(sim_dir)
+
+                        simsam_map_fp = join(sim_dir, add_filename_suffix(map_fp, '_n%d_d%r' % (simsam_rep_num, d)))
+                        simsam_otu_table_fp = join(sim_dir, add_filename_suffix(even_otu_table_fp, '_n%d_d%r' % (simsam_rep_num, d)))
 
                         required_simsam_files = [basename(simsam_map_fp), basename(simsam_otu_table_fp)]
-                        has_simsam_files = has_results(dissim_dir, required_files=required_simsam_files)
+                        has_simsam_files = has_results(sim_dir, required_files=required_simsam_files)
 
-                        required_subset_files = [basename(simsam_map_fp), basename(simsam_otu_table_fp)]
-                        has_subset_files = has_results(join(dissim_dir, 'subset'), required_files=required_subset_files)
+                        if rep_subset_index_fp is None:
+                            required_subset_files = [basename(simsam_map_fp), basename(simsam_otu_table_fp)]
+                            has_subset_files = has_results(join(dissim_dir, 'subset'), required_files=required_subset_files)
+                        else:
+                            # The simulated table is the subset.
+                            has_subset_files = True
 
                         has_metric_files = True
                         for metric in workflow['metrics']:
-                            required_metric_files = ['dm.txt', 'map.txt', 'pc.txt']
-                            if analysis_type == 'gradient':
+                            required_metric_files = [_get_dm_filename(text), 'map.txt', 'pc.txt']
+                            if gradient_dms:
                                 required_metric_files.append('%s_dm.txt' % category[0])
 
                             metric_dir = join(dissim_dir, metric[0])
@@ -286,26 +695,112 @@ def _build_simulated_data_commands(analysis_type, out_dir, even_otu_table_fp,
                                 break
 
                         if not (has_simsam_files and has_subset_files and has_metric_files):
-                            cmd = ['simsam.py -i %s -t %s -o %s -d %r -n %d -m %s' % (even_otu_table_fp, tree_fp, dissim_dir, d, simsam_rep_num, map_fp)]
-
-                            subset_dir = join(dissim_dir, 'subset')
-                            cmd.append('choose_data_subset.py -t %s -i %s -m %s -c %s -n %d -o %s' % (analysis_type, simsam_otu_table_fp, simsam_map_fp, category[0], samp_size, subset_dir))
-                            subset_otu_table_fp = join(subset_dir, basename(simsam_otu_table_fp))
-                            subset_map_fp = join(subset_dir, basename(simsam_map_fp))
-
-                            for metric in workflow['metrics']:
-                                metric_dir = join(dissim_dir, metric[0])
+                            if share_simulated_tables:
+                                # Other categories and sample sizes may
+                                # already be using the shared table.
+                                if not has_simsam_files:
+                                    shared_sims[(trial_num, simsam_rep_num)][d] = sim_dir
+                                cmd = []
+                            elif in_process_simsam:
+                                sim_dissims.append(d)
+                                sim_dirs.append(dissim_dir)
+                                cmd = []
+                            else:
+                                cmd = ['simsam.py -i %s -t %s -o %s -d %r -n %d -m %s' % (even_otu_table_fp, tree_fp, dissim_dir, d, simsam_rep_num, map_fp)]
+
+                            if rep_subset_index_fp is None:
+                                subset_dir = join(dissim_dir, 'subset')
+                                cmd.append(_build_choose_subsets_command(analysis_type, simsam_otu_table_fp, simsam_map_fp, [category[0]], [samp_size], [subset_dir], seeds=[derive_seed(samp_size_seed, 'subset', d)]))
+                                subset_otu_table_fp = join(subset_dir, basename(simsam_otu_table_fp))
+                                subset_map_fp = join(subset_dir, basename(simsam_map_fp))
+                            else:
+                                subset_otu_table_fp = simsam_otu_table_fp
+                                subset_map_fp = simsam_map_fp
+
+                            metric_dirs = [join(dissim_dir, metric[0]) for metric in workflow['metrics']]
+                            metrics = [metric[0] for metric in workflow['metrics']]
+                            if d == 0:
+                                cmd.extend(_build_sliced_dm_commands(real_data_dir, subset_map_fp, metric_dirs, metrics, binary, condensed, text))
+                            else:
+                                cmd.extend(_build_beta_diversity_commands(subset_otu_table_fp, metric_dirs, metrics, sim_tree_fp, binary, condensed, text))
+
+                            if artifact_dir is not None:
+                                cmd.append(_build_link_artifact_command(subset_map_fp, [join(metric_dir, 'map.txt') for metric_dir in metric_dirs], artifact_dir))
+
+                            for metric_dir in metric_dirs:
                                 create_dir(metric_dir)
 
-                                if analysis_type == 'gradient':
+                                if gradient_dms:
                                     cmd.append('distance_matrix_from_mapping.py -i %s -c %s -o %s' % (subset_map_fp, category[0], join(metric_dir, '%s_dm.txt' % category[0])))
 
-                                cmd.append('beta_diversity.py -i %s -o %s -m %s -t %s' % (subset_otu_table_fp, metric_dir, metric[0], tree_fp))
-                                cmd.append('mv %s %s' % (join(metric_dir, '%s_%s.txt' % (metric[0], splitext(basename(subset_otu_table_fp))[0])), join(metric_dir, 'dm.txt')))
-                                cmd.append('cp %s %s' % (subset_map_fp, join(metric_dir, 'map.txt')))
-                                cmd.append('principal_coordinates.py -i %s -o %s' % (join(metric_dir, 'dm.txt'), join(metric_dir, 'pc.txt')))
+                                if artifact_dir is None:
+                                    cmd.append('cp %s %s' % (subset_map_fp, join(metric_dir, 'map.txt')))
+                                cmd.append('compute_pcoa.py -i %s -o %s' % (join(metric_dir, _get_dm_filename(text)), join(metric_dir, 'pc.txt')))
                             cmds.append(' && '.join(cmd))
-    return cmds
+
+                    if sim_dissims and rep_subset_index_fp is not None:
+                        if simsam_rep_num not in indexed_rep_subsets:
+                            indexed_rep_subsets[simsam_rep_num] = {}
+                            if exists(rep_subset_index_fp):
+                                indexed_rep_subsets[simsam_rep_num] = parse_subset_index(rep_subset_index_fp)[1]
+                        if subset_name not in indexed_rep_subsets[simsam_rep_num]:
+                            rep_subsets[simsam_rep_num].append((category[0], samp_size, subset_name, derive_seed(samp_size_seed, 'subset')))
+                        subset_table_cmds.append(_build_simulate_tables_command(even_otu_table_fp, map_fp, tree_fp, simsam_rep_num, sim_dissims, sim_dirs, tree_index_fp, rep_subset_index_fp, subset_name, simulate_seed))
+                    elif sim_dissims:
+                        table_cmds.append(_build_simulate_tables_command(even_otu_table_fp, map_fp, tree_fp, simsam_rep_num, sim_dissims, sim_dirs, tree_index_fp, seed=simulate_seed))
+
+    for (trial_num, rep_num), sim_dirs in sorted(shared_sims.items()):
+        sim_dissims = sorted(sim_dirs)
+        # The trial's seed, shared by all categories and sample sizes.
+        trial_seed = derive_seed(seed, 'simulated', trial_num, rep_num)
+
+        if in_process_simsam:
+            table_cmds.append(_build_simulate_tables_command(even_otu_table_fp, map_fp, tree_fp, rep_num, sim_dissims, [sim_dirs[d] for d in sim_dissims], tree_index_fp, seed=trial_seed))
+        else:
+            for d in sim_dissims:
+                table_cmds.append('simsam.py -i %s -t %s -o %s -d %r -n %d -m %s' % (even_otu_table_fp, tree_fp, sim_dirs[d], d, rep_num, map_fp))
+
+    # The subsets must be chosen before they can be simulated, but each
+    # simulate_tables.py command can then run as its own job.
+    if subset_dirs:
+        table_cmds.append(_build_choose_subsets_command(analysis_type, even_otu_table_fp, map_fp, subset_categories, subset_sizes, subset_dirs, subset_index_fp, subset_seeds))
+    for rep_num, subsets in sorted(rep_subsets.items()):
+        categories, samp_sizes, names, seeds = zip(*subsets)
+        table_cmds.append(_build_choose_subsets_command(analysis_type, even_otu_table_fp, map_fp, categories, samp_sizes, names, _get_rep_subset_index_fp(data_type_dir, rep_num), seeds, rep_num))
+    return table_cmds, subset_table_cmds, cmds
+
+def _get_rep_subset_index_fp(data_type_dir, num_reps):
+    """Returns the index of subsets chosen from num_reps replicates."""
+    return join(data_type_dir, 'subsets_n%d.npz' % num_reps)
+
+def _build_choose_subsets_command(analysis_type, otu_table_fp, map_fp,
+                                  categories, samp_sizes, out_dirs,
+                                  subset_index_fp=None, seeds=None,
+                                  num_reps=None):
+    cmd = 'choose_data_subset.py -t %s -i %s -m %s -c %s -n %s -o %s' % (analysis_type, otu_table_fp, map_fp, ','.join(categories), ','.join(map(str, samp_sizes)), ','.join(out_dirs))
+
+    if subset_index_fp is not None:
+        cmd += ' --subset_index %s' % subset_index_fp
+    if num_reps is not None:
+        cmd += ' --num_replicates %d' % num_reps
+    if seeds and None not in seeds:
+        cmd += ' --seed %s' % ','.join(map(str, seeds))
+    return cmd
+
+def _build_simulate_tables_command(otu_table_fp, map_fp, tree_fp, num_reps,
+                                   dissims, out_dirs, tree_index_fp=None,
+                                   subset_index_fp=None, subset_name=None,
+                                   seed=None):
+    if tree_index_fp is None:
+        tree_option = '-t %s' % tree_fp
+    else:
+        tree_option = '-x %s' % tree_index_fp
+
+    cmd = 'simulate_tables.py -i %s -m %s %s -n %d -d %s -o %s' % (otu_table_fp, map_fp, tree_option, num_reps, ','.join(['%r' % d for d in dissims]), ','.join(out_dirs))
+
+    if subset_index_fp is not None:
+        cmd += ' --subset_index %s --subset %s' % (subset_index_fp, subset_name)
+    return cmd + _build_seed_option(seed)
 
 def process_data(in_dir, workflow, ipython_profile=None):
     """Run statistical methods over generated data.
@@ -337,15 +832,16 @@ def process_data(in_dir, workflow, ipython_profile=None):
 
         for depth in workflow[study]['depths']:
             depth_dir = join(study_dir, '%d' % depth[0])
+            depth_seed = _get_depth_seed(workflow, study, depth)
 
             cmds.extend(_build_real_data_methods_commands(depth_dir,
-                    workflow[study]))
+                    workflow[study], depth_seed))
             cmds.extend(_build_simulated_data_methods_commands(depth_dir,
-                    workflow[study]))
+                    workflow[study], depth_seed))
 
     run_parallel_jobs(cmds, run_command, ipython_profile=ipython_profile)
 
-def _build_real_data_methods_commands(out_dir, workflow):
+def _build_real_data_methods_commands(out_dir, workflow, seed=None):
     cmds = []
 
     data_type_dir = join(out_dir, 'real')
@@ -353,14 +849,27 @@ def _build_real_data_methods_commands(out_dir, workflow):
     num_shuffled_trials = workflow['num_shuffled_trials']
     num_perms = workflow['num_real_data_perms']
 
+    # If requested, run all Mantel tests for a distance matrix in a single
+    # command so that the permutations are shared between the categories.
+    batch_mantel = workflow.get('batch_mantel', False) and \
+                   Mantel() in workflow['methods']
+    batch_metrics = workflow.get('batch_metrics', False)
+
+    # Number of processes to split each batched test's permutations between.
+    # Only the real data's tests are large enough to be worth splitting.
+    num_perm_jobs = workflow.get('num_permutation_jobs', 1)
+
+    text = _writes_text_dms(workflow)
+
     for metric in workflow['metrics']:
         metric_dir = join(data_type_dir, metric[0])
 
         dirs_to_process = ['original'] + map(str, range(num_shuffled_trials))
         for dir_to_process in dirs_to_process:
+            dir_seed = derive_seed(seed, 'real', metric[0], dir_to_process)
             dir_to_process = join(metric_dir, dir_to_process)
 
-            dm_fp = join(dir_to_process, 'dm.txt')
+            dm_fp = join(dir_to_process, _get_dm_filename(text))
             pc_fp = join(dir_to_process, 'pc.txt')
             map_fp = join(dir_to_process, 'map.txt')
 
@@ -373,6 +882,10 @@ def _build_real_data_methods_commands(out_dir, workflow):
                 for method in workflow['methods']:
                     if type(method) is Best or type(method) is PartialMantel:
                         continue
+                    if type(method) is Mantel and batch_mantel:
+                        continue
+                    if batch_metrics and _is_batchable_across_metrics(method):
+                        continue
 
                     method_dir = join(category_dir, method.DirectoryName)
                     create_dir(method_dir)
@@ -386,7 +899,9 @@ def _build_real_data_methods_commands(out_dir, workflow):
                             create_dir(perms_dir)
 
                             if not has_results(perms_dir):
-                                if type(method) is Mantel or type(method) is MantelCorrelogram:
+                                if type(method) is Mantel:
+                                    cmds.append('batch_mantel.py -n %d -i %s -m %s -c %s -o %s' % (perms, dm_fp, map_fp, category[0], perms_dir) + _build_seed_option(derive_seed(dir_seed, perms)))
+                                elif type(method) is MantelCorrelogram:
                                     in_dm_fps = ','.join((dm_fp, grad_dm_fp))
                                     cmds.append('compare_distance_matrices.py --method %s -n %d -i %s -o %s' % (method.DirectoryName, perms, in_dm_fps, perms_dir))
                                 elif type(method) is PearsonOrdinationCorrelation:
@@ -396,21 +911,127 @@ def _build_real_data_methods_commands(out_dir, workflow):
                                 else:
                                     cmds.append('compare_categories.py --method %s -i %s -m %s -c %s -o %s -n %d' % (method.DirectoryName, dm_fp, map_fp, category[0], perms_dir, perms))
 
+            if batch_mantel:
+                cmds.extend(_build_batch_mantel_commands(dir_to_process,
+                        workflow['categories'], num_perms, num_perm_jobs,
+                        dir_seed, text))
+
             if Best() in workflow['methods']:
                 best_dir = join(dir_to_process, Best().DirectoryName)
 
                 if not has_results(best_dir):
                     env_vars = ','.join(workflow['best_method_env_vars'])
                     cmds.append('compare_categories.py --method %s -i %s -m %s -c %s -o %s' % (Best().DirectoryName, dm_fp, map_fp, env_vars, best_dir))
+
+    if batch_metrics:
+        dirs_to_process = ['original'] + map(str, range(num_shuffled_trials))
+        for dir_to_process in dirs_to_process:
+            in_dirs = [join(data_type_dir, metric[0], dir_to_process)
+                       for metric in workflow['metrics']]
+            dir_seed = derive_seed(seed, 'real', dir_to_process)
+
+            for category in workflow['categories']:
+                for method in workflow['methods']:
+                    if not _is_batchable_across_metrics(method):
+                        continue
+
+                    for perms in num_perms:
+                        out_dirs = [join(in_dir, category[0],
+                                         method.DirectoryName, '%d' % perms)
+                                    for in_dir in in_dirs]
+                        cmds.extend(_build_batch_category_commands(method,
+                                in_dirs, out_dirs, category[0], perms,
+                                num_jobs=num_perm_jobs,
+                                seed=derive_seed(dir_seed, category[0],
+                                                 method.DirectoryName,
+                                                 perms),
+                                text=text))
+    return cmds
+
+def _build_batch_mantel_commands(in_dir, categories, num_perms, num_jobs=1,
+                                 seed=None, text=True):
+    cmds = []
+
+    dm_fp = join(in_dir, _get_dm_filename(text))
+    map_fp = join(in_dir, 'map.txt')
+
+    for perms in num_perms:
+        batch_categories = []
+        perms_dirs = []
+
+        for category in categories:
+            method_dir = join(in_dir, category[0], Mantel().DirectoryName)
+            perms_dir = join(method_dir, '%d' % perms)
+            create_dir(perms_dir)
+
+            if not has_results(perms_dir):
+                batch_categories.append(category[0])
+                perms_dirs.append(perms_dir)
+
+        if batch_categories:
+            cmd = 'batch_mantel.py -n %d -i %s -m %s -c %s -o %s' % (perms, dm_fp, map_fp, ','.join(batch_categories), ','.join(perms_dirs))
+            if num_jobs > 1:
+                cmd += ' --num_jobs %d' % num_jobs
+            cmds.append(cmd + _build_seed_option(derive_seed(seed, perms)))
+    return cmds
+
+def _is_batchable_across_metrics(method):
+    return type(method) is Anosim or type(method) is Permanova
+
+def _build_batch_category_commands(method, in_dirs, out_dirs, category,
+                                   num_perms, approximate=False, num_jobs=1,
+                                   seed=None, text=True):
+    cmds = []
+
+    dm_fps = []
+    results_dirs = []
+    for in_dir, out_dir in zip(in_dirs, out_dirs):
+        create_dir(out_dir)
+
+        if not has_results(out_dir):
+            dm_fps.append(join(in_dir, _get_dm_filename(text)))
+            results_dirs.append(out_dir)
+
+    # All metrics share the same samples, so we can use any of the mapping
+    # files.
+    if dm_fps:
+        map_fp = join(in_dirs[0], 'map.txt')
+        cmd = 'batch_compare_categories.py --method %s -i %s -m %s -c %s -o %s -n %d' % (method.DirectoryName, ','.join(dm_fps), map_fp, category, ','.join(results_dirs), num_perms)
+        if approximate:
+            cmd += ' --approximate'
+        elif num_jobs > 1 and num_perms > 0:
+            cmd += ' --num_jobs %d' % num_jobs
+        if not approximate and num_perms > 0:
+            cmd += _build_seed_option(seed)
+        cmds.append(cmd)
     return cmds
 
-def _build_simulated_data_methods_commands(out_dir, workflow):
+def _is_approximable(method):
+    return type(method) is Mantel or type(method) is Anosim
+
+def _build_simulated_data_methods_commands(out_dir, workflow, seed=None):
     cmds = []
 
     data_type_dir = join(out_dir, 'simulated')
 
     num_sim_data_trials = workflow['num_sim_data_trials']
     num_sim_data_perms = workflow['num_sim_data_perms']
+    batch_metrics = workflow.get('batch_metrics', False)
+
+    # If requested, approximate Mantel and ANOSIM p-values instead of
+    # performing permutations.
+    approx_p_values = workflow.get('approx_p_values', False)
+
+    # If requested, only compute effect sizes (i.e. no permutations) for
+    # dissimilarity levels that are only used in the method comparison
+    # heatmaps (which don't use p-values).
+    effect_size_only = workflow.get('heatmap_effect_sizes_only', False)
+
+    # num_permutation_jobs isn't used here: the simulated data's tests are
+    # small and many, and are already run in parallel with each other, so
+    # splitting them between processes would only oversubscribe the engines.
+
+    text = _writes_text_dms(workflow)
 
     for category in workflow['categories']:
         category_dir = join(data_type_dir, category[0])
@@ -424,10 +1045,15 @@ def _build_simulated_data_methods_commands(out_dir, workflow):
                 for d in workflow['dissim']:
                     dissim_dir = join(samp_size_dir, repr(d))
 
+                    heatmap_only = effect_size_only and \
+                                   d not in workflow['plot_dissim']
+                    dissim_seed = derive_seed(seed, 'simulated', category[0],
+                                              trial_num, samp_size, d)
+
                     for metric in workflow['metrics']:
                         metric_dir = join(dissim_dir, metric[0])
 
-                        dm_fp = join(metric_dir, 'dm.txt')
+                        dm_fp = join(metric_dir, _get_dm_filename(text))
                         pc_fp = join(metric_dir, 'pc.txt')
                         map_fp = join(metric_dir, 'map.txt')
                         grad_dm_fp = join(metric_dir,
@@ -438,11 +1064,21 @@ def _build_simulated_data_methods_commands(out_dir, workflow):
                         for method in workflow['methods']:
                             if type(method) is Best or type(method) is PartialMantel:
                                 continue
+                            if batch_metrics and _is_batchable_across_metrics(method):
+                                continue
                             method_dir = join(metric_dir, method.DirectoryName)
                             create_dir(method_dir)
 
                             if not has_results(method_dir):
-                                if type(method) is Mantel or type(method) is MantelCorrelogram:
+                                if heatmap_only and _is_effect_size_only_capable(method):
+                                    cmds.append(_build_effect_size_only_command(method, metric_dir, category[0], text))
+                                elif approx_p_values and type(method) is Mantel:
+                                    cmds.append('batch_mantel.py --approximate -i %s -m %s -c %s -o %s' % (dm_fp, map_fp, category[0], method_dir))
+                                elif approx_p_values and type(method) is Anosim:
+                                    cmds.append('batch_compare_categories.py --method %s --approximate -i %s -m %s -c %s -o %s' % (method.DirectoryName, dm_fp, map_fp, category[0], method_dir))
+                                elif type(method) is Mantel:
+                                    cmds.append('batch_mantel.py -n %d -i %s -m %s -c %s -o %s' % (num_sim_data_perms, dm_fp, map_fp, category[0], method_dir) + _build_seed_option(derive_seed(dissim_seed, metric[0])))
+                                elif type(method) is MantelCorrelogram:
                                     assert get_num_samples_in_distance_matrix(grad_dm_fp) == samp_size
                                     in_dm_fps = ','.join((dm_fp,
                                                           grad_dm_fp))
@@ -453,8 +1089,56 @@ def _build_simulated_data_methods_commands(out_dir, workflow):
                                     cmds.append('ordination_correlation.py -n %d -i %s -m %s -c %s -o %s -t spearman' % (num_sim_data_perms, pc_fp, map_fp, category[0], method_dir))
                                 else:
                                     cmds.append('compare_categories.py --method %s -i %s -m %s -c %s -o %s -n %d' % (method.DirectoryName, dm_fp, map_fp, category[0], method_dir, num_sim_data_perms))
+
+                    if batch_metrics:
+                        in_dirs = [join(dissim_dir, metric[0])
+                                   for metric in workflow['metrics']]
+
+                        for method in workflow['methods']:
+                            if _is_batchable_across_metrics(method):
+                                out_dirs = [join(in_dir, method.DirectoryName)
+                                            for in_dir in in_dirs]
+                                if heatmap_only:
+                                    perms = 0
+                                    approximate = False
+                                else:
+                                    perms = num_sim_data_perms
+                                    approximate = approx_p_values and \
+                                                  _is_approximable(method)
+                                cmds.extend(_build_batch_category_commands(
+                                        method, in_dirs, out_dirs, category[0],
+                                        perms, approximate,
+                                        seed=derive_seed(dissim_seed,
+                                                method.DirectoryName),
+                                        text=text))
     return cmds
 
+def _is_effect_size_only_capable(method):
+    """Returns True if method can be run without permutations.
+
+    The results of these methods can still be parsed when run with zero
+    permutations (the parsed p-value will be None).
+    """
+    return type(method) in (Mantel, Anosim, Permanova,
+                            PearsonOrdinationCorrelation,
+                            SpearmanOrdinationCorrelation)
+
+def _build_effect_size_only_command(method, in_dir, category, text=True):
+    dm_fp = join(in_dir, _get_dm_filename(text))
+    pc_fp = join(in_dir, 'pc.txt')
+    map_fp = join(in_dir, 'map.txt')
+    method_dir = join(in_dir, method.DirectoryName)
+
+    if type(method) is Mantel:
+        cmd = 'batch_mantel.py -n 0 -i %s -m %s -c %s -o %s' % (dm_fp, map_fp, category, method_dir)
+    elif type(method) is PearsonOrdinationCorrelation:
+        cmd = 'ordination_correlation.py -n 0 -i %s -m %s -c %s -o %s -t pearson' % (pc_fp, map_fp, category, method_dir)
+    elif type(method) is SpearmanOrdinationCorrelation:
+        cmd = 'ordination_correlation.py -n 0 -i %s -m %s -c %s -o %s -t spearman' % (pc_fp, map_fp, category, method_dir)
+    else:
+        cmd = 'batch_compare_categories.py --method %s -n 0 -i %s -m %s -c %s -o %s' % (method.DirectoryName, dm_fp, map_fp, category, method_dir)
+    return cmd
+
 def create_real_data_summary_tables(in_dir, workflow):
     """Summarizes the results of the various method runs on real data.
 
@@ -852,7 +1536,11 @@ def main():
                 'num_shuffled_trials': 5,
                 'methods': [Best(), Mantel(), MantelCorrelogram(), MoransI(),
                             PearsonOrdinationCorrelation(),
-                            SpearmanOrdinationCorrelation()]
+                            SpearmanOrdinationCorrelation()],
+                # Share Mantel permutations between PH and LATITUDE.
+                'batch_mantel': True,
+                # Don't run permutations for heatmap-only simulated data.
+                'heatmap_effect_sizes_only': True
             },
 
             'gn': {
@@ -909,7 +1597,11 @@ def main():
                 'pcoa_sample_size': 150,
                 'num_sim_data_trials': 10,
                 'num_shuffled_trials': 5,
-                'methods': [Adonis(), Anosim(), Mrpp(), Permanova(), Dbrda()]
+                'methods': [Adonis(), Anosim(), Mrpp(), Permanova(), Dbrda()],
+                # Share ANOSIM/PERMANOVA permutations between metrics.
+                'batch_metrics': True,
+                # Don't run permutations for heatmap-only simulated data.
+                'heatmap_effect_sizes_only': True
             },
 
             'whole_body': {
@@ -936,7 +1628,36 @@ def main():
                 'pcoa_sample_size': 140,
                 'num_sim_data_trials': 10,
                 'num_shuffled_trials': 5,
-                'methods': [Adonis(), Anosim(), Mrpp(), Permanova(), Dbrda()]
+                'methods': [Adonis(), Anosim(), Mrpp(), Permanova(), Dbrda()],
+                # Share ANOSIM/PERMANOVA permutations between metrics.
+                'batch_metrics': True,
+                # Approximate ANOSIM p-values for the (large) simulated data.
+                'approx_p_values': True,
+                # Split each real data test's permutations between processes.
+                # Each test is already a parallel job, so only raise this if
+                # the engines have cores to spare.
+                'num_permutation_jobs': 1,
+                # Write memory-mappable copies of the (large) distance
+                # matrices.
+                'binary_dms': True,
+                # Hardlink identical mapping files instead of copying them.
+                'dedup_artifacts': True,
+                # Simulate all dissimilarity levels from a single pass over
+                # the table and tree.
+                'in_process_simsam': True,
+                # Choose all subsets of the real data with a single command.
+                'batch_subsets': True,
+                # Store subsets of the real data as sample indices instead of
+                # writing them out.
+                'virtual_subsets': True,
+                # Choose subsets larger than the table before simulating
+                # them, and only simulate the replicates in the subsets.
+                'subset_before_simulating': True,
+                # Rarefy the table to all depths in a single pass.
+                'in_process_rarefaction': True,
+                # Seed every job from its own random stream so that rerunning
+                # any part of the workflow reproduces the same results.
+                'seed': 42
             }
         }
 
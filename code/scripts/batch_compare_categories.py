@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from os.path import join
+from qiime.format import format_anosim_results, format_permanova_results
+from qiime.util import (create_dir, MetadataMap, parse_command_line_parameters,
+                        make_option)
+
+from microbiogeo.stats import (anosim_multi, APPROXIMATION_NOTE,
+                               CATEGORY_METHODS, permanova_multi)
+from microbiogeo.util import (intersect_distance_matrices,
+                              parse_distance_matrix)
+
+script_info = {}
+script_info['brief_description'] = ("Runs a categorical method on several "
+                                    "distance matrices at once")
+script_info['script_description'] = """
+This script runs ANOSIM or PERMANOVA on several distance matrices (e.g. \
+computed using different metrics) that share the same samples and grouping. \
+Each permutation of the grouping is applied to all of the distance matrices \
+at the same time, so this is much faster than running compare_categories.py \
+once for each distance matrix. Only samples that are in all of the input \
+distance matrices are used in the tests.
+
+A results file (in the same format as compare_categories.py) is written to \
+each output directory.
+
+If --approximate is provided (ANOSIM only), no permutations are performed. \
+Instead, p-values are computed from a Pearson type III distribution fit to \
+the exact mean, variance, and skewness of the permutation distribution. The \
+results files will start with a comment line noting this, and the number of \
+permutations will be reported as zero.
+"""
+script_info['script_usage'] = [("ANOSIM on three metrics",
+    "Run ANOSIM on the unweighted UniFrac, weighted UniFrac, and Bray-Curtis "
+    "distance matrices using the Treatment category.",
+    "%prog --method anosim -i uu_dm.txt,wu_dm.txt,bc_dm.txt -m map.txt -c "
+    "Treatment -o uu_out,wu_out,bc_out")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('--method', type='choice', choices=CATEGORY_METHODS,
+        help='the categorical method to run. Valid choices: ' +
+             ', '.join(CATEGORY_METHODS)),
+    make_option('-i','--input_dms', type='existing_filepaths',
+        help='the input distance matrices, comma-separated'),
+    make_option('-m','--map_fp', type='existing_filepath',
+        help='the metadata mapping file'),
+    make_option('-c', '--category', type='string',
+        help='the category in the mapping file to group samples by'),
+    make_option('-o','--output_dirs', type='string',
+        help='the output directories, comma-separated (one for each input '
+             'distance matrix)')
+]
+script_info['optional_options'] = [
+    make_option('-n','--num_permutations', type='int',
+        help='the number of permutations to perform [default: %default]',
+        default=999),
+    make_option('--approximate', action='store_true',
+        help='approximate the p-values instead of performing permutations. '
+             'Only supported with ANOSIM [default: %default]', default=False),
+    make_option('--seed', type='int',
+        help='the seed for the random number generator. If provided, the '
+             'p-values will be the same for any number of jobs [default: '
+             'random seed]', default=None),
+    make_option('--num_jobs', type='int',
+        help='the number of processes to split the permutations between '
+             '[default: %default]', default=1)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.num_jobs < 1:
+        option_parser.error("The number of jobs must be greater than zero.")
+
+    if opts.approximate and opts.method != 'anosim':
+        option_parser.error("Approximate p-values are only supported with "
+                            "ANOSIM.")
+
+    output_dirs = opts.output_dirs.split(',')
+    if len(output_dirs) != len(opts.input_dms):
+        option_parser.error("You must provide exactly one output directory "
+                            "for each input distance matrix.")
+
+    labels, dms_data = intersect_distance_matrices(
+            [parse_distance_matrix(dm_fp, condensed=True)
+             for dm_fp in opts.input_dms])
+
+    md_map = MetadataMap.parseMetadataMap(open(opts.map_fp, 'U'))
+    if opts.category not in md_map.CategoryNames:
+        option_parser.error("Category '%s' not found in mapping file columns."
+                            % opts.category)
+    grouping = [md_map.getCategoryValue(samp_id, opts.category)
+                for samp_id in labels]
+
+    if opts.method == 'anosim':
+        results = anosim_multi(dms_data, grouping, opts.num_permutations,
+                               approximate=opts.approximate, seed=opts.seed,
+                               num_jobs=opts.num_jobs)
+        method_name = 'ANOSIM'
+        stat_key = 'r_value'
+        format_fn = format_anosim_results
+    elif opts.method == 'permanova':
+        results = permanova_multi(dms_data, grouping, opts.num_permutations,
+                                  seed=opts.seed, num_jobs=opts.num_jobs)
+        method_name = 'PERMANOVA'
+        stat_key = 'f_value'
+        format_fn = format_permanova_results
+
+    for output_dir, (stat, p_value) in zip(output_dirs, results):
+        create_dir(output_dir)
+
+        if opts.approximate:
+            # The QIIME formatting functions won't report a p-value without
+            # permutations.
+            header, _ = format_fn({'method_name': method_name, stat_key: stat,
+                                   'p_value': p_value,
+                                   'num_perms': 0}).split('\n', 1)
+            formatted_results = '%s\n%s\n%s\t%.4f\t%.6g\t0\n' % (
+                    APPROXIMATION_NOTE, header, method_name, stat, p_value)
+        else:
+            formatted_results = format_fn({'method_name': method_name,
+                                           stat_key: stat,
+                                           'p_value': p_value,
+                                           'num_perms': opts.num_permutations})
+
+        with open(join(output_dir, '%s_results.txt' % opts.method),
+                  'w') as output_f:
+            output_f.write(formatted_results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from os.path import join
+from qiime.format import format_p_value_for_num_iters
+from qiime.util import create_dir, parse_command_line_parameters, make_option
+
+from microbiogeo.stats import APPROXIMATION_NOTE, mantel_multi, TAIL_TYPES
+from microbiogeo.util import (compute_gradient_dm, intersect_distance_matrices,
+                              parse_distance_matrix)
+
+script_info = {}
+script_info['brief_description'] = ("Runs Mantel tests of one distance "
+                                    "matrix against several others")
+script_info['script_description'] = """
+This script runs a Mantel test of a single (e.g. community) distance matrix \
+against each of several other (e.g. gradient) distance matrices. Each \
+permutation of the first distance matrix is shared between all of the tests, \
+so this is much faster than running compare_distance_matrices.py once for \
+each pair of matrices. Only samples that are in all of the input distance \
+matrices are used in the tests.
+
+Instead of providing gradient distance matrices, a mapping file and one or \
+more (numeric) categories can be provided. Each category's gradient distance \
+matrix is computed in memory (in the same way as \
+distance_matrix_from_mapping.py), so it never has to be written to disk.
+
+A mantel_results.txt file (in the same format as \
+compare_distance_matrices.py --method mantel) is written to each output \
+directory.
+
+If --approximate is provided, no permutations are performed. Instead, \
+p-values are computed from a Pearson type III distribution fit to the exact \
+mean, variance, and skewness of the permutation distribution. The results \
+files will start with a comment line noting this, and the number of \
+permutations will be reported as zero.
+"""
+script_info['script_usage'] = [("Test community against two gradients",
+    "Test the community distance matrix against the pH and latitude distance "
+    "matrices, writing the results to two separate directories.",
+    "%prog -i dm.txt -g PH_dm.txt,LATITUDE_dm.txt -o PH_out,LATITUDE_out"),
+                               ("Test community against two categories",
+    "Same as above, but compute the pH and latitude distance matrices from "
+    "the mapping file.",
+    "%prog -i dm.txt -m map.txt -c PH,LATITUDE -o PH_out,LATITUDE_out")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--input_dm', type='existing_filepath',
+        help='the distance matrix to permute'),
+    make_option('-o','--output_dirs', type='string',
+        help='the output directories, comma-separated (one for each '
+             'gradient distance matrix or category)')
+]
+script_info['optional_options'] = [
+    make_option('-g','--gradient_dms', type='existing_filepaths',
+        help='the distance matrices to test the input distance matrix '
+             'against, comma-separated. Either this or -m/--mapping_fp and '
+             '-c/--categories must be provided [default: %default]',
+        default=None),
+    make_option('-m','--mapping_fp', type='existing_filepath',
+        help='the mapping file containing the categories to compute '
+             'gradient distance matrices from [default: %default]',
+        default=None),
+    make_option('-c','--categories', type='string',
+        help='the numeric mapping file categories to test the input distance '
+             'matrix against, comma-separated [default: %default]',
+        default=None),
+    make_option('-n','--num_permutations', type='int',
+        help='the number of permutations to perform [default: %default]',
+        default=999),
+    make_option('-t', '--tail_type', type='choice', choices=TAIL_TYPES,
+        help='the type of tail test to perform when calculating the p-value. '
+             'Valid choices: ' + ', '.join(TAIL_TYPES) +
+             ' [default: %default]', default='two sided'),
+    make_option('--approximate', action='store_true',
+        help='approximate the p-values instead of performing permutations '
+             '[default: %default]', default=False),
+    make_option('--seed', type='int',
+        help='the seed for the random number generator. If provided, the '
+             'p-values will be the same for any number of jobs [default: '
+             'random seed]', default=None),
+    make_option('--num_jobs', type='int',
+        help='the number of processes to split the permutations between '
+             '[default: %default]', default=1)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.num_jobs < 1:
+        option_parser.error("The number of jobs must be greater than zero.")
+
+    if (opts.mapping_fp is None) != (opts.categories is None):
+        option_parser.error("You must provide both -m/--mapping_fp and "
+                            "-c/--categories, or neither.")
+    if (opts.gradient_dms is None) == (opts.categories is None):
+        option_parser.error("You must provide either -g/--gradient_dms or "
+                            "-m/--mapping_fp and -c/--categories.")
+
+    # The native methods don't need the distance matrix in square form.
+    dms = [parse_distance_matrix(opts.input_dm, condensed=True)]
+    if opts.gradient_dms is not None:
+        grad_names = opts.gradient_dms
+        for grad_dm_fp in opts.gradient_dms:
+            dms.append(parse_distance_matrix(grad_dm_fp))
+    else:
+        grad_names = opts.categories.split(',')
+        with open(opts.mapping_fp, 'U') as map_f:
+            map_lines = map_f.readlines()
+        for category in grad_names:
+            dms.append(compute_gradient_dm(map_lines, category))
+
+    output_dirs = opts.output_dirs.split(',')
+    if len(output_dirs) != len(grad_names):
+        option_parser.error("You must provide exactly one output directory "
+                            "for each gradient distance matrix or category.")
+
+    labels, dms_data = intersect_distance_matrices(dms)
+
+    header = ['DM1', 'DM2', 'Number of entries', 'Mantel r statistic',
+              'p-value', 'Number of permutations', 'Tail type']
+
+    if len(labels) < 3:
+        results = [None] * len(grad_names)
+    else:
+        results = mantel_multi(dms_data[0], dms_data[1:],
+                               opts.num_permutations, opts.tail_type,
+                               approximate=opts.approximate, seed=opts.seed,
+                               num_jobs=opts.num_jobs)
+
+    if opts.approximate:
+        num_perms = 0
+    else:
+        num_perms = opts.num_permutations
+
+    for grad_name, output_dir, result in zip(grad_names, output_dirs,
+                                             results):
+        create_dir(output_dir)
+
+        with open(join(output_dir, 'mantel_results.txt'), 'w') as output_f:
+            if opts.approximate:
+                output_f.write(APPROXIMATION_NOTE + '\n')
+            output_f.write('\t'.join(header) + '\n')
+
+            if result is None:
+                output_f.write('%s\t%s\t%d\tToo few samples\n' %
+                               (opts.input_dm, grad_name, len(labels)))
+            else:
+                r_value, p_value = result
+
+                if opts.approximate:
+                    p_value = '%.6g' % p_value
+                else:
+                    p_value = format_p_value_for_num_iters(p_value, num_perms)
+                output_f.write('%s\t%s\t%d\t%.5f\t%s\t%d\t%s\n' % (
+                        opts.input_dm, grad_name, len(labels), r_value,
+                        p_value, num_perms, opts.tail_type))
+
+
+if __name__ == "__main__":
+    main()
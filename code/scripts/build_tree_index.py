@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from biom.parse import parse_biom_table
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.tree import parse_flat_tree, TreeNeighborhoodIndex
+
+script_info = {}
+script_info['brief_description'] = ("Builds a tree neighborhood index for "
+                                    "simulating tables")
+script_info['script_description'] = """
+This script precomputes, for each OTU in the input table, the distance up the \
+tree to each of the OTU's ancestors and the range of tips below each \
+ancestor. This is all simulate_tables.py needs to find the tips that an OTU \
+can be replaced by at any dissimilarity, so the index can be passed to \
+simulate_tables.py (-x/--tree_index) instead of the tree, and the (large) \
+tree only has to be parsed once for any number of simulations.
+
+The index is only valid for the tree it was built from, and for tables whose \
+OTUs are all in the input table (e.g. subsets of it).
+"""
+script_info['script_usage'] = [("Build an index",
+    "Build an index for the OTUs in table.biom.",
+    "%prog -i table.biom -t tree.tre -o tree_index.npz")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--otu_table', type='existing_filepath',
+        help='the OTU table containing the OTUs to index'),
+    make_option('-t','--tree_file', type='existing_filepath',
+        help='the tree containing the OTUs in the input table'),
+    make_option('-o','--output_fp', type='new_filepath',
+        help='the output index filepath (a numpy .npz file)')
+]
+script_info['optional_options'] = []
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    with open(opts.otu_table, 'U') as table_f:
+        table = parse_biom_table(table_f)
+    with open(opts.tree_file, 'U') as tree_f:
+        tree = parse_flat_tree(tree_f)
+
+    index = TreeNeighborhoodIndex.fromTree(tree, table.ObservationIds)
+    with open(opts.output_fp, 'wb') as index_f:
+        index.save(index_f)
+
+
+if __name__ == "__main__":
+    main()
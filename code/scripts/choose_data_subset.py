@@ -9,53 +9,150 @@ __version__ = "0.0.0-dev"
 __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 
-from os.path import basename, join
+from os.path import basename, exists, join
+from biom.parse import parse_biom_table
 from qiime.util import create_dir, parse_command_line_parameters, make_option
 
-from microbiogeo.simulate import choose_cluster_subsets, choose_gradient_subset
+from microbiogeo.simulate import choose_data_subsets, get_replicate_samp_ids
+from microbiogeo.util import parse_subset_index, write_subset_index
 
 script_info = {}
 script_info['brief_description'] = ""
-script_info['script_description'] = ""
-script_info['script_usage'] = []
+script_info['script_description'] = """
+Several subsets can be chosen at once by providing comma-separated subset \
+sizes and output directories (and optionally categories), one for each \
+subset. The table and mapping file are only parsed once.
+
+If --subset_index is provided, no tables or mapping files are written. \
+Instead, the samples in each subset are added to a single subset index file \
+(under the output directory's name), which simulate_tables.py can use \
+directly with the input table and mapping file.
+
+If --num_replicates is also provided, the subsets are chosen from that many \
+replicates of each sample (named as simulate_tables.py names them) instead of \
+from the samples themselves. The replicates don't need to be simulated \
+first: simulate_tables.py only simulates the replicates that are in the \
+subset.
+"""
+script_info['script_usage'] = [("Choose several subsets",
+    "Choose two subsets of 10 samples and one of 20 samples along the pH "
+    "gradient.",
+    "%prog -t gradient -i table.biom -m map.txt -c PH -n 10,10,20 "
+    "-o 0/10,1/10,0/20"),
+                               ("Index several subsets",
+    "Same as above, but add the subsets to subsets.npz instead of writing "
+    "them out.",
+    "%prog -t gradient -i table.biom -m map.txt -c PH -n 10,10,20 "
+    "-o 0/10,1/10,0/20 --subset_index subsets.npz"),
+                               ("Index subsets of replicates",
+    "Choose a subset of 50 samples from 3 replicates of each sample (the "
+    "input table has fewer than 50 samples).",
+    "%prog -t gradient -i table.biom -m map.txt -c PH -n 50 -o 0/50 "
+    "--subset_index subsets_n3.npz --num_replicates 3")]
 script_info['output_description'] = ""
 script_info['required_options'] = [
     make_option('-t','--type', type='choice', choices=['gradient', 'cluster'],
                 help=''),
     make_option('-i','--otu_table_fp', type='existing_filepath', help=''),
     make_option('-m','--map_fp', type='existing_filepath', help=''),
-    make_option('-c', '--category', type='string', help=''),
-    make_option('-n', '--num_total_samples', type='int', help=''),
-    make_option('-o','--output_dir', type='new_dirpath', help='')
+    make_option('-c', '--category', type='string',
+        help='the category to choose subsets from, or comma-separated '
+             'categories (one for each output directory)'),
+    make_option('-n', '--num_total_samples', type='string',
+        help='the subset size, or comma-separated subset sizes (one for each '
+             'output directory)'),
+    make_option('-o','--output_dir', type='string',
+        help='the output directory, or comma-separated output directories '
+             '(one for each subset)')
+]
+script_info['optional_options'] = [
+    make_option('--seed', type='string',
+        help='the seed for the random number generator, or comma-separated '
+             'seeds (one for each output directory, so that each subset is '
+             'chosen from its own random stream) [default: random seed]',
+        default=None),
+    make_option('--subset_index', type='new_filepath',
+        help='the subset index to add the subsets to (created if it doesn\'t '
+             'exist), instead of writing subset tables and mapping files '
+             '[default: %default]', default=None),
+    make_option('--num_replicates', type='int',
+        help='the number of replicates of each sample to choose the subsets '
+             'from. Requires --subset_index [default: the samples '
+             'themselves]', default=None)
 ]
-script_info['optional_options'] = []
 script_info['version'] = __version__
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    out_dir = opts.output_dir
-    create_dir(out_dir)
+    out_dirs = opts.output_dir.split(',')
+    categories = opts.category.split(',')
+    if len(categories) == 1:
+        categories *= len(out_dirs)
+    samp_sizes = map(int, opts.num_total_samples.split(','))
+    if len(samp_sizes) == 1:
+        samp_sizes *= len(out_dirs)
+
+    if len(categories) != len(out_dirs) or len(samp_sizes) != len(out_dirs):
+        option_parser.error("You must provide a single category and subset "
+                            "size, or one for each output directory.")
+
+    if opts.num_replicates is not None and opts.subset_index is None:
+        option_parser.error("--num_replicates requires --subset_index.")
+
+    random_state = None
+    if opts.seed is not None:
+        random_state = map(int, opts.seed.split(','))
+        if len(random_state) == 1:
+            random_state = random_state[0]
+        elif len(random_state) != len(out_dirs):
+            option_parser.error("You must provide a single seed, or one for "
+                                "each output directory.")
+
+    with open(opts.otu_table_fp, 'U') as otu_table_f:
+        otu_table = parse_biom_table(otu_table_f)
+
+    materialize = opts.subset_index is None
+    with open(opts.map_fp, 'U') as map_f:
+        subsets = choose_data_subsets(opts.type, otu_table, map_f,
+                                      zip(categories, samp_sizes),
+                                      materialize=materialize,
+                                      random_state=random_state,
+                                      num_replicates=opts.num_replicates)
+
+    if not materialize:
+        samp_ids = list(otu_table.SampleIds)
+        if opts.num_replicates is not None:
+            samp_ids = get_replicate_samp_ids(samp_ids, opts.num_replicates)
+        indexed_subsets = {}
+        if exists(opts.subset_index):
+            indexed_samp_ids, indexed_subsets = \
+                    parse_subset_index(opts.subset_index)
+            if indexed_samp_ids != samp_ids:
+                option_parser.error("The existing subset index was created "
+                                    "from a different table.")
+
+            for name, samp_idxs in indexed_subsets.items():
+                indexed_subsets[name] = [samp_ids[idx] for idx in samp_idxs]
 
-    if opts.type == 'gradient':
-        subset_fn = choose_gradient_subset
-    elif opts.type == 'cluster':
-        subset_fn = choose_cluster_subsets
+        indexed_subsets.update(zip(out_dirs, subsets))
+        write_subset_index(opts.subset_index, samp_ids, indexed_subsets)
+        return
 
-    subset_otu_table, subset_map_str = subset_fn(open(opts.otu_table_fp, 'U'),
-            open(opts.map_fp, 'U'), opts.category, opts.num_total_samples)
+    for out_dir, (subset_otu_table, subset_map_str) in zip(out_dirs, subsets):
+        create_dir(out_dir)
 
-    subset_otu_table_fp = join(out_dir, basename(opts.otu_table_fp))
-    subset_otu_table_f = open(subset_otu_table_fp, 'w')
-    subset_otu_table.getBiomFormatJsonString('choose_data_subset.py '
-                                             '(microbiogeo)',
-                                             subset_otu_table_f)
-    subset_otu_table_f.close()
+        subset_otu_table_fp = join(out_dir, basename(opts.otu_table_fp))
+        subset_otu_table_f = open(subset_otu_table_fp, 'w')
+        subset_otu_table.getBiomFormatJsonString('choose_data_subset.py '
+                                                 '(microbiogeo)',
+                                                 subset_otu_table_f)
+        subset_otu_table_f.close()
 
-    subset_map_fp = join(out_dir, basename(opts.map_fp))
-    subset_map_f = open(subset_map_fp, 'w')
-    subset_map_f.write(subset_map_str)
-    subset_map_f.close()
+        subset_map_fp = join(out_dir, basename(opts.map_fp))
+        subset_map_f = open(subset_map_fp, 'w')
+        subset_map_f.write(subset_map_str)
+        subset_map_f.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from biom.parse import parse_biom_table
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.distance import (compute_distance_matrices, METRICS,
+                                  PHYLOGENETIC_METRICS)
+from microbiogeo.tree import parse_flat_tree
+from microbiogeo.util import write_distance_matrix
+
+script_info = {}
+script_info['brief_description'] = ("Computes distance matrices from an OTU "
+                                    "table")
+script_info['script_description'] = """
+This script computes one or more distance matrices from an OTU table using \
+native (vectorized) implementations of beta diversity metrics. The OTU table \
+is only parsed once, and is stored as a sparse matrix. If any phylogenetic \
+metrics are requested, the tree is also only parsed once, and is converted \
+into flat arrays that the per-sample abundances are summed up in a \
+vectorized fashion. The output distance matrices are the same as those \
+created by beta_diversity.py.
+
+Output filepaths ending in .npy are written in binary form: the distances are \
+saved as a numpy array (e.g. dm.npy) that can be memory-mapped by later \
+steps, and the sample IDs are saved to a sidecar file (e.g. dm_ids.txt). All \
+other output filepaths are written as text, and -b/--binary additionally \
+writes the binary form alongside each text file. Scripts that read distance \
+matrices will use the binary form if it is present.
+
+--condensed stores the binary form as the upper triangle of each distance \
+matrix in single precision, which is about an eighth of the size of the full \
+matrix. It is expanded back to a square matrix when it is read, except by \
+steps that can work with it directly (e.g. slicing and the native \
+statistical methods). Single precision distances are only accurate to about \
+seven significant digits.
+
+Supported metrics: %s
+""" % ', '.join(METRICS)
+script_info['script_usage'] = [("Bray-Curtis",
+    "Compute a Bray-Curtis distance matrix.",
+    "%prog -i otu_table.biom -m bray_curtis -o bray_curtis_dm.txt"),
+                               ("UniFrac",
+    "Compute unweighted and weighted UniFrac distance matrices in a single "
+    "pass over the tree.",
+    "%prog -i otu_table.biom -m unweighted_unifrac,weighted_unifrac -t "
+    "rep_set.tre -o uu_dm.txt,wu_dm.txt")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--otu_table_fp', type='existing_filepath',
+        help='the input OTU table'),
+    make_option('-m','--metrics', type='string',
+        help='the metrics to compute, comma-separated. Valid choices: ' +
+             ', '.join(METRICS)),
+    make_option('-o','--output_fps', type='string',
+        help='the output distance matrix filepaths, comma-separated (one for '
+             'each metric)')
+]
+script_info['optional_options'] = [
+    make_option('-t','--tree_fp', type='existing_filepath',
+        help='the input tree (required for phylogenetic metrics) '
+             '[default: %default]', default=None),
+    make_option('-b','--binary', action='store_true',
+        help='also write each output distance matrix in binary form '
+             '[default: %default]', default=False),
+    make_option('--condensed', action='store_true',
+        help='write the binary form in condensed, single-precision form '
+             '(implies -b/--binary) [default: %default]', default=False)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    metrics = opts.metrics.split(',')
+    for metric in metrics:
+        if metric not in METRICS:
+            option_parser.error("Unknown metric '%s'. Valid choices: %s" %
+                                (metric, ', '.join(METRICS)))
+
+    tree = None
+    if set(metrics) & set(PHYLOGENETIC_METRICS):
+        if opts.tree_fp is None:
+            option_parser.error("You must provide a tree to compute "
+                                "phylogenetic metrics.")
+
+        with open(opts.tree_fp, 'U') as tree_f:
+            tree = parse_flat_tree(tree_f)
+
+    output_fps = opts.output_fps.split(',')
+    if len(output_fps) != len(metrics):
+        option_parser.error("You must provide exactly one output filepath for "
+                            "each metric.")
+
+    with open(opts.otu_table_fp, 'U') as table_f:
+        table = parse_biom_table(table_f)
+
+    samp_ids, dms = compute_distance_matrices(table, metrics, tree)
+
+    for output_fp, dm in zip(output_fps, dms):
+        write_distance_matrix(output_fp, samp_ids, dm, opts.binary,
+                              opts.condensed)
+
+
+if __name__ == "__main__":
+    main()
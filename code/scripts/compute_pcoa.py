@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from qiime.format import format_coords
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.pcoa import DEFAULT_NUM_AXES, pcoa
+from microbiogeo.util import parse_distance_matrix
+
+script_info = {}
+script_info['brief_description'] = ("Computes the leading principal "
+                                    "coordinates of a distance matrix")
+script_info['script_description'] = """
+This script performs principal coordinates analysis (PCoA) on a distance \
+matrix, but only computes the leading axes instead of performing a full \
+eigendecomposition. The output is in the same format as \
+principal_coordinates.py's output and contains the requested number of axes. \
+The percent variation explained by each axis is computed relative to the sum \
+of all eigenvalues (the trace of the centered matrix).
+"""
+script_info['script_usage'] = [("PCoA",
+    "Compute the first three principal coordinates.",
+    "%prog -i dm.txt -o pc.txt")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--input_distance_matrix', type='existing_filepath',
+        help='the input distance matrix'),
+    make_option('-o','--output_fp', type='new_filepath',
+        help='the output coordinates filepath')
+]
+script_info['optional_options'] = [
+    make_option('-n','--num_axes', type='int',
+        help='the number of axes to compute [default: %default]',
+        default=DEFAULT_NUM_AXES)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.num_axes < 1:
+        option_parser.error("The number of axes must be greater than zero.")
+
+    samp_ids, dm_data = parse_distance_matrix(opts.input_distance_matrix)
+
+    coords, eigvals, pct_var = pcoa(dm_data, opts.num_axes)
+
+    with open(opts.output_fp, 'w') as output_f:
+        output_f.write(format_coords(samp_ids, coords, eigvals, pct_var))
+        output_f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
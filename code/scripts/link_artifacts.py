@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.util import link_artifact
+
+script_info = {}
+script_info['brief_description'] = ("Copies a file to several places using a "
+                                    "deduplicating artifact store")
+script_info['script_description'] = """
+This script stores a copy of a file in a content-addressed artifact store \
+directory (under the SHA-1 hash of its contents), and creates each output \
+filepath as a hardlink to the stored copy. The input file isn't modified. \
+Identical files (e.g. the same mapping file copied into many directories) are \
+therefore only written once and share a single inode, but still appear as \
+regular files to anything that reads them.
+
+Files are copied instead of hardlinked if the artifact store is on a \
+different filesystem. Linked files must not be modified in place, since the \
+change would be seen through every link.
+"""
+script_info['script_usage'] = [("Copy a mapping file",
+    "Make bray_curtis/map.txt and unweighted_unifrac/map.txt identical to "
+    "map.txt, storing a single copy in artifacts/.",
+    "%prog -i map.txt -o bray_curtis/map.txt,unweighted_unifrac/map.txt "
+    "-s artifacts")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--input_fp', type='existing_filepath',
+        help='the file to copy'),
+    make_option('-o','--output_fps', type='string',
+        help='the filepaths to link to the stored copy, comma-separated'),
+    make_option('-s','--store_dir', type='new_dirpath',
+        help='the artifact store directory (created if it doesn\'t exist)')
+]
+script_info['optional_options'] = []
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    link_artifact(opts.input_fp, opts.output_fps.split(','), opts.store_dir)
+
+
+if __name__ == "__main__":
+    main()
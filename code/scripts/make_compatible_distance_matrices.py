@@ -10,11 +10,11 @@ __maintainer__ = "Jai Ram Rideout"
 __email__ = "jr378@nau.edu"
 __status__ = "Development"
  
-from qiime.format import format_distance_matrix
-from qiime.parse import parse_distmat
 from qiime.util import make_compatible_distance_matrices, make_option, \
     parse_command_line_parameters
 
+from microbiogeo.util import parse_distance_matrix, write_distance_matrix
+
 script_info = {}
 script_info['brief_description'] = """
 Makes two distance matrices compatible based on sample IDs
@@ -64,21 +64,14 @@ def main():
         option_parser.error("You must provide exactly two input and output "
             "distance matrix filepaths.")
 
-    labels1, dm1_data = parse_distmat(open(input_dm_fps[0], 'U'))
-    labels2, dm2_data = parse_distmat(open(input_dm_fps[1], 'U'))
-
     (dm1_labels, dm1), (dm2_labels, dm2) = make_compatible_distance_matrices(
-        parse_distmat(open(input_dm_fps[0],'U')),
-        parse_distmat(open(input_dm_fps[1],'U')))
+        parse_distance_matrix(input_dm_fps[0]),
+        parse_distance_matrix(input_dm_fps[1]))
     assert (dm1_labels == dm2_labels), "The order of sample IDs is not the " +\
         "same for the two matrices."
 
-    output1_f = open(output_dm_fps[0], 'w')
-    output2_f = open(output_dm_fps[1], 'w')
-    output1_f.write(format_distance_matrix(dm1_labels, dm1))
-    output2_f.write(format_distance_matrix(dm2_labels, dm2))
-    output1_f.close()
-    output2_f.close()
+    write_distance_matrix(output_dm_fps[0], dm1_labels, dm1)
+    write_distance_matrix(output_dm_fps[1], dm2_labels, dm2)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from biom.parse import parse_biom_table
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.tree import parse_flat_tree, TreeNeighborhoodIndex
+
+script_info = {}
+script_info['brief_description'] = ("Prunes a tree to the OTUs in an OTU "
+                                    "table")
+script_info['script_description'] = """
+This script removes all tips from a tree that are not OTUs in the input OTU \
+table. Internal nodes that are left with a single child are collapsed, and \
+their branch lengths are added to their child's branch length. Distances \
+between the remaining tips are unchanged, so UniFrac distances computed \
+using the pruned tree are the same as those computed using the full tree, \
+but the pruned tree is much faster to parse and traverse.
+
+If a dissimilarity is provided, the tips in each OTU's neighborhood at that \
+dissimilarity (the tips that simsam.py and simulate_tables.py can replace \
+the OTU with) are also kept, so the pruned tree can be used to compute \
+distances between samples simulated from the OTU table at that \
+dissimilarity or any lower one.
+"""
+script_info['script_usage'] = [("Prune tree",
+    "Prune the tree to the OTUs in otu_table.biom.",
+    "%prog -i otu_table.biom -t rep_set.tre -o pruned_rep_set.tre"),
+                               ("Prune tree for simulated data",
+    "Prune the tree to the OTUs in otu_table.biom and the tips that they can "
+    "be replaced by when simulating samples at a dissimilarity of 0.1.",
+    "%prog -i otu_table.biom -t rep_set.tre -o simulated_rep_set.tre -d 0.1")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--otu_table_fp', type='existing_filepath',
+        help='the input OTU table'),
+    make_option('-t','--tree_fp', type='existing_filepath',
+        help='the input tree'),
+    make_option('-o','--output_fp', type='new_filepath',
+        help='the output pruned tree filepath')
+]
+script_info['optional_options'] = [
+    make_option('-d','--dissim', type='float', default=None,
+        help='also keep the tips in each OTU\'s neighborhood at this '
+        'dissimilarity [default: %default]')
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    with open(opts.otu_table_fp, 'U') as table_f:
+        table = parse_biom_table(table_f)
+
+    with open(opts.tree_fp, 'U') as tree_f:
+        tree = parse_flat_tree(tree_f)
+
+    tip_names = table.ObservationIds
+    if opts.dissim is not None:
+        index = TreeNeighborhoodIndex.fromTree(tree, tip_names)
+        tip_names = set(tip_names) | \
+                    set(index.getNeighborhoodTips(opts.dissim, tip_names))
+    pruned_tree = tree.prune(tip_names)
+
+    with open(opts.output_fp, 'w') as output_f:
+        output_f.write(pruned_tree.getNewick())
+        output_f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
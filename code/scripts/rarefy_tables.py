@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from os.path import dirname
+
+from biom.parse import parse_biom_table
+from biom.table import table_factory
+from qiime.util import create_dir, parse_command_line_parameters, make_option
+
+from microbiogeo.rarefaction import rarefy_tables
+from microbiogeo.util import derive_seed
+
+script_info = {}
+script_info['brief_description'] = ("Rarefies a table to several depths in "
+                                    "a single pass")
+script_info['script_description'] = """
+This script creates the same kind of even-depth tables as \
+single_rarefaction.py, but the table is only parsed once, and each depth is \
+subsampled for all samples at once (single_rarefaction.py reparses the table \
+for each depth).
+
+As with single_rarefaction.py, samples with fewer sequences than the depth \
+are removed, as are OTUs that aren't in any of the remaining samples.
+"""
+script_info['script_usage'] = [("Rarefy to three depths",
+    "Rarefy a table to 100, 500 and 1000 sequences per sample.",
+    "%prog -i table.biom -d 100,500,1000 "
+    "-o 100/table.biom,500/table.biom,1000/table.biom")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--otu_table', type='existing_filepath',
+        help='the input OTU table'),
+    make_option('-d','--depths', type='string',
+        help='the depths to rarefy to, comma-separated'),
+    make_option('-o','--output_fps', type='string',
+        help='the output filepaths, comma-separated (one for each depth)')
+]
+script_info['optional_options'] = [
+    make_option('--seed', type='int',
+        help='the seed for the random number generator. Each depth is '
+             'rarefied from its own random stream (derived from the seed and '
+             'the depth), so a table only depends on the seed and its depth '
+             '[default: random seed]', default=None)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    depths = map(int, opts.depths.split(','))
+    output_fps = opts.output_fps.split(',')
+    if len(output_fps) != len(depths):
+        option_parser.error("You must provide exactly one output filepath for "
+                            "each depth.")
+
+    with open(opts.otu_table, 'U') as table_f:
+        table = parse_biom_table(table_f)
+
+    samp_md = None
+    if table.SampleMetadata is not None:
+        samp_md = dict(zip(table.SampleIds, table.SampleMetadata))
+    otu_md = None
+    if table.ObservationMetadata is not None:
+        otu_md = dict(zip(table.ObservationIds, table.ObservationMetadata))
+
+    for output_fp, (samp_ids, otu_ids, counts) in zip(output_fps,
+            rarefy_tables(table, depths, [derive_seed(opts.seed, depth)
+                                          for depth in depths])):
+        if dirname(output_fp):
+            create_dir(dirname(output_fp))
+
+        counts = counts.tocoo()
+        rare_table = table_factory([[otu_idx, samp_idx, int(count)]
+                                    for samp_idx, otu_idx, count in
+                                    zip(counts.row, counts.col, counts.data)],
+                                   samp_ids, otu_ids,
+                                   sample_metadata=None if samp_md is None
+                                   else [samp_md[samp_id]
+                                         for samp_id in samp_ids],
+                                   observation_metadata=None if otu_md is None
+                                   else [otu_md[otu_id]
+                                         for otu_id in otu_ids])
+
+        with open(output_fp, 'w') as table_f:
+            rare_table.getBiomFormatJsonString('rarefy_tables.py '
+                                               '(microbiogeo)', table_f)
+
+
+if __name__ == "__main__":
+    main()
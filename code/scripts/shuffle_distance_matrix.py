@@ -10,11 +10,11 @@ __maintainer__ = "Jai Ram Rideout"
 __email__ = "jr378@nau.edu"
 __status__ = "Development"
  
-from random import shuffle
-from qiime.format import format_distance_matrix
-from qiime.parse import parse_distmat
 from qiime.util import parse_command_line_parameters, make_option
 
+from microbiogeo.util import (get_random_state, parse_distance_matrix,
+                              shuffle_dm_and_coords, write_distance_matrix)
+
 script_info = {}
 script_info['brief_description'] = "Shuffles the labels of a distance matrix"
 script_info['script_description'] = """
@@ -22,11 +22,25 @@ This script shuffles the sample ID labels of a distance matrix. This \
 functionality may be useful, for example, if you have a distance matrix that \
 you are using a positive control in testing and you want to create a negative \
 control to use in additional testing.
+
+If the distance matrix's principal coordinates are provided, the same \
+shuffled labels are applied to the coordinates. Shuffling only permutes the \
+labels, so this creates the shuffled distance matrix's principal coordinates \
+without rerunning PCoA.
+
+Distance matrices can be in text or binary form (see \
+compute_distance_matrices.py).
 """
 script_info['script_usage'] = [("Shuffle distance matrix labels",
     "This example shows how to shuffle the labels of a distance matrix.",
     "%prog -i unweighted_unifrac_dm.txt -o "
-    "shuffled_unweighted_unifrac_dm.txt")]
+    "shuffled_unweighted_unifrac_dm.txt"),
+                               ("Shuffle distance matrix and coordinates",
+    "This example shows how to shuffle the labels of a distance matrix and "
+    "its principal coordinates.",
+    "%prog -i unweighted_unifrac_dm.txt -o "
+    "shuffled_unweighted_unifrac_dm.txt -c unweighted_unifrac_pc.txt -p "
+    "shuffled_unweighted_unifrac_pc.txt")]
 script_info['output_description'] = """
 The output is a distance matrix with the same data as the input distance \
 matrix, but with the labels shuffled.
@@ -36,19 +50,51 @@ script_info['required_options'] = [
         help='the input distance matrix', type="existing_filepath"),
     make_option('-o', '--output_distance_matrix',
         help='path to store the output distance matrix', type="new_filepath")]
-script_info['optional_options'] = []
+script_info['optional_options'] = [
+    make_option('-c','--input_coords', type='existing_filepath',
+        help='the input distance matrix\'s principal coordinates. If '
+             'provided, -p/--output_coords must also be provided '
+             '[default: %default]', default=None),
+    make_option('-p','--output_coords', type='new_filepath',
+        help='path to store the shuffled principal coordinates '
+             '[default: %default]', default=None),
+    make_option('-b','--binary', action='store_true',
+        help='also write the output distance matrix in binary form '
+             '[default: %default]', default=False),
+    make_option('--condensed', action='store_true',
+        help='write the binary form in condensed, single-precision form '
+             '(implies -b/--binary) [default: %default]', default=False),
+    make_option('--seed', type='int',
+        help='the seed for the random number generator [default: random '
+             'seed]', default=None)]
 script_info['version'] = __version__
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    # Open the input distance matrix and parse it. Shuffle its labels and write
-    # them and the original data to the output file.
-    labels, dm_data = parse_distmat(open(opts.input_distance_matrix, 'U'))
-    shuffle(labels)
-    output_f = open(opts.output_distance_matrix, 'w')
-    output_f.write(format_distance_matrix(labels, dm_data))
-    output_f.close()
+    if (opts.input_coords is None) != (opts.output_coords is None):
+        option_parser.error("You must provide both -c/--input_coords and "
+                            "-p/--output_coords, or neither.")
+
+    random_state = get_random_state(opts.seed)
+    if opts.input_coords is not None:
+        with open(opts.input_coords, 'U') as coords_f:
+            (labels, dm_data), coords_str = shuffle_dm_and_coords(
+                    opts.input_distance_matrix, coords_f, random_state,
+                    opts.condensed)
+
+        with open(opts.output_coords, 'w') as output_f:
+            output_f.write(coords_str)
+            output_f.write('\n')
+    else:
+        # Parse the input distance matrix and shuffle its labels.
+        labels, dm_data = parse_distance_matrix(opts.input_distance_matrix,
+                                                opts.condensed)
+        random_state.shuffle(labels)
+
+    # Write the shuffled labels and the original data to the output file.
+    write_distance_matrix(opts.output_distance_matrix, labels, dm_data,
+                          opts.binary, opts.condensed)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from os.path import basename, join, splitext
+
+from biom.parse import parse_biom_table
+from biom.table import table_factory
+from qiime.format import format_mapping_file
+from qiime.parse import parse_mapping_file
+from qiime.simsam import create_replicated_mapping_file
+from qiime.util import create_dir, parse_command_line_parameters, make_option
+
+from microbiogeo.simulate import get_replicate_samp_ids, simulate_tables
+from microbiogeo.tree import load_tree_index, parse_flat_tree
+from microbiogeo.util import derive_seed, parse_subset_index
+
+script_info = {}
+script_info['brief_description'] = ("Simulates tables at several "
+                                    "dissimilarities in a single pass")
+script_info['script_description'] = """
+This script creates the same simulated tables as simsam.py, but the table and \
+tree are only parsed once, and the tables for all dissimilarities are created \
+in a single vectorized pass (simsam.py reparses the tree and walks it for \
+every OTU in every sample for each dissimilarity).
+
+Each dissimilarity's output is written to its own output directory, using \
+the same filenames as simsam.py (e.g. table_n1_d0.1.biom and map_n1_d0.1.txt).
+
+Instead of the tree, an index built by build_tree_index.py can be provided. \
+This avoids parsing the tree, which is usually much slower than simulating \
+the tables.
+
+To simulate a subset of the input table's samples that was added to a subset \
+index by choose_data_subset.py, provide the index and the subset's name. The \
+output is the same as simulating the subset's own table and mapping file. \
+If the subset was chosen from replicates of the input table's samples \
+(choose_data_subset.py --num_replicates), only the replicates in the subset \
+are simulated.
+"""
+script_info['script_usage'] = [("Simulate three dissimilarities",
+    "Simulate one replicate of each sample at three dissimilarities.",
+    "%prog -i table.biom -t tree.tre -m map.txt -n 1 -d 0.0,0.1,1.0 "
+    "-o d0.0,d0.1,d1.0"),
+                               ("Simulate using a tree index",
+    "Same as above, but use a prebuilt tree index instead of the tree.",
+    "%prog -i table.biom -x tree_index.npz -m map.txt -n 1 -d 0.0,0.1,1.0 "
+    "-o d0.0,d0.1,d1.0"),
+                               ("Simulate an indexed subset",
+    "Simulate the samples in subset 0/10 of subsets.npz.",
+    "%prog -i table.biom -x tree_index.npz -m map.txt -n 1 -d 0.0,0.1,1.0 "
+    "-o d0.0,d0.1,d1.0 --subset_index subsets.npz --subset 0/10")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--otu_table', type='existing_filepath',
+        help='the input OTU table'),
+    make_option('-n','--num', type='int',
+        help='the number of replicates to simulate for each sample'),
+    make_option('-d','--dissim', type='string',
+        help='the dissimilarities to simulate, comma-separated'),
+    make_option('-o','--output_dirs', type='string',
+        help='the output directories, comma-separated (one for each '
+             'dissimilarity)')
+]
+script_info['optional_options'] = [
+    make_option('-t','--tree_file', type='existing_filepath',
+        help='the tree containing the OTUs in the input table. Either this '
+             'or -x/--tree_index must be provided [default: %default]',
+        default=None),
+    make_option('-x','--tree_index', type='existing_filepath',
+        help='the tree index (built by build_tree_index.py) containing the '
+             'OTUs in the input table [default: %default]', default=None),
+    make_option('-m','--mapping_fp', type='existing_filepath',
+        help='the mapping file to replicate for each output table '
+             '[default: %default]', default=None),
+    make_option('--subset_index', type='existing_filepath',
+        help='the subset index containing --subset [default: %default]',
+        default=None),
+    make_option('--subset', type='string',
+        help='the name of the subset of the input table to simulate '
+             '[default: all samples]', default=None),
+    make_option('--seed', type='int',
+        help='the seed for the random number generator. Each dissimilarity '
+             'is simulated from its own random stream (derived from the '
+             'seed and the dissimilarity), so a table only depends on the '
+             'seed and its dissimilarity [default: random seed]',
+        default=None)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if (opts.tree_file is None) == (opts.tree_index is None):
+        option_parser.error("You must provide either -t/--tree_file or "
+                            "-x/--tree_index.")
+
+    if (opts.subset_index is None) != (opts.subset is None):
+        option_parser.error("You must provide both --subset_index and "
+                            "--subset, or neither.")
+
+    dissims = map(float, opts.dissim.split(','))
+    output_dirs = opts.output_dirs.split(',')
+    if len(output_dirs) != len(dissims):
+        option_parser.error("You must provide exactly one output directory "
+                            "for each dissimilarity.")
+
+    with open(opts.otu_table, 'U') as table_f:
+        table = parse_biom_table(table_f)
+    if opts.tree_file is not None:
+        with open(opts.tree_file, 'U') as tree_f:
+            tree = parse_flat_tree(tree_f)
+    else:
+        with open(opts.tree_index, 'rb') as index_f:
+            tree = load_tree_index(index_f)
+
+    samp_ids = table.SampleIds
+    samp_idxs = None
+    rep_idxs = None
+    if opts.subset is not None:
+        indexed_samp_ids, subsets = parse_subset_index(opts.subset_index)
+        if opts.subset not in subsets:
+            option_parser.error("The subset '%s' is not in the subset index."
+                                % opts.subset)
+
+        if indexed_samp_ids == list(table.SampleIds):
+            samp_idxs = subsets[opts.subset]
+            samp_ids = [samp_ids[idx] for idx in samp_idxs]
+        elif indexed_samp_ids == get_replicate_samp_ids(table.SampleIds,
+                                                        opts.num):
+            rep_idxs = subsets[opts.subset]
+        else:
+            option_parser.error("The subset index was not created from the "
+                                "input table (or %d replicates of its "
+                                "samples)." % opts.num)
+
+    map_str = None
+    if opts.mapping_fp is not None:
+        with open(opts.mapping_fp, 'U') as map_f:
+            map_str = create_replicated_mapping_file(map_f, opts.num,
+                                                     samp_ids)
+
+        if rep_idxs is not None:
+            rep_samp_ids = set([indexed_samp_ids[idx] for idx in rep_idxs])
+            map_data, map_header, map_comments = \
+                    parse_mapping_file(map_str.split('\n'))
+            map_str = format_mapping_file(map_header,
+                                          [row for row in map_data
+                                           if row[0] in rep_samp_ids],
+                                          map_comments)
+
+    # Only the OTUs in the input table have metadata.
+    otu_md = None
+    if table.ObservationMetadata is not None:
+        otu_md = dict(zip(table.ObservationIds, table.ObservationMetadata))
+
+    table_base = splitext(basename(opts.otu_table))[0]
+    for dissim, output_dir, (samp_ids, otu_ids, counts) in zip(dissims,
+            output_dirs, simulate_tables(table, tree, opts.num, dissims,
+                                         [derive_seed(opts.seed, dissim)
+                                          for dissim in dissims],
+                                         samp_idxs, rep_idxs)):
+        create_dir(output_dir)
+        suffix = '_n%d_d%r' % (opts.num, dissim)
+
+        counts = counts.tocoo()
+        sim_table = table_factory([[otu_idx, samp_idx, int(count)]
+                                   for samp_idx, otu_idx, count in
+                                   zip(counts.row, counts.col, counts.data)],
+                                  samp_ids, otu_ids,
+                                  observation_metadata=None if otu_md is None
+                                  else [otu_md.get(otu_id)
+                                        for otu_id in otu_ids])
+
+        with open(join(output_dir, table_base + suffix + '.biom'),
+                  'w') as table_f:
+            sim_table.getBiomFormatJsonString('simulate_tables.py '
+                                              '(microbiogeo)', table_f)
+
+        if map_str is not None:
+            map_base, map_ext = splitext(basename(opts.mapping_fp))
+            with open(join(output_dir, map_base + suffix + map_ext),
+                      'w') as out_map_f:
+                out_map_f.write(map_str)
+
+
+if __name__ == "__main__":
+    main()
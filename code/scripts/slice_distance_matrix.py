@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+from qiime.parse import parse_mapping_file
+from qiime.util import parse_command_line_parameters, make_option
+
+from microbiogeo.util import slice_dm, write_distance_matrix
+
+script_info = {}
+script_info['brief_description'] = ("Slices a distance matrix to the samples "
+                                    "in a mapping file")
+script_info['script_description'] = """
+This script creates a distance matrix containing only the samples in the \
+input mapping file (in the same order) by indexing into a precomputed \
+distance matrix. Since the distance between two samples does not depend on \
+the other samples in the table, this is the same as recomputing the distance \
+matrix from a subset of the table, but much faster.
+
+If the mapping file was created by simsam.py using a dissimilarity of zero, \
+each simulated sample has the same counts as its original sample, so the \
+simulated distance matrix can be sliced from the original distance matrix \
+by using --strip_replicate_suffix.
+
+Distance matrices can be in text or binary form (see \
+compute_distance_matrices.py).
+"""
+script_info['script_usage'] = [("Subset",
+    "Slice the distance matrix to the samples in subset_map.txt.",
+    "%prog -i dm.txt -m subset_map.txt -o subset_dm.txt"),
+                               ("simsam.py replicates",
+    "Create the distance matrix for a table simulated by simsam.py with a "
+    "dissimilarity of zero.",
+    "%prog -i dm.txt -m map_n1_d0.0.txt -o simsam_dm.txt "
+    "--strip_replicate_suffix")]
+script_info['output_description'] = ""
+script_info['required_options'] = [
+    make_option('-i','--input_distance_matrix', type='existing_filepath',
+        help='the input distance matrix'),
+    make_option('-m','--mapping_fp', type='existing_filepath',
+        help='the mapping file containing the samples to keep'),
+    make_option('-o','--output_distance_matrix', type='new_filepath',
+        help='the output distance matrix filepath')
+]
+script_info['optional_options'] = [
+    make_option('--strip_replicate_suffix', action='store_true',
+        help='remove the replicate number that simsam.py appends to each '
+             'sample ID (e.g. ".0") before looking up the sample in the '
+             'input distance matrix [default: %default]', default=False),
+    make_option('-b','--binary', action='store_true',
+        help='also write the output distance matrix in binary form '
+             '[default: %default]', default=False),
+    make_option('--condensed', action='store_true',
+        help='write the binary form in condensed, single-precision form '
+             '(implies -b/--binary) [default: %default]', default=False)
+]
+script_info['version'] = __version__
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    with open(opts.mapping_fp, 'U') as map_f:
+        sample_ids = [row[0] for row in parse_mapping_file(map_f)[0]]
+
+    labels, dm_data = slice_dm(opts.input_distance_matrix, sample_ids,
+                               opts.strip_replicate_suffix, opts.condensed)
+    write_distance_matrix(opts.output_distance_matrix, labels, dm_data,
+                          opts.binary, opts.condensed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the distance.py module."""
+
+from StringIO import StringIO
+
+from biom.table import table_factory
+from cogent.core.tree import PhyloNode
+from cogent.maths.distance_transform import dist_bray_curtis
+from cogent.util.unit_test import TestCase, main
+from numpy import array
+from qiime.beta_metrics import dist_unweighted_unifrac, dist_weighted_unifrac
+from qiime.parse import parse_newick
+
+import microbiogeo.distance
+from microbiogeo.distance import (bray_curtis, compute_distance_matrices,
+                                  pairwise_l1, table_to_csr, unifrac)
+from microbiogeo.tree import parse_flat_tree
+
+class DistanceTests(TestCase):
+    """Tests for the distance.py module functions."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        # Observations are rows, samples are columns.
+        self.counts = array([[1, 0, 3, 0, 2],
+                             [0, 2, 0, 0, 2],
+                             [4, 4, 1, 0, 0],
+                             [0, 0, 0, 0, 0],
+                             [5, 1, 0, 0, 3]])
+        self.table = table_factory(self.counts,
+                                   ['S1', 'S2', 'S3', 'S4', 'S5'],
+                                   ['O1', 'O2', 'O3', 'O4', 'O5'])
+
+        # O6 and O7 are not in the table.
+        self.newick = ('((((O1:0.5,O2:0.2):0.3,O3:1.5):0.1,O6:0.7):0.4,'
+                       '((O4:0.3,O7:0.8):1.0,O5:0.6):0.2);')
+        self.tree = parse_flat_tree(StringIO(self.newick))
+
+    def tearDown(self):
+        microbiogeo.distance.MAX_BLOCK_ELEMENTS = 2 ** 22
+
+    def test_table_to_csr(self):
+        """Test converting a biom table to a sparse matrix."""
+        samp_ids, obs_ids, counts = table_to_csr(self.table)
+        self.assertEqual(samp_ids, ['S1', 'S2', 'S3', 'S4', 'S5'])
+        self.assertEqual(obs_ids, ['O1', 'O2', 'O3', 'O4', 'O5'])
+        self.assertEqual(counts.shape, (5, 5))
+        self.assertEqual(counts.nnz, 11)
+        self.assertFloatEqual(counts.toarray(), self.counts.T)
+
+    def test_bray_curtis(self):
+        """Test Bray-Curtis distances match cogent's implementation."""
+        _, _, counts = table_to_csr(self.table)
+        exp = dist_bray_curtis(self.counts.T.astype(float))
+
+        self.assertFloatEqual(bray_curtis(counts), exp)
+
+        # Force comparisons to use many small blocks.
+        microbiogeo.distance.MAX_BLOCK_ELEMENTS = 1
+        self.assertFloatEqual(bray_curtis(counts), exp)
+
+        # Samples with no counts are identical to each other.
+        obs = bray_curtis(array([[0, 0], [0, 0], [1, 0]]))
+        self.assertFloatEqual(obs, [[0, 0, 1], [0, 0, 1], [1, 1, 0]])
+
+    def test_unifrac(self):
+        """Test UniFrac distances match QIIME's implementation."""
+        _, obs_ids, counts = table_to_csr(self.table)
+        obs_unweighted, obs_weighted = unifrac(counts, obs_ids, self.tree)
+
+        qiime_tree = parse_newick(StringIO(self.newick), PhyloNode)
+        samp_ids = ['S1', 'S2', 'S3', 'S4', 'S5']
+        exp_unweighted = dist_unweighted_unifrac(self.counts.T, obs_ids,
+                                                 qiime_tree, samp_ids)
+        exp_weighted = dist_weighted_unifrac(self.counts.T, obs_ids,
+                                             qiime_tree, samp_ids)
+
+        self.assertFloatEqual(obs_unweighted, exp_unweighted)
+        self.assertFloatEqual(obs_weighted, exp_weighted)
+
+    def test_unifrac_missing_tips(self):
+        """Test observations must be in the tree."""
+        tree = parse_flat_tree(StringIO('((O1:1,O2:1):1,O3:1);'))
+        _, obs_ids, counts = table_to_csr(self.table)
+        self.assertRaises(ValueError, unifrac, counts, obs_ids, tree)
+
+    def test_pairwise_l1(self):
+        """Test computing weighted L1 distances between rows."""
+        mat = array([[1, 0, 2], [0, 3, 1], [1, 0, 2]])
+
+        obs = pairwise_l1(mat)
+        self.assertFloatEqual(obs, [[0, 5, 0], [5, 0, 5], [0, 5, 0]])
+
+        obs = pairwise_l1(mat, array([1, 0.5, 2]))
+        self.assertFloatEqual(obs, [[0, 4.5, 0], [4.5, 0, 4.5], [0, 4.5, 0]])
+
+    def test_compute_distance_matrices(self):
+        """Test computing distance matrices for several metrics."""
+        samp_ids, dms = compute_distance_matrices(self.table,
+                                                  ['bray_curtis'] * 2)
+        self.assertEqual(samp_ids, ['S1', 'S2', 'S3', 'S4', 'S5'])
+        self.assertEqual(len(dms), 2)
+        self.assertFloatEqual(dms[0], dms[1])
+
+        samp_ids, dms = compute_distance_matrices(self.table,
+                ['weighted_unifrac', 'bray_curtis', 'unweighted_unifrac'],
+                self.tree)
+        _, obs_ids, counts = table_to_csr(self.table)
+        exp_unweighted, exp_weighted = unifrac(counts, obs_ids, self.tree)
+        self.assertFloatEqual(dms[0], exp_weighted)
+        self.assertFloatEqual(dms[1], bray_curtis(counts))
+        self.assertFloatEqual(dms[2], exp_unweighted)
+
+        self.assertRaises(ValueError, compute_distance_matrices, self.table,
+                          ['bray_curtis', 'foo'])
+        self.assertRaises(ValueError, compute_distance_matrices, self.table,
+                          ['unweighted_unifrac'])
+
+
+if __name__ == "__main__":
+    main()
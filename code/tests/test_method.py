@@ -30,6 +30,15 @@ class AbstractStatMethodTests(TestCase):
         """Test raises error."""
         self.assertRaises(NotImplementedError, self.inst.parse, 'foo')
 
+    def test_is_effect_size_only(self):
+        """Test detecting p-values from runs without permutations."""
+        self.assertTrue(self.inst.is_effect_size_only('N/A'))
+        self.assertTrue(self.inst.is_effect_size_only(
+                'Too few iters to compute p-value (num_iters=0)'))
+        self.assertFalse(self.inst.is_effect_size_only(
+                'Too few iters to compute p-value (num_iters=1)'))
+        self.assertFalse(self.inst.is_effect_size_only('0.01'))
+
     def test_parse_float(self):
         """Test parsing float strings."""
         obs = self.inst.parse_float('0.045')
@@ -86,6 +95,7 @@ class QiimeStatMethodTests(TestCase):
 
         self.anosim_results_str1 = anosim_results_str1.split('\n')
         self.anosim_results_str2 = anosim_results_str2.split('\n')
+        self.anosim_results_str3 = anosim_results_str3.split('\n')
 
     def test_parse(self):
         """Test parsing QIIME stats results file."""
@@ -95,6 +105,12 @@ class QiimeStatMethodTests(TestCase):
         self.assertRaises(UnparsableLineError, self.inst.parse,
                           self.anosim_results_str2)
 
+    def test_parse_no_permutations(self):
+        """Test parsing results file with only an effect size."""
+        obs = self.inst.parse(self.anosim_results_str3)
+        self.assertFloatEqual(obs[0], 0.9375)
+        self.assertTrue(obs[1] is None)
+
 
 class AnosimTests(TestCase):
     """Nothing to test."""
@@ -190,12 +206,19 @@ class MantelTests(TestCase):
         self.inst = Mantel()
 
         self.mantel_results_str1 = mantel_results_str1.split('\n')
+        self.mantel_results_str2 = mantel_results_str2.split('\n')
 
     def test_parse(self):
         """Test parsing mantel results file."""
         obs = self.inst.parse(self.mantel_results_str1)
         self.assertFloatEqual(obs, (1.0, 0.01))
 
+    def test_parse_no_permutations(self):
+        """Test parsing mantel results file with only an effect size."""
+        obs = self.inst.parse(self.mantel_results_str2)
+        self.assertFloatEqual(obs[0], 0.45)
+        self.assertTrue(obs[1] is None)
+
 
 class PartialMantelTests(TestCase):
     """Tests for the PartialMantel class."""
@@ -270,6 +293,7 @@ class OrdinationCorrelationTests(TestCase):
 
         self.ord_corr_results_str1 = ord_corr_results_str1.split('\n')
         self.ord_corr_results_str2 = ord_corr_results_str2.split('\n')
+        self.ord_corr_results_str3 = ord_corr_results_str3.split('\n')
 
     def test_parse(self):
         """Test parsing ordination-correlation results file."""
@@ -279,6 +303,10 @@ class OrdinationCorrelationTests(TestCase):
         self.assertRaises(UnparsableLineError, self.inst.parse,
                           self.ord_corr_results_str2)
 
+        obs = self.inst.parse(self.ord_corr_results_str3)
+        self.assertFloatEqual(obs[0], 0.9138)
+        self.assertTrue(obs[1] is None)
+
 
 class PearsonOrdinationCorrelationTests(TestCase):
     """Nothing to test."""
@@ -296,6 +324,9 @@ ANOSIM\t0.463253142506\t0.01\t99"""
 anosim_results_str2 = """Method name\tR statistic\tp-value\tNumber of permutations
 ANOSIM\t0.9375\tToo few iters to compute p-value (num_iters=1)\t1"""
 
+anosim_results_str3 = """Method name\tR statistic\tp-value\tNumber of permutations
+ANOSIM\t0.9375\tToo few iters to compute p-value (num_iters=0)\t0"""
+
 adonis_results_str1 = """
 Call:
 adonis(formula = as.dist(qiime.data$distmat) ~ qiime.data$map[[opts$category]],      permutations = opts$num_permutations) 
@@ -453,6 +484,9 @@ mantel_results_str1 = """# Number of entries refers to the number of rows (or co
 DM1\tDM2\tNumber of entries\tMantel r statistic\tp-value\tNumber of permutations\tTail type
 /Users/jrideout/analysis/overview_tutorial/wf_bdiv_even146/unweighted_unifrac_dm.txt\t/Users/jrideout/analysis/overview_tutorial/wf_bdiv_even146/unweighted_unifrac_dm.txt\t9\t1.00000\t0.01\t100\ttwo sided"""
 
+mantel_results_str2 = """DM1\tDM2\tNumber of entries\tMantel r statistic\tp-value\tNumber of permutations\tTail type
+dm.txt\tPH_dm.txt\t9\t0.45000\tToo few iters to compute p-value (num_iters=0)\t0\ttwo sided"""
+
 partial_mantel_results_str1 = """# Number of entries refers to the number of rows (or cols) retained in each
 # distance matrix after filtering the distance matrices to include only those
 # samples that were in both distance matrices. p-value contains the correct
@@ -494,6 +528,9 @@ ord_corr_results_str1 = """Correlation coefficient\tParametric p-value\tNonparam
 ord_corr_results_str2 = """Correlation coefficient\tParametric p-value\tNonparametric p-value
 0.9138\t0.0000\tToo few iters to compute p-value (num_iters=2)"""
 
+ord_corr_results_str3 = """Correlation coefficient\tParametric p-value\tNonparametric p-value
+0.9138\t0.0000\tN/A"""
+
 
 if __name__ == "__main__":
     main()
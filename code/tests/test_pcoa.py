@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the pcoa.py module."""
+
+from cogent.cluster.metric_scaling import principal_coordinates_analysis
+from cogent.util.unit_test import TestCase, main
+from numpy import argsort, array, zeros
+from numpy.random import RandomState
+from scipy.spatial.distance import pdist, squareform
+
+import microbiogeo.pcoa
+from microbiogeo.pcoa import pcoa
+
+class PCoATests(TestCase):
+    """Tests for the pcoa.py module functions."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.dm = array([[0, 1, 2, 4, 5],
+                         [1, 0, 3, 2, 6],
+                         [2, 3, 0, 1, 2],
+                         [4, 2, 1, 0, 3],
+                         [5, 6, 2, 3, 0]], dtype=float)
+
+        self.large_dm = squareform(pdist(RandomState(0).rand(40, 10),
+                                         'braycurtis'))
+
+    def tearDown(self):
+        """Restore module-level settings changed by the tests."""
+        microbiogeo.pcoa.MIN_LANCZOS_SAMPLES = 100
+
+    def _exp_pcoa(self, dm):
+        coords, eigvals = principal_coordinates_analysis(dm.copy())
+        order = argsort(eigvals)[::-1]
+        return coords[order].T, eigvals[order]
+
+    def test_pcoa(self):
+        """Test PCoA matches QIIME's implementation (up to sign)."""
+        exp_coords, exp_eigvals = self._exp_pcoa(self.dm)
+        obs_coords, obs_eigvals, obs_pct_var = pcoa(self.dm, 2)
+
+        self.assertEqual(obs_coords.shape, (5, 2))
+        self.assertFloatEqual(abs(obs_coords), abs(exp_coords[:, :2]))
+        self.assertFloatEqual(obs_eigvals, exp_eigvals[:2])
+        self.assertFloatEqual(obs_pct_var,
+                              exp_eigvals[:2] / exp_eigvals.sum() * 100)
+
+        # All axes.
+        obs_coords, obs_eigvals, obs_pct_var = pcoa(self.dm, 10)
+        self.assertFloatEqual(abs(obs_coords), abs(exp_coords))
+        self.assertFloatEqual(obs_pct_var.sum(), 100)
+
+    def test_pcoa_lanczos(self):
+        """Test PCoA using the Lanczos solver."""
+        exp_coords, exp_eigvals = self._exp_pcoa(self.large_dm)
+
+        microbiogeo.pcoa.MIN_LANCZOS_SAMPLES = 10
+        obs_coords, obs_eigvals, obs_pct_var = pcoa(self.large_dm)
+
+        self.assertEqual(obs_coords.shape, (40, 3))
+        self.assertFloatEqual(abs(obs_coords), abs(exp_coords[:, :3]))
+        self.assertFloatEqual(obs_eigvals, exp_eigvals[:3])
+
+    def test_pcoa_zero_distances(self):
+        """Test PCoA on a matrix of zeros."""
+        obs_coords, obs_eigvals, obs_pct_var = pcoa(zeros((4, 4)))
+        self.assertFloatEqual(obs_coords, zeros((4, 3)))
+        self.assertFloatEqual(obs_pct_var, [0, 0, 0])
+
+    def test_pcoa_invalid_input(self):
+        """Test invalid number of axes raises an error."""
+        self.assertRaises(ValueError, pcoa, self.dm, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the rarefaction.py module."""
+
+from biom.table import table_factory
+from cogent.util.unit_test import TestCase, main
+from numpy import array
+
+from microbiogeo.rarefaction import rarefy_tables
+
+class RarefactionTests(TestCase):
+    """Tests for the rarefaction.py module functions."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        # S1 has 10 sequences, S2 has 4, and S3 has 6.
+        self.table = table_factory(array([[5, 0, 1], [5, 3, 0], [0, 1, 5]]),
+                                   ['S1', 'S2', 'S3'], ['A', 'B', 'C'])
+
+    def test_rarefy_tables(self):
+        """Test rarefying a table to several depths."""
+        obs = rarefy_tables(self.table, [4, 6, 10, 11], 42)
+        self.assertEqual(len(obs), 4)
+
+        samp_ids, otu_ids, counts = obs[0]
+        self.assertEqual(samp_ids, ['S1', 'S2', 'S3'])
+        self.assertEqual(otu_ids, sorted(otu_ids))
+        self.assertEqual(counts.sum(axis=1).T.tolist(), [[4, 4, 4]])
+        # S2 has exactly enough sequences, so all of them are kept.
+        self.assertEqual(counts[1].toarray(), [[0, 3, 1]])
+
+        # Samples without enough sequences are removed.
+        samp_ids, otu_ids, counts = obs[1]
+        self.assertEqual(samp_ids, ['S1', 'S3'])
+        self.assertEqual(counts.sum(axis=1).T.tolist(), [[6, 6]])
+        self.assertEqual(counts[1].toarray().ravel()[-1], 5)
+
+        # OTUs that aren't in any remaining sample are removed.
+        samp_ids, otu_ids, counts = obs[2]
+        self.assertEqual(samp_ids, ['S1'])
+        self.assertEqual(otu_ids, ['A', 'B'])
+        self.assertEqual(counts.toarray(), [[5, 5]])
+
+        self.assertEqual(obs[3][0], [])
+        self.assertEqual(obs[3][1], [])
+
+        # Subsamples never have more of an OTU than the sample does.
+        for seed in range(20):
+            samp_ids, otu_ids, counts = rarefy_tables(self.table, [5],
+                                                      seed)[0]
+            self.assertEqual(samp_ids, ['S1', 'S3'])
+            orig = dict(zip(self.table.ObservationIds,
+                            zip(*[self.table.sampleData(samp_id)
+                                  for samp_id in samp_ids])))
+            for otu_idx, otu_id in enumerate(otu_ids):
+                self.assertTrue(
+                        (counts[:, otu_idx].toarray().ravel() <=
+                         array(orig[otu_id])).all())
+
+        # Same seed, same tables, whether the depths are rarefied together or
+        # one at a time.
+        obs = rarefy_tables(self.table, [4, 6], [1, 2])
+        exp = rarefy_tables(self.table, [6], [2])
+        self.assertEqual(obs[1][0], exp[0][0])
+        self.assertEqual(obs[1][1], exp[0][1])
+        self.assertEqual(obs[1][2].toarray(), exp[0][2].toarray())
+
+        self.assertRaises(ValueError, rarefy_tables, self.table, [0])
+
+
+if __name__ == "__main__":
+    main()
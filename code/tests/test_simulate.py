@@ -12,17 +12,21 @@ __email__ = "jai.rideout@gmail.com"
 """Test suite for the simulate.py module."""
 
 from biom.parse import parse_biom_table
+from biom.table import table_factory
 from cogent.util.unit_test import TestCase, main
+from numpy import array
 from qiime.util import MetadataMap
 
 from microbiogeo.simulate import (choose_cluster_subsets,
-                                  choose_gradient_subset,
+                                  choose_data_subsets, choose_gradient_subset,
+                                  get_replicate_samp_ids,
                                   _choose_items_from_bins,
                                   _choose_items_from_clusters,
                                   _collate_cluster_pcoa_plot_data,
                                   _collate_gradient_pcoa_plot_data,
                                   _compute_plot_data_statistics,
-                                  InvalidSubsetSize)
+                                  InvalidSubsetSize, simulate_tables)
+from microbiogeo.tree import parse_flat_tree, TreeNeighborhoodIndex
 
 class SimulateTests(TestCase):
     """Tests for the simulate.py module functions."""
@@ -148,6 +152,147 @@ class SimulateTests(TestCase):
                           self.tutorial_otu_table_f, self.tutorial_mapping_f,
                           'Gradient', 11)
 
+    def test_choose_data_subsets(self):
+        """Test picking several subsets at once."""
+        obs = choose_data_subsets('gradient', self.tutorial_otu_table_f,
+                                  self.tutorial_mapping_f,
+                                  [('Gradient', 9), ('Gradient', 2),
+                                   ('Gradient', 2)])
+        self.assertEqual(len(obs), 3)
+        self.assertEqual(obs[0], (parse_biom_table(self.tutorial_otu_table_f),
+                                  tutorial_mapping_f))
+        for subset_table, subset_map_str in obs[1:]:
+            self.assertEqual(list(subset_table.SampleIds),
+                    MetadataMap.parseMetadataMap(
+                            subset_map_str.split('\n')).SampleIds)
+            self.assertEqual(len(subset_table.SampleIds), 2)
+
+        obs = choose_data_subsets('cluster', self.tutorial_otu_table_f,
+                                  self.tutorial_mapping_f,
+                                  [('Treatment', 4), ('DOB', 3)])
+        self.assertEqual([len(subset_table.SampleIds)
+                          for subset_table, _ in obs], [4, 3])
+
+        self.assertRaises(InvalidSubsetSize, choose_data_subsets, 'cluster',
+                          self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                          [('Treatment', 4), ('Treatment', 10)])
+        # Only choose the sample IDs.
+        obs = choose_data_subsets('gradient', self.tutorial_otu_table_f,
+                                  self.tutorial_mapping_f, [('Gradient', 3)],
+                                  materialize=False)
+        table_samp_ids = list(
+                parse_biom_table(self.tutorial_otu_table_f).SampleIds)
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(len(obs[0]), 3)
+        self.assertEqual(obs[0], sorted(obs[0], key=table_samp_ids.index))
+
+        # The same seeds always give the same subsets, whether they're chosen
+        # together or one at a time.
+        obs = choose_data_subsets('cluster', self.tutorial_otu_table_f,
+                                  self.tutorial_mapping_f,
+                                  [('Treatment', 4), ('DOB', 3)],
+                                  materialize=False, random_state=[1, 2])
+        self.assertEqual(obs, choose_data_subsets('cluster',
+                self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                [('Treatment', 4), ('DOB', 3)], False, [1, 2]))
+        self.assertEqual(obs[1:], choose_data_subsets('cluster',
+                self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                [('DOB', 3)], False, [2]))
+
+        # Choose subsets from replicates that haven't been simulated.
+        obs = choose_data_subsets('cluster', self.tutorial_otu_table_f,
+                                  self.tutorial_mapping_f,
+                                  [('Treatment', 20)], materialize=False,
+                                  num_replicates=3)
+        rep_samp_ids = get_replicate_samp_ids(table_samp_ids, 3)
+        self.assertEqual(len(obs[0]), 20)
+        self.assertEqual(obs[0], sorted(obs[0], key=rep_samp_ids.index))
+
+        self.assertRaises(InvalidSubsetSize, choose_data_subsets, 'gradient',
+                          self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                          [('Gradient', 28)], False, None, 3)
+        self.assertRaises(ValueError, choose_data_subsets, 'gradient',
+                          self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                          [('Gradient', 10)], True, None, 3)
+
+        self.assertRaises(ValueError, choose_data_subsets, 'foo',
+                          self.tutorial_otu_table_f, self.tutorial_mapping_f,
+                          [('Treatment', 4)])
+
+    def test_simulate_tables(self):
+        """Test simulating tables at several dissimilarities."""
+        tree = parse_flat_tree(
+                ['((A:0.1,B:0.2)ab:0.3,(C:0.4,D:0.5)cd:0.6)root;'])
+        table = table_factory(array([[1, 0], [2, 5]]), ['S1', 'S2'],
+                              ['A', 'C'])
+
+        obs = simulate_tables(table, tree, 2, [0.0, 0.35, 100.0], 42)
+        self.assertEqual(len(obs), 3)
+
+        # Nothing moves at a dissimilarity of zero.
+        samp_ids, otu_ids, counts = obs[0]
+        self.assertEqual(samp_ids, ['S1.0', 'S1.1', 'S2.0', 'S2.1'])
+        self.assertEqual(otu_ids, ['A', 'C'])
+        self.assertEqual(counts.toarray(), [[1, 2], [1, 2], [0, 5], [0, 5]])
+
+        # A can move to B, but C can't move.
+        samp_ids, otu_ids, counts = obs[1]
+        self.assertEqual(samp_ids, ['S1.0', 'S1.1', 'S2.0', 'S2.1'])
+        self.assertTrue(set(otu_ids) <= set(['A', 'B', 'C']))
+        self.assertTrue('C' in otu_ids)
+        self.assertEqual(otu_ids, sorted(otu_ids))
+        self.assertEqual(counts.sum(axis=1).T.tolist(), [[3, 3, 5, 5]])
+
+        # Everything can move anywhere, but counts are preserved.
+        samp_ids, otu_ids, counts = obs[2]
+        self.assertTrue(set(otu_ids) <= set(['A', 'B', 'C', 'D']))
+        self.assertEqual(counts.sum(axis=1).T.tolist(), [[3, 3, 5, 5]])
+
+        # Same seed, same tables (with or without a prebuilt index, which can
+        # include OTUs that aren't in the table).
+        index = TreeNeighborhoodIndex.fromTree(tree, ['D', 'C', 'A'])
+        for tree_or_index in tree, index:
+            obs2 = simulate_tables(table, tree_or_index, 2,
+                                   [0.0, 0.35, 100.0], 42)
+            for (_, otu_ids1, counts1), (_, otu_ids2, counts2) in zip(obs,
+                                                                      obs2):
+                self.assertEqual(otu_ids1, otu_ids2)
+                self.assertEqual(counts1.toarray(), counts2.toarray())
+
+        # Simulating a subset of the samples is the same as simulating a
+        # filtered table.
+        sub_table = table_factory(array([[0], [5]]), ['S2'], ['A', 'C'])
+        exp = simulate_tables(sub_table, tree, 2, [0.0, 100.0], 42)
+        obs = simulate_tables(table, tree, 2, [0.0, 100.0], 42,
+                              samp_idxs=[1])
+        for (samp_ids1, otu_ids1, counts1), (samp_ids2, otu_ids2,
+                                             counts2) in zip(obs, exp):
+            self.assertEqual(samp_ids1, ['S2.0', 'S2.1'])
+            self.assertEqual(samp_ids1, samp_ids2)
+            self.assertEqual(otu_ids1, otu_ids2)
+            self.assertEqual(counts1.toarray(), counts2.toarray())
+
+        # Only simulate some of the replicates.
+        obs = simulate_tables(table, tree, 3, [0.0, 100.0], 42,
+                              rep_idxs=[1, 3, 5])
+        samp_ids, otu_ids, counts = obs[0]
+        self.assertEqual(samp_ids, ['S1.1', 'S2.0', 'S2.2'])
+        self.assertEqual(otu_ids, ['A', 'C'])
+        self.assertEqual(counts.toarray(), [[1, 2], [0, 5], [0, 5]])
+        samp_ids, otu_ids, counts = obs[1]
+        self.assertEqual(samp_ids, ['S1.1', 'S2.0', 'S2.2'])
+        self.assertEqual(counts.sum(axis=1).T.tolist(), [[3, 5, 5]])
+
+        self.assertRaises(ValueError, simulate_tables, table, tree, 0, [0.0])
+
+    def test_get_replicate_samp_ids(self):
+        """Test naming sample replicates."""
+        self.assertEqual(get_replicate_samp_ids([], 2), [])
+        self.assertEqual(get_replicate_samp_ids(['S1', 'S2'], 1),
+                         ['S1.0', 'S2.0'])
+        self.assertEqual(get_replicate_samp_ids(['S1', 'S2'], 2),
+                         ['S1.0', 'S1.1', 'S2.0', 'S2.1'])
+
     def test_choose_items_from_bins(self):
         """Test picking items from a sequence that is split into bins."""
         sequence = [1, 2, 3, 4]
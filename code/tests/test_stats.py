@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the stats.py module."""
+
+from itertools import permutations
+
+from cogent.maths.stats.test import pearson
+from cogent.util.unit_test import TestCase, main
+from numpy import array, isnan, tril_indices
+from numpy.random import seed
+from qiime.stats import Anosim, Permanova
+from qiime.util import DistanceMatrix, MetadataMap
+from scipy.spatial.distance import squareform
+
+from microbiogeo.stats import (anosim_multi, _count_better, mantel_multi,
+                               permanova_multi, _pearson3_upper_tail,
+                               _qap_moments, _rank)
+
+class StatsTests(TestCase):
+    """Tests for the stats.py module functions."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.dm1 = array([[0, 1, 2, 4, 5],
+                          [1, 0, 3, 2, 6],
+                          [2, 3, 0, 1, 2],
+                          [4, 2, 1, 0, 3],
+                          [5, 6, 2, 3, 0]])
+
+        self.dm2 = array([[0, 2, 3, 3, 6],
+                          [2, 0, 4, 1, 7],
+                          [3, 4, 0, 2, 1],
+                          [3, 1, 2, 0, 3],
+                          [6, 7, 1, 3, 0]])
+
+        self.dm3 = array([[0, 9, 1, 2, 1],
+                          [9, 0, 1, 5, 2],
+                          [1, 1, 0, 8, 4],
+                          [2, 5, 8, 0, 1],
+                          [1, 2, 4, 1, 0]])
+
+        self.constant_dm = array([[0, 1, 1, 1, 1],
+                                  [1, 0, 1, 1, 1],
+                                  [1, 1, 0, 1, 1],
+                                  [1, 1, 1, 0, 1],
+                                  [1, 1, 1, 1, 0]])
+
+        self.samp_ids = ['S1', 'S2', 'S3', 'S4', 'S5']
+        self.grouping = ['a', 'b', 'a', 'b', 'b']
+        self.md_map = MetadataMap(dict([(samp_id, {'Group': group})
+                for samp_id, group in zip(self.samp_ids, self.grouping)]), [])
+
+    def test_mantel_multi(self):
+        """Test Mantel tests against multiple distance matrices."""
+        obs = mantel_multi(self.dm1, [self.dm2, self.dm3], 0)
+        self.assertEqual(len(obs), 2)
+
+        for (obs_r, obs_p), dm in zip(obs, [self.dm2, self.dm3]):
+            tri = tril_indices(5, -1)
+            exp_r = pearson(self.dm1[tri], dm[tri])
+            self.assertFloatEqual(obs_r, exp_r)
+            self.assertTrue(obs_p is None)
+
+    def test_mantel_multi_shared_permutations(self):
+        """Test that batched p-values match separate runs."""
+        seed(42)
+        obs = mantel_multi(self.dm1, [self.dm2, self.dm3], 99, block_size=7)
+
+        for i, dm in enumerate([self.dm2, self.dm3]):
+            seed(42)
+            exp = mantel_multi(self.dm1, [dm], 99)
+            self.assertFloatEqual(obs[i], exp[0])
+
+        for r, p in obs:
+            self.assertTrue(0 < p <= 1)
+
+    def test_mantel_multi_condensed(self):
+        """Test condensed matrices give the same results as square ones."""
+        exp = mantel_multi(self.dm1, [self.dm2, self.dm3], 99, seed=42)
+        obs = mantel_multi(squareform(self.dm1), [self.dm2, self.dm3], 99,
+                           seed=42)
+        self.assertFloatEqual(obs, exp)
+
+        obs = mantel_multi(squareform(self.dm1), [squareform(self.dm2),
+                           self.dm3], 99, seed=42)
+        self.assertFloatEqual(obs, exp)
+
+        exp = mantel_multi(self.dm1, [self.dm2], approximate=True)
+        obs = mantel_multi(squareform(self.dm1), [self.dm2], approximate=True)
+        self.assertFloatEqual(obs, exp)
+
+        self.assertRaises(ValueError, mantel_multi, squareform(self.dm1),
+                          [squareform(self.dm2)[:4]], 99)
+
+    def test_mantel_multi_tail_types(self):
+        """Test one-sided tests are consistent with the two-sided test."""
+        seed(0)
+        two_sided = mantel_multi(self.dm1, [self.dm2], 99)[0][1]
+        seed(0)
+        greater = mantel_multi(self.dm1, [self.dm2], 99, 'greater')[0][1]
+        seed(0)
+        less = mantel_multi(self.dm1, [self.dm2], 99, 'less')[0][1]
+
+        self.assertTrue(greater <= two_sided)
+        self.assertTrue(greater < less)
+
+    def test_count_better_ties(self):
+        """Test permuted statistics that tie the original are counted."""
+        # 0.1 + 0.2 != 0.3 in floating point, but they are the same statistic.
+        perm_stats = [0.1 + 0.2, -(0.1 + 0.2), 0.3 + 1e-6, 0.3 - 1e-6]
+        self.assertEqual(_count_better(perm_stats, 0.3, 'two sided'), 3)
+        self.assertEqual(_count_better(perm_stats, 0.3, 'greater'), 2)
+        self.assertEqual(_count_better(perm_stats, 0.3, 'less'), 3)
+
+        self.assertEqual(_count_better([0.3], 0.1 + 0.2, 'greater'), 1)
+        self.assertEqual(_count_better([0.1 + 0.2], 0.3, 'less'), 1)
+
+    def test_mantel_multi_constant_dm(self):
+        """Test correlating against a matrix with no variation."""
+        obs = mantel_multi(self.dm1, [self.constant_dm, self.dm2], 9)
+        self.assertTrue(isnan(obs[0][0]))
+        self.assertFloatEqual(obs[0][1], 0.1)
+        self.assertFalse(isnan(obs[1][0]))
+
+    def test_mantel_multi_invalid_input(self):
+        """Test invalid input raises errors."""
+        self.assertRaises(ValueError, mantel_multi, self.dm1, [self.dm2], -1)
+        self.assertRaises(ValueError, mantel_multi, self.dm1, [self.dm2], 99,
+                          'foo')
+        self.assertRaises(ValueError, mantel_multi, self.dm1,
+                          [self.dm2[:3, :3]], 99)
+
+    def test_mantel_multi_substreams(self):
+        """Test seeded p-values don't depend on the number of jobs."""
+        exp = mantel_multi(self.dm1, [self.dm2, self.dm3], 250, seed=42)
+        obs = mantel_multi(self.dm1, [self.dm2, self.dm3], 250, seed=42,
+                           num_jobs=2)
+        self.assertFloatEqual(obs, exp)
+
+        obs = mantel_multi(self.dm1, [self.dm2, self.dm3], 250, seed=42,
+                           block_size=3)
+        self.assertFloatEqual(obs, exp)
+
+        obs = mantel_multi(self.dm1, [self.dm2], 0, seed=42, num_jobs=2)
+        self.assertTrue(obs[0][1] is None)
+
+        self.assertRaises(ValueError, mantel_multi, self.dm1, [self.dm2], 99,
+                          num_jobs=0)
+
+    def test_mantel_multi_approximate(self):
+        """Test approximate p-values are close to exact p-values."""
+        obs = mantel_multi(self.dm1, [self.dm2, self.dm3], approximate=True)
+        exp = mantel_multi(self.dm1, [self.dm2, self.dm3], 0)
+
+        for (obs_r, obs_p), (exp_r, _), dm in zip(obs, exp,
+                                                  [self.dm2, self.dm3]):
+            self.assertFloatEqual(obs_r, exp_r)
+
+            # Compare against all 120 permutations.
+            exact_p = self._exact_mantel_p_value(self.dm1, dm)
+            self.assertTrue(abs(obs_p - exact_p) < 0.1)
+
+        greater = mantel_multi(self.dm1, [self.dm2], tail_type='greater',
+                               approximate=True)[0][1]
+        less = mantel_multi(self.dm1, [self.dm2], tail_type='less',
+                            approximate=True)[0][1]
+        self.assertFloatEqual(greater + less, 1.0)
+        self.assertTrue(greater < less)
+
+        obs = mantel_multi(self.dm1, [self.constant_dm], approximate=True)
+        self.assertTrue(isnan(obs[0][0]))
+        self.assertFloatEqual(obs[0][1], 1.0)
+
+    def _exact_mantel_p_value(self, dm1, dm2):
+        tri = tril_indices(len(dm1), -1)
+        orig_r = pearson(dm1[tri], dm2[tri])
+
+        perm_rs = []
+        for perm in permutations(range(len(dm1))):
+            perm = list(perm)
+            perm_rs.append(pearson(dm1[perm][:, perm][tri], dm2[tri]))
+        return sum([abs(r) >= abs(orig_r) - 1e-8
+                    for r in perm_rs]) / len(perm_rs)
+
+    def test_anosim_multi_approximate(self):
+        """Test approximate ANOSIM p-values."""
+        obs = anosim_multi([self.dm1, self.dm3], self.grouping,
+                           approximate=True)
+        exp = anosim_multi([self.dm1, self.dm3], self.grouping, 0)
+
+        for (obs_r, obs_p), (exp_r, _) in zip(obs, exp):
+            self.assertFloatEqual(obs_r, exp_r)
+            self.assertTrue(0 <= obs_p <= 1)
+
+        # Larger R statistics should have smaller p-values.
+        self.assertTrue(obs[1][0] > obs[0][0])
+        self.assertTrue(obs[1][1] < obs[0][1])
+
+    def test_qap_moments(self):
+        """Test moments match the distribution over all permutations."""
+        for a, b in (self.dm1, self.dm2), (self.dm2, self.dm3), \
+                    (self.dm1[:4, :4], self.dm3[:4, :4]):
+            a = a.astype(float)
+            stats = []
+            for perm in permutations(range(len(a))):
+                perm = list(perm)
+                stats.append((a * b[perm][:, perm]).sum())
+            stats = array(stats)
+
+            exp_mean = stats.mean()
+            exp_var = stats.var()
+            exp_skew = ((stats - exp_mean) ** 3).mean() / exp_var ** 1.5
+
+            self.assertFloatEqual(_qap_moments(a, b),
+                                  (exp_mean, exp_var, exp_skew))
+
+    def test_pearson3_upper_tail(self):
+        """Test the Pearson type III upper tail probability."""
+        # No skew is the standard normal distribution.
+        self.assertFloatEqual(_pearson3_upper_tail(0, 0), 0.5)
+        self.assertFloatEqual(_pearson3_upper_tail(1.96, 0), 0.0249979)
+
+        # Near-zero skew should be close to the normal distribution.
+        self.assertFloatEqual(_pearson3_upper_tail(1.96, 0.001), 0.0249979,
+                              eps=1e-3)
+
+        # Positive skew has a heavier upper tail and is bounded below.
+        self.assertTrue(_pearson3_upper_tail(1.96, 1) > 0.0249979)
+        self.assertFloatEqual(_pearson3_upper_tail(-2, 1), 1.0)
+        self.assertFloatEqual(_pearson3_upper_tail(2, -1), 0.0)
+        self.assertFloatEqual(_pearson3_upper_tail(1.5, 0.5),
+                              1 - _pearson3_upper_tail(-1.5, -0.5))
+
+    def test_anosim_multi(self):
+        """Test ANOSIM on multiple distance matrices matches QIIME."""
+        dms = [self.dm1, self.dm2, self.dm3]
+
+        seed(42)
+        obs = anosim_multi(dms, self.grouping, 99, block_size=4)
+        self.assertEqual(len(obs), 3)
+
+        for (obs_r, obs_p), dm in zip(obs, dms):
+            seed(42)
+            exp = Anosim(self.md_map, DistanceMatrix(dm, self.samp_ids,
+                         self.samp_ids), 'Group')(99)
+            self.assertFloatEqual(obs_r, exp['r_value'])
+            self.assertFloatEqual(obs_p, exp['p_value'])
+
+        obs = anosim_multi(dms, self.grouping, 0)
+        self.assertTrue(obs[0][1] is None)
+
+    def test_permanova_multi(self):
+        """Test PERMANOVA on multiple distance matrices matches QIIME."""
+        dms = [self.dm1, self.dm2, self.dm3]
+
+        seed(42)
+        obs = permanova_multi(dms, self.grouping, 99, block_size=4)
+        self.assertEqual(len(obs), 3)
+
+        for (obs_f, obs_p), dm in zip(obs, dms):
+            seed(42)
+            exp = Permanova(self.md_map, DistanceMatrix(dm, self.samp_ids,
+                            self.samp_ids), 'Group')(99)
+            self.assertFloatEqual(obs_f, exp['f_value'])
+            self.assertFloatEqual(obs_p, exp['p_value'])
+
+    def test_category_methods_substreams(self):
+        """Test seeded p-values don't depend on the number of jobs."""
+        dms = [self.dm1, self.dm2, self.dm3]
+
+        for method in anosim_multi, permanova_multi:
+            exp = method(dms, self.grouping, 250, seed=7)
+            obs = method(dms, self.grouping, 250, seed=7, num_jobs=3)
+            self.assertFloatEqual(obs, exp)
+
+            for stat, p_value in obs:
+                self.assertTrue(0 < p_value <= 1)
+
+            self.assertRaises(ValueError, method, dms, self.grouping, 99,
+                              num_jobs=0)
+
+    def test_category_methods_condensed(self):
+        """Test condensed matrices give the same results as square ones."""
+        dms = [self.dm1, self.dm2, self.dm3]
+
+        for method in anosim_multi, permanova_multi:
+            exp = method(dms, self.grouping, 99, seed=7)
+            obs = method([squareform(dm) for dm in dms], self.grouping, 99,
+                         seed=7)
+            self.assertFloatEqual(obs, exp)
+
+        exp = anosim_multi(dms, self.grouping, approximate=True)
+        obs = anosim_multi([squareform(dm) for dm in dms], self.grouping,
+                           approximate=True)
+        self.assertFloatEqual(obs, exp)
+
+    def test_category_methods_invalid_input(self):
+        """Test invalid input to categorical methods raises errors."""
+        for method in anosim_multi, permanova_multi:
+            self.assertRaises(ValueError, method, [self.dm1], self.grouping,
+                              -1)
+            self.assertRaises(ValueError, method, [self.dm1], ['a'] * 5, 99)
+            self.assertRaises(ValueError, method, [self.dm1],
+                              ['a', 'b', 'c', 'd', 'e'], 99)
+            self.assertRaises(ValueError, method, [self.dm1[:3, :3]],
+                              self.grouping, 99)
+            self.assertRaises(ValueError, method, [squareform(self.dm1)[:4]],
+                              self.grouping, 99)
+
+    def test_rank(self):
+        """Test ranking values with ties."""
+        self.assertFloatEqual(_rank([3, 1, 2]), [3, 1, 2])
+        self.assertFloatEqual(_rank([2, 1, 2, 5, 2]), [3, 1, 3, 5, 3])
+        self.assertFloatEqual(_rank([1, 1]), [1.5, 1.5])
+        self.assertFloatEqual(_rank([4]), [1])
+
+
+if __name__ == "__main__":
+    main()
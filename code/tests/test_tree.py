@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Jai Ram Rideout"
+__copyright__ = "Copyright 2013, The QIIME Project"
+__credits__ = ["Jai Ram Rideout"]
+__license__ = "GPL"
+__version__ = "0.0.0-dev"
+__maintainer__ = "Jai Ram Rideout"
+__email__ = "jai.rideout@gmail.com"
+
+"""Test suite for the tree.py module."""
+
+from StringIO import StringIO
+
+from cogent.util.unit_test import TestCase, main
+from numpy import array
+
+from microbiogeo.tree import (FlatTree, load_tree_index, parse_flat_tree,
+                              TreeNeighborhoodIndex)
+
+class TreeTests(TestCase):
+    """Tests for the tree.py module functions."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.newick = '(((a:1,b:2)x:5,d:1):4,c:3)root;'
+        self.tree = parse_flat_tree(StringIO(self.newick))
+
+    def test_parse_flat_tree(self):
+        """Test parsing a newick tree into flat arrays."""
+        self.assertEqual(self.tree.names,
+                         ['a', 'b', 'x', 'd', None, 'c', 'root'])
+        self.assertEqual(self.tree.parents, [2, 2, 4, 4, 6, 6, -1])
+        self.assertFloatEqual(self.tree.lengths, [1, 2, 5, 1, 4, 3, 0])
+        self.assertEqual(self.tree.depths, [3, 3, 2, 2, 1, 1, 0])
+        self.assertEqual(self.tree.is_tip,
+                         [True, True, False, True, False, True, False])
+
+
+class FlatTreeTests(TestCase):
+    """Tests for the FlatTree class."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.tree = parse_flat_tree(
+                StringIO('(((a:1,b:2)x:5,d:1):4,c:3)root;'))
+
+    def test_getTipIndices(self):
+        """Test looking up tips by name."""
+        self.assertEqual(self.tree.getTipIndices(['c', 'a', 'd']), [5, 0, 3])
+        self.assertRaises(ValueError, self.tree.getTipIndices, ['a', 'x'])
+        self.assertRaises(ValueError, self.tree.getTipIndices, ['foo'])
+
+    def test_propagate(self):
+        """Test summing values up the tree."""
+        obs = self.tree.propagate([1, 2, 0, 4, 0, 8, 0])
+        self.assertFloatEqual(obs, [1, 2, 3, 4, 7, 8, 15])
+
+        obs = self.tree.propagate(array([[1, 0], [0, 1], [0, 0], [1, 1],
+                                         [0, 0], [0, 2], [0, 0]]))
+        self.assertFloatEqual(obs, [[1, 0], [0, 1], [1, 1], [1, 1], [2, 2],
+                                    [0, 2], [2, 4]])
+
+    def test_subtree(self):
+        """Test removing nodes from the tree."""
+        obs = self.tree.subtree([True, True, True, False, True, False, True])
+        self.assertEqual(obs.names, ['a', 'b', 'x', None, 'root'])
+        self.assertEqual(obs.parents, [2, 2, 3, 4, -1])
+        self.assertFloatEqual(obs.lengths, [1, 2, 5, 4, 0])
+        self.assertEqual(obs.is_tip, [True, True, False, False, False])
+
+    def test_prune(self):
+        """Test pruning the tree to a subset of tips."""
+        obs = self.tree.prune(['b', 'd'])
+        self.assertEqual(obs.names, ['b', 'd', None, 'root'])
+        self.assertEqual(obs.parents, [2, 2, 3, -1])
+        self.assertFloatEqual(obs.lengths, [7, 1, 4, 0])
+
+        # The stem above the remaining tips is kept as a single branch.
+        obs = self.tree.prune(['a', 'b'])
+        self.assertEqual(obs.names, ['a', 'b', 'x', 'root'])
+        self.assertEqual(obs.parents, [2, 2, 3, -1])
+        self.assertFloatEqual(obs.lengths, [1, 2, 9, 0])
+
+        obs = self.tree.prune(['c'])
+        self.assertEqual(obs.names, ['c', 'root'])
+        self.assertFloatEqual(obs.lengths, [3, 0])
+
+        obs = self.tree.prune(['a', 'b', 'c', 'd'])
+        self.assertEqual(obs.names, self.tree.names)
+        self.assertEqual(obs.parents, self.tree.parents)
+
+        self.assertRaises(ValueError, self.tree.prune, [])
+        self.assertRaises(ValueError, self.tree.prune, ['a', 'foo'])
+
+    def test_getNewick(self):
+        """Test converting the tree to newick format."""
+        self.assertEqual(self.tree.getNewick(),
+                         '(((a:1.0,b:2.0)x:5.0,d:1.0):4.0,c:3.0)root;')
+        self.assertEqual(self.tree.prune(['b', 'd']).getNewick(),
+                         '((b:7.0,d:1.0):4.0)root;')
+
+        tree = parse_flat_tree(StringIO("(a_b:1,'c_d':2);"))
+        obs = parse_flat_tree(StringIO(tree.getNewick()))
+        self.assertEqual(obs.names, tree.names)
+
+    def test_single_node(self):
+        """Test a tree containing only a root."""
+        tree = FlatTree(['a'], [-1], [0])
+        self.assertEqual(tree.depths, [0])
+        self.assertEqual(tree.is_tip, [True])
+        self.assertFloatEqual(tree.propagate([3]), [3])
+
+
+class TreeNeighborhoodIndexTests(TestCase):
+    """Tests for the TreeNeighborhoodIndex class."""
+
+    def setUp(self):
+        """Define some sample data that will be used by the tests."""
+        self.tree = parse_flat_tree(
+                StringIO('(((a:1,b:2)x:5,d:1):4,c:3)root;'))
+        self.index = TreeNeighborhoodIndex.fromTree(self.tree, ['a', 'c'])
+
+    def test_fromTree(self):
+        """Test building an index from a tree."""
+        self.assertEqual(self.index.tip_names, ['a', 'b', 'd', 'c'])
+        self.assertEqual(self.index.otu_ids, ['a', 'c'])
+        self.assertFloatEqual(self.index.dists[0], [0, 1, 6, 10])
+        self.assertFloatEqual(self.index.dists[1][:2], [0, 3])
+        self.assertTrue((self.index.dists[1][2:] > 1e300).all())
+        self.assertEqual(self.index.first_tips[0], [0, 0, 0, 0])
+        self.assertEqual(self.index.num_tips[0], [1, 2, 3, 4])
+        self.assertEqual(self.index.first_tips[1][:2], [3, 0])
+        self.assertEqual(self.index.num_tips[1][:2], [1, 4])
+
+    def test_getNeighborhood(self):
+        """Test finding the tips near each OTU."""
+        first_tips, num_tips = self.index.getNeighborhood(0.0, ['a', 'c'])
+        self.assertEqual(first_tips, [0, 3])
+        self.assertEqual(num_tips, [1, 1])
+
+        first_tips, num_tips = self.index.getNeighborhood(5, ['c', 'a'])
+        self.assertEqual(first_tips, [0, 0])
+        self.assertEqual(num_tips, [4, 2])
+
+        first_tips, num_tips = self.index.getNeighborhood(100, ['a'])
+        self.assertEqual(first_tips, [0])
+        self.assertEqual(num_tips, [4])
+
+        self.assertRaises(KeyError, self.index.getNeighborhood, 1, ['b'])
+
+    def test_getNeighborhoodTips(self):
+        """Test finding the union of the tips near a set of OTUs."""
+        self.assertEqual(self.index.getNeighborhoodTips(0.0, ['a', 'c']),
+                         ['a', 'c'])
+        self.assertEqual(self.index.getNeighborhoodTips(2, ['c', 'a']),
+                         ['a', 'b', 'c'])
+        self.assertEqual(self.index.getNeighborhoodTips(5, ['c', 'a']),
+                         ['a', 'b', 'd', 'c'])
+        self.assertEqual(self.index.getNeighborhoodTips(2, ['a']),
+                         ['a', 'b'])
+
+    def test_save(self):
+        """Test saving and loading an index."""
+        index_f = StringIO()
+        self.index.save(index_f)
+        index_f.seek(0)
+        obs = load_tree_index(index_f)
+
+        self.assertEqual(obs.tip_names, self.index.tip_names)
+        self.assertEqual(obs.otu_ids, ['a', 'c'])
+        self.assertFloatEqual(obs.dists[0], self.index.dists[0])
+        self.assertEqual(obs.first_tips, self.index.first_tips)
+        self.assertEqual(obs.num_tips, self.index.num_tips)
+        self.assertEqual(obs.getNeighborhood(5, ['c', 'a']),
+                         self.index.getNeighborhood(5, ['c', 'a']))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,20 +12,31 @@ __email__ = "jai.rideout@gmail.com"
 """Test suite for the util.py module."""
 
 from os import chdir, getcwd
-from os.path import exists, join
+from os.path import exists, join, samefile
 from shutil import rmtree
 from tempfile import mkdtemp
 
 from cogent.util.misc import remove_files
 from cogent.util.unit_test import TestCase, main
-from qiime.parse import parse_distmat
+from numpy import float32, load, memmap
+from qiime.parse import parse_coords, parse_distmat
 from qiime.util import get_qiime_temp_dir
-
-from microbiogeo.util import (choose_gradient_subsets,
-                              ExternalCommandFailedError, get_color_pool,
-                              get_simsam_rep_num, has_results, is_empty,
-                              run_command, run_parallel_jobs, shuffle_dm,
-                              StatsResults, subset_dm, subset_groups)
+from scipy.spatial.distance import squareform
+
+from microbiogeo.util import (choose_gradient_subsets, compute_gradient_dm,
+                              derive_seed, ExternalCommandFailedError,
+                              get_binary_dm_fps,
+                              get_color_pool,
+                              get_num_samples_in_distance_matrix,
+                              get_simsam_rep_num, has_results,
+                              intersect_distance_matrices, is_empty,
+                              link_artifact,
+                              parse_distance_matrix, parse_subset_index,
+                              run_command, run_parallel_jobs, sample_items,
+                              shuffle_dm,
+                              shuffle_dm_and_coords, slice_dm, StatsResults,
+                              subset_dm, subset_groups, write_distance_matrix,
+                              write_subset_index)
 
 class UtilTests(TestCase):
     """Tests for the util.py module functions."""
@@ -33,6 +44,7 @@ class UtilTests(TestCase):
     def setUp(self):
         """Define some sample data that will be used by the tests."""
         self.dm_f1 = dm_str1.split('\n')
+        self.coords_f1 = coords_str1.split('\n')
         self.map_f1 = map_str1.split('\n')
 
         self.dm_f2 = dm_str2.split('\n')
@@ -149,6 +161,30 @@ class UtilTests(TestCase):
 
         self.assertRaises(ValueError, get_simsam_rep_num, 42, 42)
 
+    def test_derive_seed(self):
+        """Test deriving seeds for independent random streams."""
+        self.assertEqual(derive_seed(None, 'foo', 1), None)
+
+        obs = derive_seed(42, 'foo', 1)
+        self.assertEqual(obs, derive_seed(42, 'foo', 1))
+        self.assertTrue(0 <= obs < 2**31)
+        self.assertNotEqual(obs, derive_seed(42, 'foo', 2))
+        self.assertNotEqual(obs, derive_seed(43, 'foo', 1))
+        self.assertNotEqual(obs, derive_seed(42, 1, 'foo'))
+
+    def test_sample_items(self):
+        """Test sampling items without replacement."""
+        obs = sample_items(['a', 'b', 'c', 'd'], 2)
+        self.assertEqual(len(obs), 2)
+        self.assertEqual(len(set(obs)), 2)
+        self.assertTrue(set(obs) <= set(['a', 'b', 'c', 'd']))
+
+        # Sets are sampled in a reproducible order.
+        self.assertEqual(sample_items(set(['a', 'b', 'c', 'd']), 3, 7),
+                         sample_items(['a', 'b', 'c', 'd'], 3, 7))
+
+        self.assertRaises(ValueError, sample_items, ['a'], 2)
+
     def test_shuffle_dm(self):
         """Test shuffling labels of distance matrix."""
         exp_labels, exp_dm = parse_distmat(self.dm_f1)
@@ -168,6 +204,9 @@ class UtilTests(TestCase):
 
         self.assertTrue(order_changed)
 
+        # The same seed always gives the same shuffle.
+        self.assertEqual(shuffle_dm(self.dm_f1, 42), shuffle_dm(self.dm_f1, 42))
+
     def test_subset_dm(self):
         """Test picking a subset of a distance matrix."""
         # Don't actually subset.
@@ -188,6 +227,228 @@ class UtilTests(TestCase):
 
         self.assertRaises(ValueError, subset_dm, self.dm_f1, 4)
 
+    def test_write_and_parse_distance_matrix(self):
+        """Test writing and parsing text and binary distance matrices."""
+        exp_labels, exp_dm = parse_distmat(self.dm_f1)
+        text_fp = join(self.input_dir, 'dm.txt')
+        data_fp, ids_fp = get_binary_dm_fps(text_fp)
+        self.assertEqual(data_fp, join(self.input_dir, 'dm.npy'))
+        self.assertEqual(ids_fp, join(self.input_dir, 'dm_ids.txt'))
+
+        # Text only.
+        write_distance_matrix(text_fp, exp_labels, exp_dm)
+        self.assertFalse(exists(data_fp))
+        obs_labels, obs_dm = parse_distance_matrix(text_fp)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertFloatEqual(obs_dm, exp_dm)
+        self.assertEqual(get_num_samples_in_distance_matrix(text_fp), 3)
+
+        # Text and binary. Binary is used when reading the text filepath.
+        write_distance_matrix(text_fp, exp_labels, exp_dm, binary=True)
+        self.assertTrue(exists(data_fp))
+        obs_labels, obs_dm = parse_distance_matrix(text_fp)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertFloatEqual(obs_dm, exp_dm)
+        self.assertTrue(isinstance(obs_dm, memmap))
+        self.assertEqual(get_num_samples_in_distance_matrix(text_fp), 3)
+
+        # Binary only.
+        remove_files([text_fp])
+        obs_labels, obs_dm = parse_distance_matrix(data_fp)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertFloatEqual(obs_dm, exp_dm)
+        obs_labels, obs_dm = parse_distance_matrix(text_fp)
+        self.assertEqual(obs_labels, exp_labels)
+
+        # File-like objects are parsed as text.
+        obs_labels, obs_dm = parse_distance_matrix(self.dm_f1)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertFloatEqual(obs_dm, exp_dm)
+
+        # Util functions accept binary filepaths.
+        obs_labels, obs_data = slice_dm(data_fp, ['S2', 'S1'])
+        self.assertFloatEqual(obs_data, [[0, 0.5], [0.5, 0]])
+
+    def test_write_and_parse_condensed_distance_matrix(self):
+        """Test writing and parsing condensed binary distance matrices."""
+        exp_labels, exp_dm = parse_distmat(self.dm_f1)
+        text_fp = join(self.input_dir, 'dm.txt')
+        data_fp, ids_fp = get_binary_dm_fps(text_fp)
+
+        write_distance_matrix(text_fp, exp_labels, exp_dm, condensed=True)
+        self.assertTrue(exists(text_fp))
+        self.assertEqual(load(data_fp).shape, (3,))
+        self.assertEqual(load(data_fp).dtype, float32)
+
+        # Expanded to square form by default.
+        obs_labels, obs_dm = parse_distance_matrix(text_fp)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertEqual(obs_dm.shape, (3, 3))
+        self.assertFloatEqual(obs_dm, exp_dm)
+
+        obs_labels, obs_dm = parse_distance_matrix(text_fp, condensed=True)
+        self.assertTrue(isinstance(obs_dm, memmap))
+        self.assertFloatEqual(obs_dm, [0.5, 0.7, 0.1])
+
+        # Square matrices can be read in condensed form.
+        obs_labels, obs_dm = parse_distance_matrix(self.dm_f1, condensed=True)
+        self.assertFloatEqual(obs_dm, [0.5, 0.7, 0.1])
+
+        # Slicing doesn't expand the matrix, and handles repeated samples.
+        obs_labels, obs_data = slice_dm(data_fp, ['S3.0', 'S1.0', 'S3.1'],
+                                        strip_replicate_suffix=True)
+        self.assertFloatEqual(obs_data, [[0, 0.7, 0], [0.7, 0, 0.7],
+                                         [0, 0.7, 0]])
+        obs_labels, obs_data = slice_dm(data_fp, ['S3.0', 'S1.0', 'S3.1'],
+                                        strip_replicate_suffix=True,
+                                        condensed=True)
+        self.assertFloatEqual(obs_data, [0.7, 0, 0.7])
+
+        # Binary only.
+        remove_files([text_fp, data_fp, ids_fp])
+        write_distance_matrix(data_fp, exp_labels, exp_dm, condensed=True)
+        self.assertFalse(exists(text_fp))
+        self.assertEqual(load(data_fp).shape, (3,))
+        obs_labels, obs_dm = parse_distance_matrix(data_fp, condensed=True)
+        self.assertEqual(obs_labels, exp_labels)
+        self.assertFloatEqual(obs_dm, [0.5, 0.7, 0.1])
+        self.assertEqual(get_num_samples_in_distance_matrix(data_fp), 3)
+
+    def test_write_subset_index(self):
+        """Test writing and parsing subset indices."""
+        index_fp = join(self.input_dir, 'subsets.npz')
+        write_subset_index(index_fp, ['S1', 'S2', 'S3', 'S4'],
+                           {'a/0/2': ['S4', 'S2'], 'b/0/3': ['S1', 'S2', 'S3'],
+                            'c': []})
+        samp_ids, subsets = parse_subset_index(index_fp)
+        self.assertEqual(samp_ids, ['S1', 'S2', 'S3', 'S4'])
+        self.assertEqual(sorted(subsets), ['a/0/2', 'b/0/3', 'c'])
+        self.assertEqual(subsets['a/0/2'], [1, 3])
+        self.assertEqual(subsets['b/0/3'], [0, 1, 2])
+        self.assertEqual(len(subsets['c']), 0)
+
+        self.assertRaises(KeyError, write_subset_index, index_fp, ['S1'],
+                          {'a': ['S2']})
+
+    def test_link_artifact(self):
+        """Test linking copies of a file to a single stored copy."""
+        in_fp = join(self.input_dir, 'map.txt')
+        with open(in_fp, 'w') as in_f:
+            in_f.write(map_str1)
+        store_dir = join(self.input_dir, 'artifacts')
+        out_fps = [join(self.input_dir, 'a', 'map.txt'),
+                   join(self.input_dir, 'b', 'map.txt')]
+
+        store_fp = link_artifact(in_fp, out_fps, store_dir)
+        self.assertTrue(store_fp.startswith(store_dir))
+        self.assertTrue(store_fp.endswith('.txt'))
+        self.assertFalse(samefile(in_fp, store_fp))
+        for out_fp in out_fps:
+            self.assertTrue(samefile(out_fp, store_fp))
+            with open(out_fp, 'U') as out_f:
+                self.assertEqual(out_f.read(), map_str1)
+
+        # An identical file is linked to the same stored copy, and existing
+        # output files are replaced.
+        other_fp = join(self.input_dir, 'other_map.txt')
+        with open(other_fp, 'w') as other_f:
+            other_f.write(map_str1)
+        self.assertEqual(link_artifact(other_fp, out_fps[:1], store_dir),
+                         store_fp)
+        self.assertTrue(samefile(out_fps[0], store_fp))
+
+        with open(other_fp, 'w') as other_f:
+            other_f.write(map_str2)
+        self.assertNotEqual(link_artifact(other_fp, out_fps[:1], store_dir),
+                            store_fp)
+        with open(out_fps[0], 'U') as out_f:
+            self.assertEqual(out_f.read(), map_str2)
+        with open(out_fps[1], 'U') as out_f:
+            self.assertEqual(out_f.read(), map_str1)
+
+    def test_shuffle_dm_and_coords(self):
+        """Test shuffling a distance matrix along with its coordinates."""
+        exp_labels, exp_dm = parse_distmat(self.dm_f1)
+        exp_coords = parse_coords(self.coords_f1)
+        exp_coords_d = dict(zip(exp_coords[0], exp_coords[1]))
+
+        for i in range(10):
+            (obs_labels, obs_dm), obs_coords_str = shuffle_dm_and_coords(
+                    self.dm_f1, self.coords_f1)
+            obs_coords = parse_coords(obs_coords_str.split('\n'))
+
+            self.assertFloatEqual(obs_dm, exp_dm)
+            self.assertEqualItems(obs_labels, exp_labels)
+            self.assertEqual(obs_coords[0], obs_labels)
+            self.assertFloatEqual(obs_coords[2], exp_coords[2])
+            self.assertFloatEqual(obs_coords[3], exp_coords[3])
+
+            # Each row of coordinates moves with its row of distances.
+            for obs_label, exp_label, coords in zip(obs_labels, exp_labels,
+                                                    obs_coords[1]):
+                self.assertFloatEqual(coords, exp_coords_d[exp_label])
+
+        self.assertRaises(ValueError, shuffle_dm_and_coords, self.dm_f2,
+                          self.coords_f1)
+
+    def test_slice_dm(self):
+        """Test slicing a distance matrix by sample ID."""
+        obs_labels, obs_data = slice_dm(self.dm_f1, ['S3', 'S1'])
+        self.assertEqual(obs_labels, ['S3', 'S1'])
+        self.assertFloatEqual(obs_data, [[0, 0.7], [0.7, 0]])
+
+        # simsam.py replicates.
+        obs_labels, obs_data = slice_dm(self.dm_f1, ['S1.0', 'S1.1', 'S2.0'],
+                                        strip_replicate_suffix=True)
+        self.assertEqual(obs_labels, ['S1.0', 'S1.1', 'S2.0'])
+        self.assertFloatEqual(obs_data, [[0, 0, 0.5], [0, 0, 0.5],
+                                         [0.5, 0.5, 0]])
+
+        self.assertRaises(ValueError, slice_dm, self.dm_f1, ['S1', 'S4'])
+        self.assertRaises(ValueError, slice_dm, self.dm_f1, ['S1.0'])
+
+    def test_intersect_distance_matrices(self):
+        """Test making multiple distance matrices compatible."""
+        dm1 = parse_distmat(self.dm_f1)
+        dm2 = parse_distmat(self.dm_f2)
+
+        obs_labels, obs_data = intersect_distance_matrices([dm1, dm2, dm1])
+        self.assertEqual(obs_labels, ['S1', 'S2', 'S3'])
+        self.assertEqual(len(obs_data), 3)
+        self.assertFloatEqual(obs_data[0], dm1[1])
+        self.assertFloatEqual(obs_data[1], dm2[1][:3, :3])
+        self.assertFloatEqual(obs_data[2], dm1[1])
+
+        # Different sample order.
+        obs_labels, obs_data = intersect_distance_matrices([dm2, dm1])
+        self.assertEqual(obs_labels, ['S1', 'S2', 'S3'])
+        self.assertFloatEqual(obs_data[0], obs_data[1])
+
+        # Condensed matrices stay condensed.
+        condensed_dm1 = (dm1[0], squareform(dm1[1]))
+        condensed_dm2 = (dm2[0], squareform(dm2[1]))
+        obs_labels, obs_data = intersect_distance_matrices([condensed_dm1,
+                                                            condensed_dm2])
+        self.assertEqual(obs_labels, ['S1', 'S2', 'S3'])
+        self.assertTrue(obs_data[0] is condensed_dm1[1])
+        self.assertFloatEqual(obs_data[1], squareform(dm2[1][:3, :3]))
+
+        obs_labels, obs_data = intersect_distance_matrices([dm2,
+                                                            condensed_dm1])
+        self.assertFloatEqual(obs_data[0], dm1[1])
+        self.assertFloatEqual(obs_data[1], squareform(dm1[1]))
+
+    def test_compute_gradient_dm(self):
+        """Test computing a gradient distance matrix from a mapping file."""
+        obs_labels, obs_data = compute_gradient_dm(self.map_f1, 'Gradient')
+        self.assertEqual(obs_labels, ['S1', 'S2', 'S3', 'S4'])
+        self.assertFloatEqual(obs_data, [[0, 2, 1, 2], [2, 0, 1, 0],
+                                         [1, 1, 0, 1], [2, 0, 1, 0]])
+
+        self.assertRaises(ValueError, compute_gradient_dm, self.map_f1,
+                          'Category')
+        self.assertRaises(ValueError, compute_gradient_dm, self.map_f1, 'Foo')
+
     def test_subset_groups(self):
         """Test picking subsets of sample groups in distance matrix."""
         # Don't filter anything out.
@@ -243,6 +504,21 @@ class UtilTests(TestCase):
         self.assertEqual(obs[4], exp)
         self.assertEqual(obs[5], exp)
 
+        # The same seed always gives the same subsets.
+        self.assertEqual(choose_gradient_subsets(self.dm_f2, self.map_f2,
+                                                 'Gradient', [2, 1], 5, 42),
+                         choose_gradient_subsets(self.dm_f2, self.map_f2,
+                                                 'Gradient', [2, 1], 5, 42))
+
+        # Tied samples are ordered by sample ID, not by the order that the
+        # mapping file is parsed into.
+        tied_map_f = [line.rsplit('\t', 1)[0] + '\t1'
+                      for line in self.map_f2[1:]]
+        tied_map_f.insert(0, self.map_f2[0])
+        obs = choose_gradient_subsets(self.dm_f2, tied_map_f, 'Gradient', [5],
+                                      1)
+        self.assertEqual(obs, [['S1', 'S2', 'S3', 'S4', 'S5']])
+
     def test_is_empty(self):
         """Test checking if category results are empty or not."""
         self.assertTrue(is_empty(self.cat_res1))
@@ -274,6 +550,17 @@ class StatsResultsTests(TestCase):
         self.assertFloatEqual(self.sr1.effect_size, 0.5)
         self.assertFloatEqual(self.sr1.p_values, [0.01, 0.001])
 
+    def test_addResult_no_p_value(self):
+        """Adding an effect size without a p-value works correctly."""
+        self.sr1.addResult(0.5, None)
+        self.assertFloatEqual(self.sr1.effect_size, 0.5)
+        self.assertEqual(self.sr1.p_values, [])
+        self.assertFalse(self.sr1.isEmpty())
+
+        self.sr1.addResult(0.5, 0.01)
+        self.assertFloatEqual(self.sr1.p_values, [0.01])
+        self.assertRaises(ValueError, self.sr1.addResult, 0.6, None)
+
     def test_addResult_invalid_input(self):
         """Adding invalid input raises error."""
         # Effect sizes don't match.
@@ -359,6 +646,15 @@ S1\t0\t0.5\t0.7
 S2\t0.5\t0\t0.1
 S3\t0.7\t0.1\t0"""
 
+coords_str1 = """pc vector number\t1\t2
+S2\t0.1\t-0.2
+S3\t0.3\t0.4
+S1\t-0.5\t0.6
+
+
+eigvals\t0.7\t0.2
+% variation explained\t70.0\t20.0"""
+
 map_str1 = """#SampleID\tBarcodeSequence\tCategory\tGradient
 S1\tAGCACGAGCCTA\tCat1\t4
 S2\tAGCACGAGCCTG\tCat2\t2
@@ -16,17 +16,27 @@ from os.path import exists, join
 from shutil import rmtree
 from tempfile import mkdtemp
 
+from biom.table import table_factory
 from cogent.util.misc import remove_files
 from cogent.util.unit_test import TestCase, main
+from numpy import array
 from qiime.util import create_dir, get_qiime_temp_dir
 
-from microbiogeo.method import Adonis, Anosim, Mantel, MantelCorrelogram, Best
+from microbiogeo.method import (Adonis, Anosim, Mantel, MantelCorrelogram,
+                                Best, Permanova)
 from microbiogeo.util import StatsResults
-from microbiogeo.workflow import (_build_per_metric_real_data_commands,
+from microbiogeo.workflow import (_build_beta_diversity_commands,
+                                  _build_choose_subsets_command,
+                                  _build_rarefy_tables_command,
+                                  _build_per_metric_real_data_commands,
+                                  _build_simulate_tables_command,
+                                  _build_simulated_data_commands,
+                                  _build_sliced_dm_commands,
                                   _collate_real_data_results,
                                   _collate_simulated_data_results,
                                   _parse_original_results_file,
-                                  _parse_shuffled_results_files)
+                                  _parse_shuffled_results_files,
+                                  _writes_gradient_dms, _writes_text_dms)
 
 class WorkflowTests(TestCase):
     """Tests for the workflow.py module functions."""
@@ -72,19 +82,283 @@ class WorkflowTests(TestCase):
             }
         }
 
+        self.dirs_to_remove = []
+
+    def tearDown(self):
+        """Remove temporary dirs created by tests."""
+        for d in self.dirs_to_remove:
+            if exists(d):
+                rmtree(d)
+
     def test_build_per_metric_real_data_commands(self):
-        exp = 'beta_diversity.py -i /bar/baz.biom -o /foo/original -m unweighted_unifrac -t /bar/tree.tre && mv /foo/original/unweighted_unifrac_baz.txt /foo/original/dm.txt && cp /map.txt /foo/original/map.txt && principal_coordinates.py -i /foo/original/dm.txt -o /foo/original/pc.txt && mkdir -p /foo/0 && shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt && cp /foo/original/map.txt /foo/0/map.txt && principal_coordinates.py -i /foo/0/dm.txt -o /foo/0/pc.txt && mkdir -p /foo/1 && shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/1/dm.txt && cp /foo/original/map.txt /foo/1/map.txt && principal_coordinates.py -i /foo/1/dm.txt -o /foo/1/pc.txt'
+        exp = ['cp /map.txt /foo/original/map.txt', 'compute_pcoa.py -i /foo/original/dm.txt -o /foo/original/pc.txt', 'mkdir -p /foo/0', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt -c /foo/original/pc.txt -p /foo/0/pc.txt', 'cp /foo/original/map.txt /foo/0/map.txt', 'mkdir -p /foo/1', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/1/dm.txt -c /foo/original/pc.txt -p /foo/1/pc.txt', 'cp /foo/original/map.txt /foo/1/map.txt']
         obs = _build_per_metric_real_data_commands('cluster', '/foo',
-                '/bar/baz.biom', '/map.txt', '/bar/tree.tre',
-                ('unweighted_unifrac', 'Unweighted UniFrac'), ['A', 'B'], 2)
+                '/map.txt', ['A', 'B'], 2)
         self.assertEqual(obs, exp)
 
-        exp = 'beta_diversity.py -i /bar/baz.biom -o /foo/original -m unweighted_unifrac -t /bar/tree.tre && mv /foo/original/unweighted_unifrac_baz.txt /foo/original/dm.txt && cp /map.txt /foo/original/map.txt && principal_coordinates.py -i /foo/original/dm.txt -o /foo/original/pc.txt && distance_matrix_from_mapping.py -i /foo/original/map.txt -c A -o /foo/original/A_dm.txt && distance_matrix_from_mapping.py -i /foo/original/map.txt -c B -o /foo/original/B_dm.txt && mkdir -p /foo/0 && shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt && cp /foo/original/map.txt /foo/0/map.txt && principal_coordinates.py -i /foo/0/dm.txt -o /foo/0/pc.txt && distance_matrix_from_mapping.py -i /foo/0/map.txt -c A -o /foo/0/A_dm.txt && distance_matrix_from_mapping.py -i /foo/0/map.txt -c B -o /foo/0/B_dm.txt && mkdir -p /foo/1 && shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/1/dm.txt && cp /foo/original/map.txt /foo/1/map.txt && principal_coordinates.py -i /foo/1/dm.txt -o /foo/1/pc.txt && distance_matrix_from_mapping.py -i /foo/1/map.txt -c A -o /foo/1/A_dm.txt && distance_matrix_from_mapping.py -i /foo/1/map.txt -c B -o /foo/1/B_dm.txt'
+        exp = ['cp /map.txt /foo/original/map.txt', 'compute_pcoa.py -i /foo/original/dm.txt -o /foo/original/pc.txt', 'distance_matrix_from_mapping.py -i /foo/original/map.txt -c A -o /foo/original/A_dm.txt', 'distance_matrix_from_mapping.py -i /foo/original/map.txt -c B -o /foo/original/B_dm.txt', 'mkdir -p /foo/0', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt -c /foo/original/pc.txt -p /foo/0/pc.txt', 'cp /foo/original/map.txt /foo/0/map.txt', 'distance_matrix_from_mapping.py -i /foo/0/map.txt -c A -o /foo/0/A_dm.txt', 'distance_matrix_from_mapping.py -i /foo/0/map.txt -c B -o /foo/0/B_dm.txt']
         obs = _build_per_metric_real_data_commands('gradient', '/foo',
-                '/bar/baz.biom', '/map.txt', '/bar/tree.tre',
-                ('unweighted_unifrac', 'Unweighted UniFrac'), ['A', 'B'], 2)
+                '/map.txt', ['A', 'B'], 1)
+        self.assertEqual(obs, exp)
+
+        exp = ['cp /map.txt /foo/original/map.txt', 'compute_pcoa.py -i /foo/original/dm.txt -o /foo/original/pc.txt', 'mkdir -p /foo/0', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt -c /foo/original/pc.txt -p /foo/0/pc.txt -b', 'cp /foo/original/map.txt /foo/0/map.txt']
+        obs = _build_per_metric_real_data_commands('cluster', '/foo',
+                '/map.txt', ['A', 'B'], 1, binary=True)
+        self.assertEqual(obs, exp)
+
+        # Gradient distance matrices aren't written.
+        exp = ['cp /map.txt /foo/original/map.txt', 'compute_pcoa.py -i /foo/original/dm.txt -o /foo/original/pc.txt', 'mkdir -p /foo/0', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt -c /foo/original/pc.txt -p /foo/0/pc.txt', 'cp /foo/original/map.txt /foo/0/map.txt']
+        obs = _build_per_metric_real_data_commands('gradient', '/foo',
+                '/map.txt', ['A', 'B'], 1, gradient_dms=False)
+        self.assertEqual(obs, exp)
+
+        # Copies of the mapping file are links to a stored copy.
+        exp = ['link_artifacts.py -i /map.txt -o /foo/original/map.txt,/foo/0/map.txt,/foo/1/map.txt -s /art', 'compute_pcoa.py -i /foo/original/dm.txt -o /foo/original/pc.txt', 'mkdir -p /foo/0', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/0/dm.txt -c /foo/original/pc.txt -p /foo/0/pc.txt', 'mkdir -p /foo/1', 'shuffle_distance_matrix.py -i /foo/original/dm.txt -o /foo/1/dm.txt -c /foo/original/pc.txt -p /foo/1/pc.txt']
+        obs = _build_per_metric_real_data_commands('cluster', '/foo',
+                '/map.txt', ['A', 'B'], 2, artifact_dir='/art')
+        self.assertEqual(obs, exp)
+
+    def test_build_choose_subsets_command(self):
+        exp = 'choose_data_subset.py -t gradient -i /foo/t.biom -m /foo/m.txt -c PH -n 5 -o /bar/0/5'
+        obs = _build_choose_subsets_command('gradient', '/foo/t.biom',
+                '/foo/m.txt', ['PH'], [5], ['/bar/0/5'])
+        self.assertEqual(obs, exp)
+
+        exp = 'choose_data_subset.py -t cluster -i /foo/t.biom -m /foo/m.txt -c A,A,B -n 5,10,5 -o /bar/A/0/5,/bar/A/0/10,/bar/B/0/5'
+        obs = _build_choose_subsets_command('cluster', '/foo/t.biom',
+                '/foo/m.txt', ['A', 'A', 'B'], [5, 10, 5],
+                ['/bar/A/0/5', '/bar/A/0/10', '/bar/B/0/5'])
+        self.assertEqual(obs, exp)
+
+        exp = 'choose_data_subset.py -t gradient -i /foo/t.biom -m /foo/m.txt -c PH -n 5 -o PH/0/5 --subset_index /bar/subsets.npz'
+        obs = _build_choose_subsets_command('gradient', '/foo/t.biom',
+                '/foo/m.txt', ['PH'], [5], ['PH/0/5'],
+                subset_index_fp='/bar/subsets.npz')
+        self.assertEqual(obs, exp)
+
+        exp = 'choose_data_subset.py -t cluster -i /foo/t.biom -m /foo/m.txt -c A,B -n 5,5 -o /bar/A/0/5,/bar/B/0/5 --seed 3,7'
+        obs = _build_choose_subsets_command('cluster', '/foo/t.biom',
+                '/foo/m.txt', ['A', 'B'], [5, 5], ['/bar/A/0/5', '/bar/B/0/5'],
+                seeds=[3, 7])
+        self.assertEqual(obs, exp)
+
+        exp = 'choose_data_subset.py -t cluster -i /foo/t.biom -m /foo/m.txt -c A -n 20 -o A/0/20 --subset_index /bar/subsets_n3.npz --num_replicates 3'
+        obs = _build_choose_subsets_command('cluster', '/foo/t.biom',
+                '/foo/m.txt', ['A'], [20], ['A/0/20'], '/bar/subsets_n3.npz',
+                num_reps=3)
+        self.assertEqual(obs, exp)
+
+        # Unseeded subsets don't get a seed.
+        obs = _build_choose_subsets_command('cluster', '/foo/t.biom',
+                '/foo/m.txt', ['A'], [5], ['/bar/A/0/5'], seeds=[None])
+        self.assertFalse('--seed' in obs)
+
+    def test_build_rarefy_tables_command(self):
+        exp = 'rarefy_tables.py -i /foo/t.biom -d 10,20 -o /bar/10/t.biom,/bar/20/t.biom'
+        obs = _build_rarefy_tables_command('/foo/t.biom', [10, 20],
+                                           ['/bar/10/t.biom', '/bar/20/t.biom'])
+        self.assertEqual(obs, exp)
+
+        exp = 'rarefy_tables.py -i /foo/t.biom -d 10 -o /bar/10/t.biom --seed 42'
+        obs = _build_rarefy_tables_command('/foo/t.biom', [10],
+                                           ['/bar/10/t.biom'], 42)
+        self.assertEqual(obs, exp)
+
+    def test_build_simulate_tables_command(self):
+        exp = 'simulate_tables.py -i /foo/t.biom -m /foo/m.txt -t /foo/t.tre -n 2 -d 0.0,0.001,10.0 -o /bar/0.0,/bar/0.001,/bar/10.0'
+        obs = _build_simulate_tables_command('/foo/t.biom', '/foo/m.txt',
+                '/foo/t.tre', 2, [0.0, 0.001, 10.0],
+                ['/bar/0.0', '/bar/0.001', '/bar/10.0'])
+        self.assertEqual(obs, exp)
+
+        exp = 'simulate_tables.py -i /foo/t.biom -m /foo/m.txt -x /foo/t.npz -n 1 -d 0.1 -o /bar/0.1'
+        obs = _build_simulate_tables_command('/foo/t.biom', '/foo/m.txt',
+                '/foo/t.tre', 1, [0.1], ['/bar/0.1'],
+                tree_index_fp='/foo/t.npz')
+        self.assertEqual(obs, exp)
+
+        exp = 'simulate_tables.py -i /foo/t.biom -m /foo/m.txt -x /foo/t.npz -n 1 -d 0.1 -o /bar/0.1 --subset_index /bar/subsets.npz --subset PH/0/5'
+        obs = _build_simulate_tables_command('/foo/t.biom', '/foo/m.txt',
+                '/foo/t.tre', 1, [0.1], ['/bar/0.1'], '/foo/t.npz',
+                '/bar/subsets.npz', 'PH/0/5')
+        self.assertEqual(obs, exp)
+
+        exp = 'simulate_tables.py -i /foo/t.biom -m /foo/m.txt -t /foo/t.tre -n 1 -d 0.1 -o /bar/0.1 --seed 42'
+        obs = _build_simulate_tables_command('/foo/t.biom', '/foo/m.txt',
+                '/foo/t.tre', 1, [0.1], ['/bar/0.1'], seed=42)
         self.assertEqual(obs, exp)
 
+    def test_writes_gradient_dms(self):
+        self.assertFalse(_writes_gradient_dms({'methods': [Mantel()]}))
+        self.assertTrue(_writes_gradient_dms(
+                {'methods': [Mantel(), MantelCorrelogram()]}))
+        self.assertTrue(_writes_gradient_dms({'methods': [Mantel()],
+                                              'export_gradient_dms': True}))
+
+    def test_writes_text_dms(self):
+        workflow = {'metrics': [('bray_curtis', 'BC')],
+                    'methods': [Mantel(), Anosim(), Permanova()],
+                    'batch_metrics': True}
+        self.assertTrue(_writes_text_dms(workflow))
+
+        workflow['condensed_dms'] = True
+        self.assertFalse(_writes_text_dms(workflow))
+
+        # Run by QIIME.
+        self.assertTrue(_writes_text_dms(dict(workflow,
+                methods=[Mantel(), Adonis()])))
+        self.assertTrue(_writes_text_dms(dict(workflow, batch_metrics=False)))
+        self.assertTrue(_writes_text_dms(dict(workflow,
+                metrics=[('euclidean', 'Euclidean')])))
+
+    def test_build_beta_diversity_commands(self):
+        # All native metrics are computed by a single command.
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m unweighted_unifrac,bray_curtis,weighted_unifrac -o /foo/uu/dm.txt,/foo/bc/dm.txt,/foo/wu/dm.txt -t /bar/tree.tre']
+        obs = _build_beta_diversity_commands('/bar/baz.biom',
+                ['/foo/uu', '/foo/bc', '/foo/wu'],
+                ['unweighted_unifrac', 'bray_curtis', 'weighted_unifrac'],
+                '/bar/tree.tre')
+        self.assertEqual(obs, exp)
+
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m unweighted_unifrac -o /foo/uu/dm.txt -t /bar/tree.tre -b']
+        obs = _build_beta_diversity_commands('/bar/baz.biom', ['/foo/uu'],
+                ['unweighted_unifrac'], '/bar/tree.tre', binary=True)
+        self.assertEqual(obs, exp)
+
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m unweighted_unifrac -o /foo/uu/dm.txt -t /bar/tree.tre --condensed']
+        obs = _build_beta_diversity_commands('/bar/baz.biom', ['/foo/uu'],
+                ['unweighted_unifrac'], '/bar/tree.tre', condensed=True)
+        self.assertEqual(obs, exp)
+
+        # Binary only.
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m unweighted_unifrac -o /foo/uu/dm.npy -t /bar/tree.tre --condensed']
+        obs = _build_beta_diversity_commands('/bar/baz.biom', ['/foo/uu'],
+                ['unweighted_unifrac'], '/bar/tree.tre', condensed=True,
+                text=False)
+        self.assertEqual(obs, exp)
+
+        # Non-phylogenetic metric.
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m bray_curtis -o /foo/bc/dm.txt']
+        obs = _build_beta_diversity_commands('/bar/baz.biom', ['/foo/bc'],
+                                             ['bray_curtis'], '/bar/tree.tre')
+        self.assertEqual(obs, exp)
+
+        # Metric without a native implementation.
+        exp = ['compute_distance_matrices.py -i /bar/baz.biom -m bray_curtis -o /foo/bc/dm.txt', 'beta_diversity.py -i /bar/baz.biom -o /foo/eu -m euclidean -t /bar/tree.tre', 'mv /foo/eu/euclidean_baz.txt /foo/eu/dm.txt']
+        obs = _build_beta_diversity_commands('/bar/baz.biom',
+                ['/foo/eu', '/foo/bc'], ['euclidean', 'bray_curtis'],
+                '/bar/tree.tre')
+        self.assertEqual(obs, exp)
+
+    def test_build_sliced_dm_commands(self):
+        exp = ['slice_distance_matrix.py -i /foo/real/unweighted_unifrac/original/dm.txt -m /bar/map.txt -o /baz/unweighted_unifrac/dm.txt --strip_replicate_suffix', 'slice_distance_matrix.py -i /foo/real/bray_curtis/original/dm.txt -m /bar/map.txt -o /baz/bray_curtis/dm.txt --strip_replicate_suffix']
+        obs = _build_sliced_dm_commands('/foo/real', '/bar/map.txt',
+                ['/baz/unweighted_unifrac', '/baz/bray_curtis'],
+                ['unweighted_unifrac', 'bray_curtis'])
+        self.assertEqual(obs, exp)
+
+        exp = ['slice_distance_matrix.py -i /foo/real/bray_curtis/original/dm.txt -m /bar/map.txt -o /baz/bray_curtis/dm.txt --strip_replicate_suffix -b']
+        obs = _build_sliced_dm_commands('/foo/real', '/bar/map.txt',
+                ['/baz/bray_curtis'], ['bray_curtis'], binary=True)
+        self.assertEqual(obs, exp)
+
+        exp = ['slice_distance_matrix.py -i /foo/real/bray_curtis/original/dm.txt -m /bar/map.txt -o /baz/bray_curtis/dm.txt --strip_replicate_suffix --condensed']
+        obs = _build_sliced_dm_commands('/foo/real', '/bar/map.txt',
+                ['/baz/bray_curtis'], ['bray_curtis'], binary=True,
+                condensed=True)
+        self.assertEqual(obs, exp)
+
+        exp = ['slice_distance_matrix.py -i /foo/real/bray_curtis/original/dm.npy -m /bar/map.txt -o /baz/bray_curtis/dm.npy --strip_replicate_suffix --condensed']
+        obs = _build_sliced_dm_commands('/foo/real', '/bar/map.txt',
+                ['/baz/bray_curtis'], ['bray_curtis'], binary=True,
+                condensed=True, text=False)
+        self.assertEqual(obs, exp)
+
+    def test_build_simulated_data_commands_shared_tables(self):
+        """Test replicated tables are simulated once and shared."""
+        out_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                          prefix='microbiogeo_tests_')
+        self.dirs_to_remove.append(out_dir)
+
+        # Three samples, so sample sizes 4 and 7 need 2 and 3 replicates.
+        table_fp = join(out_dir, 'otu_table.biom')
+        with open(table_fp, 'w') as table_f:
+            table_f.write(table_factory(array([[1, 2, 3], [4, 0, 1]]),
+                                        ['S1', 'S2', 'S3'], ['O1', 'O2'])
+                          .getBiomFormatJsonString('test'))
+
+        workflow = {'categories': [('A', 'A'), ('B', 'B')],
+                    'metrics': [('bray_curtis', 'Bray-Curtis')],
+                    'methods': [Anosim()],
+                    'dissim': [0.1, 1.0],
+                    'sample_sizes': [4, 7],
+                    'num_sim_data_trials': 2,
+                    'in_process_simsam': True,
+                    'share_simulated_tables': True}
+        table_cmds, subset_table_cmds, cmds = _build_simulated_data_commands(
+                'cluster', out_dir, table_fp, '/foo/map.txt', '/foo/tree.tre',
+                workflow, tree_index_fp='/foo/index.npz')
+
+        # One simulate_tables.py command for each trial and number of
+        # replicates, shared by both categories.
+        replicated_dir = join(out_dir, 'simulated', 'replicated')
+        exp = ['simulate_tables.py -i %s -m /foo/map.txt -x /foo/index.npz -n %d -d 0.1,1.0 -o %s,%s' % (table_fp, num_reps, join(replicated_dir, '%d' % trial_num, '%d' % num_reps, '0.1'), join(replicated_dir, '%d' % trial_num, '%d' % num_reps, '1.0')) for trial_num in range(2) for num_reps in (2, 3)]
+        self.assertEqual(table_cmds, exp)
+        self.assertEqual(subset_table_cmds, [])
+
+        # Each category, trial, sample size and dissimilarity chooses its
+        # subset from the shared table instead of simulating its own.
+        self.assertEqual(len(cmds), 16)
+        for category in 'A', 'B':
+            for trial_num in range(2):
+                for samp_size, num_reps in (4, 2), (7, 3):
+                    for d in '0.1', '1.0':
+                        sim_table_fp = join(replicated_dir, '%d' % trial_num,
+                                            '%d' % num_reps, d,
+                                            'otu_table_n%d_d%s.biom' %
+                                            (num_reps, d))
+                        dissim_dir = join(out_dir, 'simulated', category,
+                                          '%d' % trial_num, '%d' % samp_size,
+                                          d)
+                        exp = 'choose_data_subset.py -t cluster -i %s -m %s -c %s -n %d -o %s &&' % (sim_table_fp, join(replicated_dir, '%d' % trial_num, '%d' % num_reps, d, 'map_n%d_d%s.txt' % (num_reps, d)), category, samp_size, join(dissim_dir, 'subset'))
+                        self.assertEqual(len([cmd for cmd in cmds
+                                              if cmd.startswith(exp)]), 1)
+
+        for cmd in cmds:
+            self.assertFalse('simulate_tables.py' in cmd)
+            self.assertFalse('simsam.py' in cmd)
+
+    def test_build_simulated_data_commands_sim_tree(self):
+        """Test simulated distance matrices are computed with sim_tree_fp."""
+        out_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                          prefix='microbiogeo_tests_')
+        self.dirs_to_remove.append(out_dir)
+
+        table_fp = join(out_dir, 'otu_table.biom')
+        with open(table_fp, 'w') as table_f:
+            table_f.write(table_factory(array([[1, 2, 3], [4, 0, 1]]),
+                                        ['S1', 'S2', 'S3'], ['O1', 'O2'])
+                          .getBiomFormatJsonString('test'))
+
+        workflow = {'categories': [('A', 'A')],
+                    'metrics': [('weighted_unifrac', 'Weighted UniFrac')],
+                    'methods': [Anosim()],
+                    'dissim': [0.1, 1.0],
+                    'sample_sizes': [4, 7],
+                    'num_sim_data_trials': 1}
+        table_cmds, subset_table_cmds, cmds = _build_simulated_data_commands(
+                'cluster', out_dir, table_fp, '/foo/map.txt', '/foo/tree.tre',
+                workflow, sim_tree_fp='/foo/sim_tree.tre')
+
+        # simsam.py draws from the full tree, but distances are computed
+        # using the pruned one.
+        self.assertEqual(len(cmds), 4)
+        for cmd in cmds:
+            self.assertTrue(' -t /foo/tree.tre ' in cmd)
+            self.assertTrue('compute_distance_matrices.py' in cmd)
+            self.assertEqual(cmd.count('/foo/tree.tre'), 1)
+            self.assertTrue(' -t /foo/sim_tree.tre' in cmd)
+
     def test_collate_real_data_results(self):
         """Test collating real data results."""
         # These methods should be skipped.